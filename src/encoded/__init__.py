@@ -210,6 +210,7 @@ def main(global_config, **local_config):
     config.include('.ingestion.ingestion_message_handler_vcf')
     config.include('snovault.ingestion.ingestion_message_handler_default')
     config.include('.ingestion.ingestion_processors')
+    config.include('.ingestion.bulk_upsert')
     config.include('.custom_embed')
 
     if 'elasticsearch.server' in config.registry.settings:
@@ -2,13 +2,17 @@ import datetime
 import json
 import pytz
 import structlog
+from itertools import islice
 
 from pyramid.httpexceptions import HTTPBadRequest  # , HTTPMovedPermanently, HTTPServerError, HTTPTemporaryRedirect,
 from pyramid.view import view_config
 from pyramid.response import Response
 # from pyramid.traversal import find_resource
+from elasticsearch_dsl import Search, Q
+from snovault import STORAGE, TYPES
+from snovault.elasticsearch.esstorage import CachedModel
 from snovault.embed import make_subrequest
-from snovault.util import simple_path_ids, debug_log
+from snovault.util import filter_embedded, simple_path_ids, debug_log, validate_es_content
 
 from .batch_download_utils import stream_tsv_output, convert_item_to_sheet_dict, human_readable_filter_block_queries
 from snovault.search.compound_search import CompoundSearchBuilder
@@ -17,6 +21,24 @@ from .types.variant import get_spreadsheet_mappings
 
 log = structlog.getLogger(__name__)
 
+NOTE_CONTAINING_FIELDS = [
+    "variant.interpretations",
+    "variant.discovery_interpretations",
+    "variant.variant_notes",
+    "variant.genes.genes_most_severe_gene.gene_notes",
+    "interpretation",
+    "discovery_interpretation",
+    "variant_notes",
+    "gene_notes"
+]
+# Fields of the Elasticsearch documents of notes needed by get_indexed_notes, ie: to build their CachedModel
+INDEXED_NOTE_FIELDS = [
+    "item_type", "uuid", "sid", "properties", "embedded", "principals_allowed", "linked_uuids_embedded",
+    "rev_link_names"
+]
+# Number of variant samples whose notes are embedded together, see embed_and_merge_note_items_to_variant_samples
+NOTE_EMBED_WINDOW_SIZE = 100
+
 def includeme(config):
     config.add_route('variant_sample_search_spreadsheet', '/variant-sample-search-spreadsheet/')
     config.scan(__name__)
@@ -81,10 +103,15 @@ def variant_sample_search_spreadsheet(context, request):
     )
 
     def vs_dicts_generator():
-        for embedded_representation_variant_sample in compound_search_res:
-            # Extends `embedded_representation_variant_sample` in place
-            embed_and_merge_note_items_to_variant_sample(request, embedded_representation_variant_sample)
-            yield convert_item_to_sheet_dict(embedded_representation_variant_sample, spreadsheet_mappings)
+        vs_iterator = iter(compound_search_res)
+        while True:
+            window = list(islice(vs_iterator, NOTE_EMBED_WINDOW_SIZE))
+            if not window:
+                break
+            # Extends each `embedded_representation_variant_sample` in place
+            embed_and_merge_note_items_to_variant_samples(request, window)
+            for embedded_representation_variant_sample in window:
+                yield convert_item_to_sheet_dict(embedded_representation_variant_sample, spreadsheet_mappings)
 
 
     header_info_rows = [
@@ -120,29 +147,100 @@ def embed_and_merge_note_items_to_variant_sample(request, embedded_vs):
     '''
     Important: Modifies `embedded_vs` in-place.
 
-    This function requires that `embedded_vs` contain the below
-    `note_containing_fields` with at least a populated `@id` field
+    This function requires that `embedded_vs` contain the
+    `NOTE_CONTAINING_FIELDS` with at least a populated `@id` field
     (if present).
     '''
-    note_containing_fields = [
-        "variant.interpretations",
-        "variant.discovery_interpretations",
-        "variant.variant_notes",
-        "variant.genes.genes_most_severe_gene.gene_notes",
-        "interpretation",
-        "discovery_interpretation",
-        "variant_notes",
-        "gene_notes"
+    embed_and_merge_note_items_to_variant_samples(request, [embedded_vs])
+
+
+def embed_and_merge_note_items_to_variant_samples(request, embedded_vss):
+    '''
+    Important: Modifies each of `embedded_vss` in-place.
+
+    Embeds the notes of a window of variant samples together, so that each
+    distinct note (the same gene/variant notes recur across variant samples)
+    is only fetched once: those indexed in Elasticsearch in a single multi-get
+    if the variant samples are read from Elasticsearch (see get_indexed_notes),
+    the others with a subrequest each.
+    '''
+    incomplete_note_objs = [
+        incomplete_note_obj
+        for embedded_vs in embedded_vss
+        for note_field in NOTE_CONTAINING_FIELDS
+        for incomplete_note_obj in simple_path_ids(embedded_vs, note_field)
     ]
-    # TODO: Parallelize (^ notes per VS)?
-    for note_field in note_containing_fields:
-        for incomplete_note_obj in simple_path_ids(embedded_vs, note_field):
-            # Using request.embed instead of CustomEmbed because we're fine with getting from ES (faster)
-            # for search-based spreadsheet requests.
-            note_subreq = make_subrequest(request, incomplete_note_obj["@id"])
-            # We don't get _stats on subreq of www-encoded-form POST requests; need to look into (could perhaps amend in snovault)
-            # Add this in to prevent error in snovault's `after_cursor_execute`
-            setattr(note_subreq, "_stats", request._stats)
-            note_response = request.invoke_subrequest(note_subreq)
-            incomplete_note_obj.update(note_response.json)
+    note_ids = list(dict.fromkeys(incomplete_note_obj["@id"] for incomplete_note_obj in incomplete_note_objs))
+    notes = get_indexed_notes(request, note_ids) if reads_indexed_notes(request) else {}
+    for note_id in note_ids:
+        if note_id not in notes:
+            notes[note_id] = embed_note(request, note_id)
+    for incomplete_note_obj in incomplete_note_objs:
+        incomplete_note_obj.update(notes[incomplete_note_obj["@id"]])
+
 
+def reads_indexed_notes(request):
+    '''
+    Returns whether notes are read from Elasticsearch, as the variant samples
+    of the spreadsheet are: for GET requests reading from Elasticsearch, and for
+    the form POSTs of the UI (for which snovault reads from the database) unless
+    the collection datastore is the database.
+    '''
+    if request.method in ("HEAD", "GET"):
+        return request.datastore == "elasticsearch"
+    return request.registry.settings.get("collection_datastore", "elasticsearch") == "elasticsearch"
+
+
+def embed_note(request, note_id):
+    '''
+    Returns the note with the given @id, from a subrequest.
+    '''
+    # Using request.embed instead of CustomEmbed because we're fine with getting from ES (faster)
+    # for search-based spreadsheet requests.
+    note_subreq = make_subrequest(request, note_id)
+    # We don't get _stats on subreq of www-encoded-form POST requests; need to look into (could perhaps amend in snovault)
+    # Add this in to prevent error in snovault's `after_cursor_execute`
+    setattr(note_subreq, "_stats", request._stats)
+    note_response = request.invoke_subrequest(note_subreq)
+    return note_response.json
+
+
+def get_indexed_notes(request, note_ids):
+    '''
+    Returns the embedded views of the notes with the given @ids (ending with
+    their uuid) from Elasticsearch, in a single multi-get, as a dict of @id to
+    note.
+
+    As with snovault's embedded view from Elasticsearch, a note is only returned
+    if the user may view it and its document is still valid (see
+    `validate_es_content`), the sids of the items linked in all notes being looked
+    up together; items embedded in it that the user may not view are replaced with
+    an error (see `filter_embedded`). Other notes are left out, to be fetched with
+    a subrequest.
+    '''
+    note_ids_by_uuid = {note_id.rstrip("/").split("/")[-1]: note_id for note_id in note_ids}
+    if not note_ids_by_uuid:
+        return {}
+    storage = request.registry[STORAGE]
+    search = Search(using=storage.read.es, index=storage.read.index)
+    search = search.query(Q("ids", values=list(note_ids_by_uuid)))
+    search = search.source(INDEXED_NOTE_FIELDS)
+    search = search.extra(size=len(note_ids_by_uuid))
+    hits = [(hit.meta.id, hit.to_dict()) for hit in search.execute()]
+    linked_uuids = {
+        link["uuid"] for _, es_res in hits for link in es_res.get("linked_uuids_embedded", [])
+        if link["uuid"] not in request._sid_cache
+    }
+    if linked_uuids:
+        request._sid_cache.update(storage.write.get_sids_by_uuids(list(linked_uuids)))
+    notes = {}
+    for uuid, es_res in hits:
+        note_id = note_ids_by_uuid.get(uuid)
+        if note_id is None or "embedded" not in es_res:
+            continue
+        if set(es_res["principals_allowed"]["view"]).isdisjoint(request.effective_principals):
+            continue  # the subrequest raises the error
+        context = request.registry[TYPES][es_res["item_type"]].factory(request.registry, CachedModel(es_res))
+        if validate_es_content(context, request, es_res, "embedded"):
+            notes[note_id] = filter_embedded(es_res["embedded"], request.effective_principals)
+    return notes
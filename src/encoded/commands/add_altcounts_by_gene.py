@@ -14,13 +14,13 @@ import codecs
 from granite.lib import vcf_parser
 
 
-def get_most_severe(vnt_obj, VEPtag, ENSG_idx, most_severe_idx):
-    """ TODO docstring """
-    try:
-        val_get = vnt_obj.get_tag_value(VEPtag)
-    except Exception:
-        return False
-    trscrpt_list = val_get.split(',')
+VEP_TAG = 'CSQ'
+SAMPLEGENO_DEF = '##INFO=<ID=SAMPLEGENO,Number=.,Type=String,Description="Sample genotype information. Subembedded:\'samplegeno\':Format:\'NUMGT|GT|AD|SAMPLEID|AC\'">'
+
+
+def get_most_severe_gene(VEP_val, ENSG_idx, most_severe_idx):
+    """ Returns the gene of the most severe transcript in the given VEP tag value, False if none. """
+    trscrpt_list = VEP_val.split(',')
     # Check most severe field
     for trscrpt in trscrpt_list:
         most_severe = int(trscrpt.split('|')[most_severe_idx])
@@ -29,59 +29,123 @@ def get_most_severe(vnt_obj, VEPtag, ENSG_idx, most_severe_idx):
     return False
 
 
-def main(args):
-    # Variables
-    VEPtag = 'CSQ'
-    samplegeno_def = '##INFO=<ID=SAMPLEGENO,Number=.,Type=String,Description="Sample genotype information. Subembedded:\'samplegeno\':Format:\'NUMGT|GT|AD|SAMPLEID|AC\'">'
-    counts_dict = {}  # {ENSG: {sample: alt_count, ...}, ...}
+def get_most_severe(vnt_obj, VEPtag, ENSG_idx, most_severe_idx):
+    """ Returns the gene of the most severe transcript of the given variant, False if none. """
+    try:
+        val_get = vnt_obj.get_tag_value(VEPtag)
+    except Exception:
+        return False
+    return get_most_severe_gene(val_get, ENSG_idx, most_severe_idx)
+
+
+def add_alt_allele_counts(counts_dict, vnt_obj, ENSG):
+    """ Adds the alt alleles of each sample of the given variant to its counts for gene ENSG.
+
+    :param counts_dict: dict {ENSG: {sample: alt_count, ...}, ...}, updated in place
+    :param vnt_obj: granite Variant object
+    :param ENSG: most severe gene of the variant, nothing is counted if False
+    """
+    if ENSG:
+        counts_dict.setdefault(ENSG, {})
+        for ID_genotype in vnt_obj.IDs_genotypes:
+            counts_dict[ENSG].setdefault(ID_genotype, 0)
+            GT_0, GT_1 = vnt_obj.get_genotype_value(ID_genotype, 'GT').replace('|', '/').split('/')
+            if GT_0 not in ['0', '.']:
+                counts_dict[ENSG][ID_genotype] += 1
+            if GT_1 not in ['0', '.']:
+                counts_dict[ENSG][ID_genotype] += 1
+
+
+def count_alt_alleles_by_gene(vcf_obj, VEPtag, ENSG_idx, most_severe_idx):
+    """ Counts alt alleles on the most severe gene of each variant per sample.
+
+    :param vcf_obj: granite Vcf object, parsed from the start
+    :returns: dict {ENSG: {sample: alt_count, ...}, ...}
+    """
+    counts_dict = {}
+    for vnt_obj in vcf_obj.parse_variants():
+        ENSG = get_most_severe(vnt_obj, VEPtag, ENSG_idx, most_severe_idx)
+        add_alt_allele_counts(counts_dict, vnt_obj, ENSG)
+    return counts_dict
+
+
+def update_samplegeno_header(header):
+    """ Replaces the SAMPLEGENO definition of the given granite Header with the one with alt counts (AC). """
+    header.remove_tag_definition('SAMPLEGENO')
+    header.add_tag_definition(SAMPLEGENO_DEF, 'INFO')
+
+
+def get_samplegeno_alt_counts(samplegeno_val, counts_dict, ENSG):
+    """ Returns the given SAMPLEGENO tag value with its alt counts on gene ENSG added to each sample.
 
+    :param samplegeno_val: SAMPLEGENO tag value, NUMGT|GT|AD|SAMPLEID for each sample
+    :param counts_dict: dict {ENSG: {sample: alt_count, ...}, ...}
+    :param ENSG: most severe gene of the variant
+    """
+    samplegeno = []
+    samplegeno_ = samplegeno_val.split(',')
+    for sample_ in samplegeno_:
+        _, _, _, SAMPLEID = sample_.split('|')
+        sample = sample_ + '|' + str(counts_dict[ENSG][SAMPLEID])
+        samplegeno.append(sample)
+    return ','.join(samplegeno)
+
+
+def add_samplegeno_alt_counts(vnt_obj, counts_dict, ENSG):
+    """ Adds to each sample of the SAMPLEGENO tag of the given variant its alt counts on gene ENSG.
+
+    :param vnt_obj: granite Variant object, updated in place
+    :param counts_dict: dict {ENSG: {sample: alt_count, ...}, ...}
+    :param ENSG: most severe gene of the variant
+    """
+    samplegeno = get_samplegeno_alt_counts(vnt_obj.get_tag_value('SAMPLEGENO'), counts_dict, ENSG)
+
+    # Add samplegeno to variant INFO
+    vnt_obj.remove_tag_info('SAMPLEGENO')
+    vnt_obj.add_tag_info('SAMPLEGENO={0}'.format(samplegeno))
+
+
+def iter_altcounts_lines(inputfile):
+    """ Generator over the lines of the VCF with alt allele counts added to SAMPLEGENO.
+        Counting needs a full pass before any variant can be written, so the input is read twice,
+        but lines are yielded as they are built so they can be consumed directly (ie: by vcf.Reader)
+        without writing the result to disk and parsing it again.
+
+    :param inputfile: path to the (reformatted) input VCF, gzipped or not
+    :returns: generator of the output VCF lines, header first
+    """
     # Creating Vcf object
-    vcf_obj = vcf_parser.Vcf(args['inputfile'])
+    vcf_obj = vcf_parser.Vcf(inputfile)
 
     # Indexes
-    ENSG_idx = vcf_obj.header.get_tag_field_idx(VEPtag, 'Gene')
-    most_severe_idx = vcf_obj.header.get_tag_field_idx(VEPtag, 'most_severe')
+    ENSG_idx = vcf_obj.header.get_tag_field_idx(VEP_TAG, 'Gene')
+    most_severe_idx = vcf_obj.header.get_tag_field_idx(VEP_TAG, 'most_severe')
 
     # Counting alleles per most severe gene
+    counts_dict = count_alt_alleles_by_gene(vcf_obj, VEP_TAG, ENSG_idx, most_severe_idx)
+
+    # Update and yield header
+    update_samplegeno_header(vcf_obj.header)
+    for line in vcf_obj.header.definitions.splitlines(keepends=True):
+        yield line
+    yield vcf_obj.header.columns
+
+    # Reading variants and adding samplegeno
     for vnt_obj in vcf_obj.parse_variants():
-        ENSG = get_most_severe(vnt_obj, VEPtag, ENSG_idx, most_severe_idx)
-        if ENSG:
-            counts_dict.setdefault(ENSG, {})
-            for ID_genotype in vnt_obj.IDs_genotypes:
-                counts_dict[ENSG].setdefault(ID_genotype, 0)
-                GT_0, GT_1 = vnt_obj.get_genotype_value(ID_genotype, 'GT').replace('|', '/').split('/')
-                if GT_0 not in ['0', '.']:
-                    counts_dict[ENSG][ID_genotype] += 1
-                if GT_1 not in ['0', '.']:
-                    counts_dict[ENSG][ID_genotype] += 1
-        else:
-            continue
+        ENSG = get_most_severe(vnt_obj, VEP_TAG, ENSG_idx, most_severe_idx)
+        add_samplegeno_alt_counts(vnt_obj, counts_dict, ENSG)
+
+        # Yield variant
+        yield vnt_obj.to_string()
 
+
+def main(args):
     # Buffers
     fo = codecs.open(args['outputfile'], 'w', 'utf-8')
 
-    # Update and write header
-    vcf_obj.header.remove_tag_definition('SAMPLEGENO')
-    vcf_obj.header.add_tag_definition(samplegeno_def, 'INFO')
-    vcf_obj.write_header(fo)
-
-    # Reading variants and adding samplegeno
-    for vnt_obj in vcf_obj.parse_variants():
-        ENSG = get_most_severe(vnt_obj, VEPtag, ENSG_idx, most_severe_idx)
-        # Update samplegeno
-        samplegeno = []
-        samplegeno_ = vnt_obj.get_tag_value('SAMPLEGENO').split(',')
-        for sample_ in samplegeno_:
-            _, _, _, SAMPLEID = sample_.split('|')
-            sample = sample_ + '|' + str(counts_dict[ENSG][SAMPLEID])
-            samplegeno.append(sample)
-
-        # Add samplegeno to variant INFO
-        vnt_obj.remove_tag_info('SAMPLEGENO')
-        vnt_obj.add_tag_info('SAMPLEGENO={0}'.format(','.join(samplegeno)))
-
-        # Write variant
-        vcf_obj.write_variant(fo, vnt_obj)
+    # Write header and variants
+    for line in iter_altcounts_lines(args['inputfile']):
+        fo.write(line)
 
     fo.close()
 
@@ -2,7 +2,7 @@ import argparse
 import logging
 from pyramid.paster import get_app
 from dcicutils.misc_utils import VirtualApp
-from encoded.ingestion.table_utils import GeneTableParser
+from encoded.ingestion.table_utils import GeneTableParser, MappingTableDiff
 
 logger = logging.getLogger(__name__)
 EPILOG = __doc__
@@ -33,6 +33,11 @@ def main():
                         help='If specified will write schema to location')
     parser.add_argument('--post-inserts', action='store_true', default=False,
                         help='If specified will post inserts to portal')
+    parser.add_argument('--previous-table', default=None,
+                        help='Path to the previous gene table. If specified will report the schema changes from it '
+                             'and whether they need a reindex')
+    parser.add_argument('--diff-report', default=None,
+                        help='Where to write the JSON report of schema changes, if any')
     args = parser.parse_args()
 
     # read/process gene table, build inserts
@@ -40,6 +45,15 @@ def main():
     parser = GeneTableParser(args.gene_table, args.gene_annotation_field_schema)
     inserts = parser.run(gs_out=args.gene, write=args.write_schema)
 
+    # report schema changes from the previous gene table
+    if args.previous_table:
+        diff = MappingTableDiff.from_tables(GeneTableParser, args.previous_table, args.gene_table,
+                                            args.gene_annotation_field_schema)
+        report = diff.generate_report()
+        diff.log_report(report)
+        if args.diff_report:
+            diff.write_report(report, args.diff_report)
+
     # if not a dry run try to post inserts
     if args.post_inserts:
         environ = {
@@ -10,6 +10,7 @@ from encoded.ingestion.variant_utils import (
     CNVBuilder,
     VariantBuilder,
 )
+from encoded.ingestion.vcf_reader import LazyVCFReader
 from encoded.ingestion.vcf_utils import StructuralVariantVCFParser, VCFParser
 from encoded.util import resolve_file_path
 
@@ -28,6 +29,12 @@ def run_vcf_ingestion(
     post_genes=False,
     structural_variant=False,
     copy_number_variant=False,
+    batch_size=None,
+    skip_unchanged=False,
+    processes=None,
+    checkpoint_interval=None,
+    resume=False,
+    defer_indexing=False,
 ):
     """
     Runs VCF ingestion, posting items as indicated by args.
@@ -42,6 +49,18 @@ def run_vcf_ingestion(
     :param post_genes: bool to post genes
     :param structural_variant: bool if handling SV VCF
     :param copy_number_variant: bool if handling CNV VCF
+    :param batch_size: int number of records (or genes) to write per bulk
+        request, if not given items are written one at a time
+    :param skip_unchanged: bool to not rewrite existing items (or genes)
+        whose content is unchanged
+    :param processes: int number of worker processes parsing and building
+        records, if not given records are built in this process
+    :param checkpoint_interval: int number of records after which progress
+        is saved on the VCF file, if not given progress is not saved
+    :param resume: bool to resume from the progress saved on the VCF file
+    :param defer_indexing: bool to queue all variants/samples written,
+        with or without batch_size, for indexing at every checkpoint and
+        at the end, rather than as they are written
     """
     logging.basicConfig()
     logger.info("Ingesting VCF file: %s." % vcf_path)
@@ -50,6 +69,7 @@ def run_vcf_ingestion(
             vcf_path,
             resolve_file_path("schemas/structural_variant.json"),
             resolve_file_path("schemas/structural_variant_sample.json"),
+            reader_class=LazyVCFReader,
         )
         if copy_number_variant:
             builder = CNVBuilder(
@@ -58,6 +78,12 @@ def run_vcf_ingestion(
                 vcf_accession,
                 project=project,
                 institution=institution,
+                batch_size=batch_size,
+                skip_unchanged=skip_unchanged,
+                processes=processes,
+                checkpoint_interval=checkpoint_interval,
+                resume=resume,
+                defer_indexing=defer_indexing,
             )
         else:
             builder = StructuralVariantBuilder(
@@ -66,15 +92,32 @@ def run_vcf_ingestion(
                 vcf_accession,
                 project=project,
                 institution=institution,
+                batch_size=batch_size,
+                skip_unchanged=skip_unchanged,
+                processes=processes,
+                checkpoint_interval=checkpoint_interval,
+                resume=resume,
+                defer_indexing=defer_indexing,
             )
     else:
         vcf_parser = VCFParser(
             vcf_path,
             resolve_file_path("schemas/variant.json"),
             resolve_file_path("schemas/variant_sample.json"),
+            reader_class=LazyVCFReader,
         )
         builder = VariantBuilder(
-            app, vcf_parser, vcf_accession, project=project, institution=institution
+            app,
+            vcf_parser,
+            vcf_accession,
+            project=project,
+            institution=institution,
+            batch_size=batch_size,
+            skip_unchanged=skip_unchanged,
+            processes=processes,
+            checkpoint_interval=checkpoint_interval,
+            resume=resume,
+            defer_indexing=defer_indexing,
         )
     if post_consequence:
         builder.post_variant_consequence_items()
@@ -83,7 +126,12 @@ def run_vcf_ingestion(
             resolve_file_path("annotations/gene_inserts_v0.4.5.json")
         )
         gene_handler.upload(
-            app, project=project, institution=institution, use_tqdm=True
+            app,
+            project=project,
+            institution=institution,
+            use_tqdm=True,
+            batch_size=batch_size,
+            skip_unchanged=skip_unchanged,
         )
     if post_variants:
         builder.ingest_vcf(use_tqdm=True)
@@ -136,6 +184,61 @@ def main():
         default=False,
         help="Provide if ingestion of CNV VCF",
     )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=None,
+        help=(
+            "Number of VCF records (or genes) to write per bulk request. By"
+            " default, items are written one at a time."
+        ),
+    )
+    parser.add_argument(
+        "--skip-unchanged",
+        action="store_true",
+        default=False,
+        help=(
+            "Provide to not rewrite existing variants/samples (or genes)"
+            " whose content is unchanged (ie: on re-ingestion)"
+        ),
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=None,
+        help=(
+            "Number of worker processes parsing and building variants/samples."
+            " By default, records are built in the main process."
+        ),
+    )
+    parser.add_argument(
+        "--checkpoint-interval",
+        type=int,
+        default=None,
+        help=(
+            "Number of VCF records after which progress is saved on the VCF"
+            " file, so an interrupted ingestion can be resumed."
+        ),
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        default=False,
+        help=(
+            "Provide to resume ingestion from the progress saved on the VCF"
+            " file, if any"
+        ),
+    )
+    parser.add_argument(
+        "--defer-indexing",
+        action="store_true",
+        default=False,
+        help=(
+            "Provide to queue all variants/samples written, in batches or not,"
+            " for indexing at every checkpoint and at the end of the"
+            " ingestion, each once, rather than as they are written"
+        ),
+    )
     args = parser.parse_args()
 
     # XXX: Refactor to use IngestionConfig
@@ -156,6 +259,12 @@ def main():
         post_genes=args.post_genes,
         structural_variant=args.structural_variant,
         copy_number_variant=args.copy_number_variant,
+        batch_size=args.batch_size,
+        skip_unchanged=args.skip_unchanged,
+        processes=args.processes,
+        checkpoint_interval=args.checkpoint_interval,
+        resume=args.resume,
+        defer_indexing=args.defer_indexing,
     )
 
 
@@ -1,4 +1,5 @@
 import logging
+from collections import deque
 from multiprocessing import cpu_count  # pylint: disable=no-name-in-module
 from multiprocessing import Pool  # pylint: disable=no-name-in-module
 
@@ -19,15 +20,31 @@ class ParallelTask(object):
         self.no_parallel = no_parallel
         self.num_cpu = num_cpu or cpu_count() - 1
 
-    def run(self, items, chunk_size=1):
+    def run(self, items, chunk_size=1, max_pending=None):
         """Run task in parallel on a list of work items.
 
         Uses multiprocessing in order to avoid Python's GIL.
+
+        Args:
+          - items (iterable): Work items, results are yielded in the same order.
+          - chunk_size (int): Number of items sent to a worker at once.
+          - max_pending (int): If given, at most this many items are read ahead of
+              the results yielded, so a large (ie: streamed) iterable of items is
+              not consumed into memory all at once. chunk_size is then ignored.
         """
         if not self.no_parallel:
             with Pool(self.num_cpu) as pool:
-                for res in pool.imap(self.task_func, items, chunk_size):
-                    yield res
+                if max_pending is None:
+                    for res in pool.imap(self.task_func, items, chunk_size):
+                        yield res
+                    return
+                pending = deque()
+                for item in items:
+                    if len(pending) >= max_pending:
+                        yield pending.popleft().get()
+                    pending.append(pool.apply_async(self.task_func, (item,)))
+                while pending:
+                    yield pending.popleft().get()
         else:
             for res in map(self.task_func, items):
                 yield res
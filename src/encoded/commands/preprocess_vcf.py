@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+
+################################################
+#
+#   Reformat VCF and add alt allele counts on
+#       most severe gene per sample, fused
+#
+################################################
+"""
+Runs reformat_vcf and add_altcounts_by_gene as a single engine.
+
+Run one after the other, the scripts write the whole reformatted VCF, then parse it twice more: once to count
+alt alleles per gene and sample, then again to add the counts to SAMPLEGENO. Here the annotated VCF is read once:
+each variant is reformatted and its alt alleles counted in the same pass, spilling the reformatted variant (with
+its most severe gene, already split in fields) to a temporary file. The output is then built by a second pass over
+that file only. Output is byte for byte the same as that of reformat_vcf followed by add_altcounts_by_gene.
+
+As with reformat_vcf, regions of a bgzipped and tabix indexed VCF can be reformatted (and counted) in parallel.
+For the ingestion listener, the output can also be written as binary preprocessed records rather than VCF,
+see write_preprocessed_vcf_records.
+"""
+import argparse
+import io
+import marshal
+import mmap
+import shutil
+import sys
+import tempfile
+
+from granite.lib import vcf_parser
+
+from ..ingestion.vcf_reader import LazyVCFReader, iter_preprocessed_records, write_preprocessed_header, \
+    write_preprocessed_record
+from .add_altcounts_by_gene import add_alt_allele_counts, get_most_severe_gene, get_samplegeno_alt_counts, \
+    update_samplegeno_header
+from .reformat_vcf import RegionReformatter, VCFReformatter, is_tabix_indexed, iter_region_results
+
+
+def write_intermediate_variants(reformatted, reformatter, counts_dict, fo):
+    """ Writes the given reformatted variants to the intermediate binary buffer fo, counting their alt alleles
+        by gene. Intermediate records (see vcf_reader.write_preprocessed_record) are 11-tuples of the most severe
+        gene, the fields CHROM to FILTER, the INFO entries, FORMAT (None without samples) and the genotypes.
+
+    :param reformatted: 2-tuples (granite Variant object, updated VEP tag value)
+    :param reformatter: VCFReformatter of the variants
+    :param counts_dict: dict {ENSG: {sample: alt_count, ...}, ...}, updated in place
+    :param fo: intermediate binary buffer
+    """
+    ENSG_idx, most_severe_idx = reformatter.ENSG_idx, reformatter.most_severe_idx
+    IDs_genotypes = reformatter.vcf_obj.header.IDs_genotypes
+    for vnt_obj, VEP_update in reformatted:
+        ENSG = get_most_severe_gene(VEP_update, ENSG_idx, most_severe_idx)
+        add_alt_allele_counts(counts_dict, vnt_obj, ENSG)
+        write_preprocessed_record(fo, (
+            ENSG or '', vnt_obj.CHROM, vnt_obj.POS, vnt_obj.ID, vnt_obj.REF, vnt_obj.ALT, vnt_obj.QUAL,
+            vnt_obj.FILTER, vnt_obj.INFO.split(';'), vnt_obj.FORMAT if IDs_genotypes else None,
+            [vnt_obj.GENOTYPES[ID_genotype] for ID_genotype in IDs_genotypes]
+        ))
+
+
+def merge_alt_allele_counts(counts_dict, region_counts):
+    """ Adds the alt allele counts of a region to counts_dict, both dicts {ENSG: {sample: alt_count, ...}, ...}. """
+    for ENSG, sample_counts in region_counts.items():
+        gene_counts = counts_dict.setdefault(ENSG, {})
+        for ID_genotype, count in sample_counts.items():
+            gene_counts[ID_genotype] = gene_counts.get(ID_genotype, 0) + count
+
+
+def add_samplegeno_alt_counts_to_entries(info_entries, counts_dict, ENSG):
+    """ Adds alt counts on gene ENSG to the SAMPLEGENO tag of the given INFO entries, moving it last,
+        as add_altcounts_by_gene.add_samplegeno_alt_counts does on the INFO field of a granite Variant.
+
+    :param info_entries: list of the INFO entries of a variant, updated in place
+    :param counts_dict: dict {ENSG: {sample: alt_count, ...}, ...}
+    :param ENSG: most severe gene of the variant
+    """
+    samplegeno, entries = None, []
+    for entry in info_entries:
+        if entry.startswith('SAMPLEGENO='):
+            if samplegeno is None:
+                samplegeno = entry.split('SAMPLEGENO=')[1]
+        else:
+            entries.append(entry)
+    if samplegeno is None:
+        raise ValueError('\nERROR in variant INFO field, SAMPLEGENO tag is missing\n')
+    entry = 'SAMPLEGENO={0}'.format(get_samplegeno_alt_counts(samplegeno, counts_dict, ENSG))
+    if len(entries) > 1 and entries[-1] == '':  # INFO ending with ';', no separator is added
+        entries[-1] = entry
+    else:
+        entries = (entries or ['']) + [entry]
+    info_entries[:] = entries
+
+
+class RegionPreprocessor(RegionReformatter):
+    """ Task reformatting a region of a tabix indexed VCF in worker processes, writing intermediate records
+        and counting alt alleles by gene as iter_preprocessed_variants. """
+
+    def write_region(self, region, fo):
+        """ Writes the intermediate records of the given region to binary buffer fo.
+
+        :returns: dict {ENSG: {sample: alt_count, ...}, ...} of the region
+        """
+        _, reformatter = self.get_reformatter()
+        region_counts = {}
+        write_intermediate_variants(self.iter_region_variants(region), reformatter, region_counts, fo)
+        return region_counts
+
+    @staticmethod
+    def open_region_file(fd):
+        return io.open(fd, 'wb')
+
+
+def iter_preprocessed_variants(inputfile, verbose=False, processes=None):
+    """ Generator over the variants of the annotated VCF reformatted for ingestion, with alt allele counts
+        added to SAMPLEGENO. Every variant is read before anything is yielded, as counts need a full pass.
+
+    :param inputfile: path to the annotated input VCF, gzipped or not
+    :param verbose: whether to write the count of variants (or regions) read to stderr
+    :param processes: if more than 1 and the VCF is bgzipped and tabix indexed, its regions are reformatted
+                      in that many worker processes, giving the same output
+    :returns: generator of the granite Header of the output first, then for each variant the 10-tuple of
+              its fields CHROM to FILTER, its INFO entries, FORMAT (None without samples) and its genotypes
+    """
+    # Creating Vcf object and reformatter, updating the header
+    vcf_obj = vcf_parser.Vcf(inputfile)
+    reformatter = VCFReformatter(vcf_obj)
+
+    with tempfile.TemporaryFile(mode='w+b') as intermediate:
+        # Reformatting variants and counting alleles per most severe gene
+        counts_dict = {}
+        if processes and processes > 1 and is_tabix_indexed(inputfile):
+            for path, region_counts in iter_region_results(RegionPreprocessor, inputfile, vcf_obj.header, processes,
+                                                           is_verbose=verbose):
+                with io.open(path, 'rb') as region_fo:
+                    shutil.copyfileobj(region_fo, intermediate)
+                merge_alt_allele_counts(counts_dict, region_counts)
+        else:
+            write_intermediate_variants(reformatter.iter_reformatted_variants(is_verbose=verbose), reformatter,
+                                        counts_dict, intermediate)
+        if verbose:
+            sys.stderr.write('\n')
+
+        # Update and yield header
+        update_samplegeno_header(vcf_obj.header)
+        yield vcf_obj.header
+
+        # Reading reformatted variants and adding samplegeno
+        intermediate.flush()
+        if not intermediate.tell():  # no variants, nothing to map
+            return
+        with mmap.mmap(intermediate.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            for data in iter_preprocessed_records(buffer):
+                ENSG, *fields = marshal.loads(data)
+                # no gene is never a key of counts_dict, as with add_altcounts_by_gene
+                add_samplegeno_alt_counts_to_entries(fields[7], counts_dict, ENSG or False)
+                yield fields
+
+
+def iter_preprocessed_vcf_lines(inputfile, verbose=False, processes=None):
+    """ Generator over the lines of the annotated VCF reformatted for ingestion, with alt allele counts
+        added to SAMPLEGENO. Every variant is read before the header is yielded, as counts need a full pass,
+        so lines can be consumed directly (ie: by vcf.Reader) without writing the result to disk.
+
+    :param inputfile: path to the annotated input VCF, gzipped or not
+    :param verbose: whether to write the count of variants (or regions) read to stderr
+    :param processes: as for iter_preprocessed_variants
+    :returns: generator of the output VCF lines, header first
+    """
+    variants = iter_preprocessed_variants(inputfile, verbose=verbose, processes=processes)
+    header = next(variants)
+    for line in header.definitions.splitlines(keepends=True):
+        yield line
+    yield header.columns
+    for CHROM, POS, ID, REF, ALT, QUAL, FILTER, info_entries, FORMAT, genotypes in variants:
+        variant_as_list = [CHROM, str(POS), ID, REF, ALT, QUAL, FILTER, ';'.join(info_entries)]
+        if FORMAT is not None:  # if samples
+            variant_as_list.append(FORMAT)
+            variant_as_list.extend(genotypes)
+        yield '\t'.join(variant_as_list) + '\n'
+
+
+def write_preprocessed_vcf_records(inputfile, outputfile, verbose=False, processes=None):
+    """ Preprocesses the annotated VCF as iter_preprocessed_vcf_lines, but writes it to outputfile as a compact
+        binary preprocessed records file instead of VCF, read (memory-mapped) by vcf_reader.PreprocessedVCFReader
+        without parsing text. Records read are the same as those of iter_preprocessed_vcf_lines read by
+        vcf_reader.LazyVCFReader.
+
+    :param inputfile: path to the annotated input VCF, gzipped or not
+    :param outputfile: path to the preprocessed records file to write
+    :param verbose: whether to write the count of variants (or regions) read to stderr
+    :param processes: as for iter_preprocessed_variants
+    """
+    variants = iter_preprocessed_variants(inputfile, verbose=verbose, processes=processes)
+    header = next(variants)
+    with io.open(outputfile, 'wb') as fo:
+        write_preprocessed_header(fo, header.definitions.splitlines() + [header.columns.rstrip('\n')])
+        for CHROM, POS, ID, REF, ALT, QUAL, FILTER, info_entries, FORMAT, genotypes in variants:
+            raw_info = LazyVCFReader.split_info_entries(info_entries)
+            write_preprocessed_record(fo, (CHROM, POS, ID, REF, ALT, QUAL, FILTER, raw_info, FORMAT, genotypes))
+
+
+def runner(args):
+    """ Preprocesses the annotated VCF at args['inputfile'], writing it to args['outputfile'].
+
+    :param args: dict with keys inputfile, outputfile, verbose and (optional) processes
+    """
+    processes = args.get('processes')
+    if processes and processes > 1 and not is_tabix_indexed(args['inputfile']):
+        sys.stderr.write('Input VCF is not bgzipped and tabix indexed, reformatting in a single process\n')
+    with io.open(args['outputfile'], 'w', encoding='utf-8') as fo:
+        for line in iter_preprocessed_vcf_lines(args['inputfile'], verbose=args['verbose'], processes=processes):
+            fo.write(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Reformat VCF for portal ingestion and add alt allele counts on '
+                                                 'most severe gene per sample, in a single pass over the input')
+
+    parser.add_argument('-i', '--inputfile', help='input (annotated) VCF file', required=True)
+    parser.add_argument('-o', '--outputfile', help='output VCF file', required=True)
+    parser.add_argument('--verbose', help='verbose', action='store_true', required=False)
+    parser.add_argument('--processes', help='number of worker processes reformatting regions of the input VCF in '
+                                            'parallel, which must then be bgzipped and tabix indexed',
+                        type=int, default=1, required=False)
+
+    args = vars(parser.parse_args())
+
+    runner(args)
+
+
+if __name__ == '__main__':
+    main()
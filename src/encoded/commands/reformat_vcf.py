@@ -18,8 +18,14 @@
 ################################################
 import argparse
 import io
+import os
+import re
+import shutil
 import sys
+import tempfile
+from uuid import uuid4
 
+import pysam
 from dcicutils.misc_utils import ignored
 from granite.lib import vcf_parser
 # shared_functions as *
@@ -28,6 +34,8 @@ from granite.lib.shared_functions import get_tag_idx, variant_type_ext
 # shared_vars
 from granite.lib.shared_vars import DStags
 
+from .parallel import ParallelTask
+
 
 ################################################
 #
@@ -181,139 +189,139 @@ def clean_dbnsfp(vnt_obj, VEPtag, dbNSFP_fields, dbnsfp_ENST_idx, ENST_idx, sep=
     return ','.join(trscrpt_clean)
 
 
-def runner(args):
-    """
-    ...TODO: add doc...
+################################################
+#
+#   Reformatter
+#
+################################################
 
-    :param args: ...
+VEP_TAG = 'CSQ'
+VEP_ORDER = {
+                # HIGH
+                'transcript_ablation': 1,
+                'splice_acceptor_variant': 2,
+                'splice_donor_variant': 3,
+                'stop_gained': 4,
+                'frameshift_variant': 5,
+                'stop_lost': 6,
+                'start_lost': 7,
+                'transcript_amplification': 8,
+                # MODERATE
+                'inframe_insertion': 9,
+                'inframe_deletion': 10,
+                'missense_variant': 11,
+                'protein_altering_variant': 12,
+                # LOW
+                'splice_region_variant': 13,
+                'incomplete_terminal_codon_variant': 14,
+                'start_retained_variant': 15,
+                'stop_retained_variant': 16,
+                'synonymous_variant': 17,
+                # MODIFIER
+                'coding_sequence_variant': 18,
+                'mature_miRNA_variant': 19,
+                '5_prime_UTR_variant': 20,
+                '3_prime_UTR_variant': 21,
+                'intron_variant': 22,
+                'MODIFIER': 23
+            }
+# dbNSFP fields that may be a list
+# and need to be assigned to transcripts
+DBNSFP_FIELDS = ['Polyphen2_HVAR_pred', 'Polyphen2_HVAR_score', 'SIFT_pred', 'SIFT_score']
+
+# Definitions
+VEP_INIT = '##VEP=<ID={0}>'.format(VEP_TAG)
+GENES_INIT = '##CGAP=<ID=GENES>'
+SPLICEAI_DEF = '##INFO=<ID=spliceaiMaxds,Number=1,Type=Float,Description="SpliceAI max delta score">'
+GENES_DEF = '##INFO=<ID=GENES,Number=.,Type=String,Description=". Subembedded:\'genes\':Format:\'most_severe_gene|most_severe_transcript|most_severe_feature_ncbi|most_severe_hgvsc|most_severe_hgvsp|most_severe_amino_acids|most_severe_sift_score|most_severe_polyphen_score|most_severe_maxentscan_diff|most_severe_consequence\'">'
+VARIANT_DEF = '##INFO=<ID=variantClass,Number=1,Type=String,Description="Variant type">'
+VEP_DEF = '##INFO=<ID={0},Number=.,Type=String,Description="Consequence annotations from Ensembl VEP.  Subembedded:\'transcript\':Format:\'{1}\'">'
+
+
+class VCFReformatter:
+    """ Reformats the variants of a granite Vcf object for portal ingestion, one at a time.
+        Creating the reformatter updates the header of the Vcf object with the custom tags
+        and resolves the indexes of the VEP fields from it.
     """
-    # Variables
-    is_verbose = args['verbose']
-    VEPtag = 'CSQ'
-    VEP_order = {
-                    # HIGH
-                    'transcript_ablation': 1,
-                    'splice_acceptor_variant': 2,
-                    'splice_donor_variant': 3,
-                    'stop_gained': 4,
-                    'frameshift_variant': 5,
-                    'stop_lost': 6,
-                    'start_lost': 7,
-                    'transcript_amplification': 8,
-                    # MODERATE
-                    'inframe_insertion': 9,
-                    'inframe_deletion': 10,
-                    'missense_variant': 11,
-                    'protein_altering_variant': 12,
-                    # LOW
-                    'splice_region_variant': 13,
-                    'incomplete_terminal_codon_variant': 14,
-                    'start_retained_variant': 15,
-                    'stop_retained_variant': 16,
-                    'synonymous_variant': 17,
-                    # MODIFIER
-                    'coding_sequence_variant': 18,
-                    'mature_miRNA_variant': 19,
-                    '5_prime_UTR_variant': 20,
-                    '3_prime_UTR_variant': 21,
-                    'intron_variant': 22,
-                    'MODIFIER': 23
-                }
-    dbNSFP_fields = {
-                    # dbNSFP fields that may be a list
-                    # and need to be assigned to transcripts
-                    'Polyphen2_HVAR_pred': 0,
-                    'Polyphen2_HVAR_score': 0,
-                    'SIFT_pred': 0,
-                    'SIFT_score': 0
-                    }
-
-    # Definitions
-    vep_init = '##VEP=<ID={0}>'.format(VEPtag)
-    genes_init = '##CGAP=<ID=GENES>'
-    spliceai_def = '##INFO=<ID=spliceaiMaxds,Number=1,Type=Float,Description="SpliceAI max delta score">'
-    genes_def = '##INFO=<ID=GENES,Number=.,Type=String,Description=". Subembedded:\'genes\':Format:\'most_severe_gene|most_severe_transcript|most_severe_feature_ncbi|most_severe_hgvsc|most_severe_hgvsp|most_severe_amino_acids|most_severe_sift_score|most_severe_polyphen_score|most_severe_maxentscan_diff|most_severe_consequence\'">'
-    variant_def = '##INFO=<ID=variantClass,Number=1,Type=String,Description="Variant type">'
-
-    # Buffers
-    fo = io.open(args['outputfile'], 'w', encoding='utf-8')
-
-    # Creating Vcf object
-    vcf_obj = vcf_parser.Vcf(args['inputfile'])
-
-    # Modify VEP definition
-    vep_def = '##INFO=<ID={0},Number=.,Type=String,Description="Consequence annotations from Ensembl VEP.  Subembedded:\'transcript\':Format:\'{1}\'">'
-    for line in vcf_obj.header.definitions.split('\n')[:-1]:
-        if line.startswith('##INFO=<ID=' + VEPtag + ','):  # '##<tag_type>=<ID=<tag>,...'
-            format = line.split('Format:')[1]
-            # Cleaning format
-            format = format.replace(' ', '')
-            format = format.replace('\'', '')
-            format = format.replace('\"', '')
-            format = format.replace('>', '')
-            # Update definition
-            vep_field_list = format.split('|')
-            vep_field_list.append('most_severe')
-            vep_def = vep_def.format(VEPtag, '|'.join(vep_field_list))
-            break
-
-    # Remove older VEP definition
-    vcf_obj.header.remove_tag_definition(VEPtag)
-
-    # Update and write custom definitions
-    vcf_obj.header.add_tag_definition(vep_init + '\n' + genes_init, 'INFO')
-    vcf_obj.header.add_tag_definition(spliceai_def, 'INFO')
-    vcf_obj.header.add_tag_definition(genes_def, 'INFO')
-    vcf_obj.header.add_tag_definition(variant_def, 'INFO')
-    vcf_obj.header.add_tag_definition(vep_def, 'INFO')
-
-    # Write header
-    vcf_obj.write_header(fo)
-
-    # Get SpliceAI ds indexes
-    # DStags import from granite.shared_vars
-    SpAItag_list, SpAI_idx_list = [], []
-    for DStag in DStags:
-        tag, idx = vcf_obj.header.check_tag_definition(DStag)
-        SpAItag_list.append(tag)
-        SpAI_idx_list.append(idx)
-
-    # Get VEP indexes
-    # Indexes to resolve dbNSFP values by transcript
-    dbnsfp_ENST_idx = vcf_obj.header.get_tag_field_idx(VEPtag, 'Ensembl_transcriptid')
-    for field in dbNSFP_fields:
-        dbNSFP_fields[field] = vcf_obj.header.get_tag_field_idx(VEPtag, field)
-
-    # Indexes for worst transcript (GENES)
-    CNONICL_idx = vcf_obj.header.get_tag_field_idx(VEPtag, 'CANONICAL')
-    ENSG_idx = vcf_obj.header.get_tag_field_idx(VEPtag, 'Gene')
-    ENST_idx = vcf_obj.header.get_tag_field_idx(VEPtag, 'Feature')
-    MANE_idx = vcf_obj.header.get_tag_field_idx(VEPtag, 'MANE')  # feature_ncbi
-    HGVSC_idx = vcf_obj.header.get_tag_field_idx(VEPtag, 'HGVSc')
-    HGVSP_idx = vcf_obj.header.get_tag_field_idx(VEPtag, 'HGVSp')
-    AACIDS_idx = vcf_obj.header.get_tag_field_idx(VEPtag, 'Amino_acids')
-    SIFT_idx = dbNSFP_fields['SIFT_score']
-    PPHEN_idx = dbNSFP_fields['Polyphen2_HVAR_score']
-    MAXENTDIFF_idx = vcf_obj.header.get_tag_field_idx(VEPtag, 'MaxEntScan_diff')
-    CONSEQUENCE_idx = vcf_obj.header.get_tag_field_idx(VEPtag, 'Consequence')
-
-    # Reading variants and adding new tags
-    for i, vnt_obj in enumerate(vcf_obj.parse_variants()):
-        if is_verbose:
-            sys.stderr.write('\r' + str(i+1))
-            sys.stderr.flush()
 
+    def __init__(self, vcf_obj):
+        """
+        :param vcf_obj: granite Vcf object of the annotated VCF, its header is updated
+        """
+        self.vcf_obj = vcf_obj
+        header = vcf_obj.header
+
+        # Modify VEP definition
+        vep_def = VEP_DEF
+        for line in header.definitions.split('\n')[:-1]:
+            if line.startswith('##INFO=<ID=' + VEP_TAG + ','):  # '##<tag_type>=<ID=<tag>,...'
+                format = line.split('Format:')[1]
+                # Cleaning format
+                format = format.replace(' ', '')
+                format = format.replace('\'', '')
+                format = format.replace('\"', '')
+                format = format.replace('>', '')
+                # Update definition
+                vep_field_list = format.split('|')
+                vep_field_list.append('most_severe')
+                vep_def = vep_def.format(VEP_TAG, '|'.join(vep_field_list))
+                break
+
+        # Remove older VEP definition
+        header.remove_tag_definition(VEP_TAG)
+
+        # Update custom definitions
+        header.add_tag_definition(VEP_INIT + '\n' + GENES_INIT, 'INFO')
+        header.add_tag_definition(SPLICEAI_DEF, 'INFO')
+        header.add_tag_definition(GENES_DEF, 'INFO')
+        header.add_tag_definition(VARIANT_DEF, 'INFO')
+        header.add_tag_definition(vep_def, 'INFO')
+
+        # Get SpliceAI ds indexes
+        # DStags import from granite.shared_vars
+        self.SpAItag_list, self.SpAI_idx_list = [], []
+        for DStag in DStags:
+            tag, idx = header.check_tag_definition(DStag)
+            self.SpAItag_list.append(tag)
+            self.SpAI_idx_list.append(idx)
+
+        # Get VEP indexes
+        # Indexes to resolve dbNSFP values by transcript
+        self.dbnsfp_ENST_idx = header.get_tag_field_idx(VEP_TAG, 'Ensembl_transcriptid')
+        self.dbNSFP_fields = {field: header.get_tag_field_idx(VEP_TAG, field) for field in DBNSFP_FIELDS}
+
+        # Indexes for worst transcript (GENES)
+        self.CNONICL_idx = header.get_tag_field_idx(VEP_TAG, 'CANONICAL')
+        self.ENSG_idx = header.get_tag_field_idx(VEP_TAG, 'Gene')
+        self.ENST_idx = header.get_tag_field_idx(VEP_TAG, 'Feature')
+        self.MANE_idx = header.get_tag_field_idx(VEP_TAG, 'MANE')  # feature_ncbi
+        self.HGVSC_idx = header.get_tag_field_idx(VEP_TAG, 'HGVSc')
+        self.HGVSP_idx = header.get_tag_field_idx(VEP_TAG, 'HGVSp')
+        self.AACIDS_idx = header.get_tag_field_idx(VEP_TAG, 'Amino_acids')
+        self.SIFT_idx = self.dbNSFP_fields['SIFT_score']
+        self.PPHEN_idx = self.dbNSFP_fields['Polyphen2_HVAR_score']
+        self.MAXENTDIFF_idx = header.get_tag_field_idx(VEP_TAG, 'MaxEntScan_diff')
+        self.CONSEQUENCE_idx = header.get_tag_field_idx(VEP_TAG, 'Consequence')
+        # Index of the field most_severe added to transcripts
+        self.most_severe_idx = header.get_tag_field_idx(VEP_TAG, 'most_severe')
+
+    def reformat_variant(self, vnt_obj):
+        """ Adds the custom tags to the given variant, updating its VEP tag.
+
+        :param vnt_obj: granite Variant object, updated in place
+        :returns: updated VEP tag value, None if the variant has no VEP tag and must be skipped
+        """
         # Clean dbNSFP by resolving values by transcript
-        VEP_clean = clean_dbnsfp(vnt_obj, VEPtag, dbNSFP_fields, dbnsfp_ENST_idx, ENST_idx)
+        VEP_clean = clean_dbnsfp(vnt_obj, VEP_TAG, self.dbNSFP_fields, self.dbnsfp_ENST_idx, self.ENST_idx)
 
         if not VEP_clean:
-            continue
+            return None
 
         # Get max SpliceAI max_ds
-        maxds = get_maxds(vnt_obj, SpAItag_list, SpAI_idx_list)
+        maxds = get_maxds(vnt_obj, self.SpAItag_list, self.SpAI_idx_list)
 
         # Get most severe transcript
-        worst_trscrpt = get_worst_trscrpt(VEP_clean, VEP_order, CNONICL_idx, CONSEQUENCE_idx)
+        worst_trscrpt = get_worst_trscrpt(VEP_clean, VEP_ORDER, self.CNONICL_idx, self.CONSEQUENCE_idx)
 
         # Get variant class
         # import from granite.shared_functions
@@ -330,43 +338,241 @@ def runner(args):
         # Adding field most_severe (0|1) to transcripts
         VEP_update = update_worst(VEP_clean, worst_trscrpt)
         # Replace VEP
-        vnt_obj.remove_tag_info(VEPtag)
-        vnt_obj.add_tag_info('{0}={1}'.format(VEPtag, VEP_update))
+        vnt_obj.remove_tag_info(VEP_TAG)
+        vnt_obj.add_tag_info('{0}={1}'.format(VEP_TAG, VEP_update))
 
         # Add GENES to variant INFO
         worst_trscrpt_ = worst_trscrpt.split('|')
-        worst_consequence_ = get_worst_consequence(worst_trscrpt_[CONSEQUENCE_idx], VEP_order)
+        worst_consequence_ = get_worst_consequence(worst_trscrpt_[self.CONSEQUENCE_idx], VEP_ORDER)
         genes_as_list = [
-            worst_trscrpt_[ENSG_idx],
-            worst_trscrpt_[ENST_idx],
-            worst_trscrpt_[MANE_idx],
-            worst_trscrpt_[HGVSC_idx],
-            worst_trscrpt_[HGVSP_idx],
-            worst_trscrpt_[AACIDS_idx],
-            worst_trscrpt_[SIFT_idx],
-            worst_trscrpt_[PPHEN_idx],
-            worst_trscrpt_[MAXENTDIFF_idx],
+            worst_trscrpt_[self.ENSG_idx],
+            worst_trscrpt_[self.ENST_idx],
+            worst_trscrpt_[self.MANE_idx],
+            worst_trscrpt_[self.HGVSC_idx],
+            worst_trscrpt_[self.HGVSP_idx],
+            worst_trscrpt_[self.AACIDS_idx],
+            worst_trscrpt_[self.SIFT_idx],
+            worst_trscrpt_[self.PPHEN_idx],
+            worst_trscrpt_[self.MAXENTDIFF_idx],
             worst_consequence_]
         # genes = '{0}|{1}|{2}|{3}|{4}|{5}|{6}|{7}|{8}|{9}'.format(*genes_as_list)
         genes = "|".join(map(str, genes_as_list))
         vnt_obj.add_tag_info('GENES={0}'.format(genes))
 
-        # Write variant
-        vcf_obj.write_variant(fo, vnt_obj)
+        return VEP_update
+
+    def iter_reformatted_variants(self, is_verbose=False, vnt_objs=None):
+        """ Generator over the reformatted variants of the Vcf object, skipping those without VEP tag.
+
+        :param is_verbose: whether to write the count of variants read to stderr
+        :param vnt_objs: granite Variant objects to reformat, all the variants of the Vcf object by default
+        :returns: generator of 2-tuples (granite Variant object, updated VEP tag value)
+        """
+        if vnt_objs is None:
+            vnt_objs = self.vcf_obj.parse_variants()
+        for i, vnt_obj in enumerate(vnt_objs):
+            if is_verbose:
+                sys.stderr.write('\r' + str(i+1))
+                sys.stderr.flush()
+            VEP_update = self.reformat_variant(vnt_obj)
+            if VEP_update is not None:
+                yield vnt_obj, VEP_update
+
+
+################################################
+#
+#   Parallel reformatting by region
+#
+################################################
+
+REGION_SIZE = 10000000  # contigs of known length are split in regions of this many bp reformatted in parallel
+CONTIG_ID = re.compile(r'[<,]ID=([^,>]+)')
+CONTIG_LENGTH = re.compile(r'[<,]length=(\d+)')
+_REGION_REFORMATTERS = {}  # task key -> (TabixFile, VCFReformatter) in the worker processes, see RegionReformatter
+
+
+def is_tabix_indexed(inputfile):
+    """ Returns whether the VCF at path inputfile has a tabix index, ie: is bgzipped and sorted. """
+    return os.path.exists(inputfile + '.tbi') or os.path.exists(inputfile + '.csi')
+
+
+def get_contig_lengths(header):
+    """ Returns dict {contig: length} of the contigs with a length in the ##contig definitions of header. """
+    lengths = {}
+    for line in header.definitions.split('\n'):
+        if line.startswith('##contig=<'):
+            ID, length = CONTIG_ID.search(line), CONTIG_LENGTH.search(line)
+            if ID and length:
+                lengths[ID.group(1)] = int(length.group(1))
+    return lengths
+
+
+def get_regions(inputfile, header, region_size=None):
+    """ Returns the regions of the tabix indexed VCF at path inputfile, in the order of its variants.
+        Contigs with a length in the header are split in regions of region_size bp.
+
+    :param inputfile: path to the bgzipped and tabix indexed VCF
+    :param header: granite Header object of the VCF
+    :param region_size: size of the regions in bp, REGION_SIZE by default
+    :returns: list of 3-tuples (contig, start, end), 0-based, end excluded or None for the end of the contig
+    """
+    region_size = region_size or REGION_SIZE
+    lengths = get_contig_lengths(header)
+    with pysam.TabixFile(inputfile) as tabix_file:
+        contigs = list(tabix_file.contigs)  # in order of first variant
+    regions = []
+    for contig in contigs:
+        start = 0
+        while start + region_size < lengths.get(contig, 0):
+            regions.append((contig, start, start + region_size))
+            start += region_size
+        regions.append((contig, start, None))
+    return regions
+
+
+class RegionReformatter:
+    """ Task reformatting the variants starting in a region of a tabix indexed VCF in worker processes.
+        Only the path of the VCF is pickled and sent to the workers; each worker process opens the VCF and
+        creates the reformatter once, reusing them for all regions. Variants of each region are written to
+        a temporary file in tmpdir, see iter_region_results.
+    """
+
+    def __init__(self, inputfile, tmpdir):
+        self.key = uuid4().hex  # identifies this task's reformatter in the worker processes
+        self.inputfile = inputfile
+        self.tmpdir = tmpdir
+
+    def get_reformatter(self):
+        """ Returns the 2-tuple (TabixFile, VCFReformatter) for this task in the current process,
+            creating them if needed. """
+        reformatter = _REGION_REFORMATTERS.get(self.key)
+        if reformatter is None:
+            _REGION_REFORMATTERS.clear()  # reformatters of previous tasks are no longer needed
+            reformatter = (pysam.TabixFile(self.inputfile, encoding='utf-8'),
+                           VCFReformatter(vcf_parser.Vcf(self.inputfile)))
+            _REGION_REFORMATTERS[self.key] = reformatter
+        return reformatter
+
+    def iter_region_variants(self, region):
+        """ Generator over the reformatted variants starting in the given region, skipping those without VEP tag.
+
+        :param region: 3-tuple (contig, start, end) as returned by get_regions
+        :returns: generator of 2-tuples (granite Variant object, updated VEP tag value)
+        """
+        tabix_file, reformatter = self.get_reformatter()
+        contig, start, end = region
+        IDs_genotypes = reformatter.vcf_obj.header.IDs_genotypes
+        vnt_objs = (vcf_parser.Vcf.Variant(line.rstrip(), IDs_genotypes)
+                    for line in tabix_file.fetch(contig, start, end))
+        # variants overlapping the start of the region are in the previous one
+        return reformatter.iter_reformatted_variants(vnt_objs=(vnt_obj for vnt_obj in vnt_objs
+                                                               if vnt_obj.POS > start))
+
+    def write_region(self, region, fo):
+        """ Writes the reformatted variants of the given region to buffer fo. """
+        for vnt_obj, _ in self.iter_region_variants(region):
+            fo.write(vnt_obj.to_string())
+
+    def __call__(self, region):
+        """ Reformats the given region.
+
+        :param region: 3-tuple (contig, start, end) as returned by get_regions
+        :returns: 2-tuple of the path to the temporary file of the region and the value returned by write_region
+        """
+        fd, path = tempfile.mkstemp(dir=self.tmpdir)
+        with self.open_region_file(fd) as fo:
+            result = self.write_region(region, fo)
+        return path, result
+
+    @staticmethod
+    def open_region_file(fd):
+        """ Opens the temporary file of a region, given its file descriptor, for write_region. """
+        return io.open(fd, 'w', encoding='utf-8')
+
+
+def iter_region_results(task_class, inputfile, header, processes, is_verbose=False):
+    """ Runs a task_class task (ie: RegionReformatter) on every region of the tabix indexed VCF in
+        processes worker processes, yielding results in the order of the regions, ie: of the variants.
+
+    :param task_class: RegionReformatter or a subclass
+    :param inputfile: path to the bgzipped and tabix indexed VCF
+    :param header: granite Header object of the VCF
+    :param processes: number of worker processes
+    :param is_verbose: whether to write the count of regions reformatted to stderr
+    :returns: generator of the results of the task, the temporary file of a region is deleted once the next
+              result is requested
+    """
+    regions = get_regions(inputfile, header)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        task = task_class(inputfile, tmpdir)
+        for i, (path, result) in enumerate(ParallelTask(task, num_cpu=processes).run(regions)):
+            if is_verbose:
+                sys.stderr.write('\r' + 'region {0}/{1}'.format(i+1, len(regions)))
+                sys.stderr.flush()
+            yield path, result
+            os.remove(path)
+
+
+################################################
+#
+#   Runner
+#
+################################################
+
+
+def runner(args):
+    """ Reformats the annotated VCF at args['inputfile'], writing it to args['outputfile'].
+        If args['processes'] is more than 1 and the VCF is bgzipped and tabix indexed, its regions
+        are reformatted in that many worker processes, giving the same output.
+
+    :param args: dict with keys inputfile, outputfile, verbose and (optional) processes
+    """
+    is_verbose = args['verbose']
+    processes = args.get('processes') or 1
+
+    # Buffers
+    fo = io.open(args['outputfile'], 'w', encoding='utf-8')
+
+    # Creating Vcf object and reformatter, updating the header
+    vcf_obj = vcf_parser.Vcf(args['inputfile'])
+    reformatter = VCFReformatter(vcf_obj)
+
+    # Write header
+    vcf_obj.write_header(fo)
+
+    if processes > 1 and is_tabix_indexed(args['inputfile']):
+        # Reformatting regions in parallel, concatenating them in order
+        for path, _ in iter_region_results(RegionReformatter, args['inputfile'], vcf_obj.header, processes,
+                                           is_verbose=is_verbose):
+            with io.open(path, 'r', encoding='utf-8') as region_fo:
+                shutil.copyfileobj(region_fo, fo)
+    else:
+        if processes > 1:
+            sys.stderr.write('Input VCF is not bgzipped and tabix indexed, reformatting in a single process\n')
+        # Reading variants and adding new tags
+        for vnt_obj, _ in reformatter.iter_reformatted_variants(is_verbose=is_verbose):
+            # Write variant
+            vcf_obj.write_variant(fo, vnt_obj)
 
     # Close buffers
     sys.stderr.write('\n')
     fo.close()
 
 
-if __name__ == '__main__':
-
+def main():
     parser = argparse.ArgumentParser(description='Reformat VCF and add custom tags and fields in VCF file for portal ingestion')
 
     parser.add_argument('-i', '--inputfile', help='input VCF file', required=True)
     parser.add_argument('-o', '--outputfile', help='output VCF file', required=True)
     parser.add_argument('--verbose', help='verbose', action='store_true', required=False)
+    parser.add_argument('--processes', help='number of worker processes reformatting regions of the input VCF in '
+                                            'parallel, which must then be bgzipped and tabix indexed',
+                        type=int, default=1, required=False)
 
     args = vars(parser.parse_args())
 
     runner(args)
+
+
+if __name__ == '__main__':
+    main()
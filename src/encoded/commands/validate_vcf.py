@@ -1,47 +1,323 @@
-import os
-import vcf
+"""
+Validates a VCF before it is ingested, reporting all its errors rather than the first one.
+
+The header is checked against the mapping table the variant/variant_sample schemas are generated from: annotation
+fields of the mapping table not listed by the header of their INFO field are reported as warnings, INFO/FORMAT fields
+mapped as is whose header type cannot be cast to the type of their schema field as errors. Records are then read in
+blocks of raw lines, parsed (and optionally built into variants/variant samples) in parallel worker processes, every
+error being reported with its line number. Errors reported are capped, all are counted.
+
+The report is a dict, written as JSON with --report.
+"""
 import argparse
+import gzip
+import io
+import json
+import os
+import sys
+import zlib
+from itertools import islice
+from uuid import uuid4
+
+from ..ingestion.vcf_reader import LazyVCFReader
+from ..ingestion.vcf_utils import VCFParser, StructuralVariantVCFParser
+from ..util import resolve_file_path
+from .parallel import ParallelTask
 
 
 EPILOG = __doc__
 
+VARIANT_SCHEMA = resolve_file_path('schemas/variant.json')
+VARIANT_SAMPLE_SCHEMA = resolve_file_path('schemas/variant_sample.json')
+STRUCTURAL_VARIANT_SCHEMA = resolve_file_path('schemas/structural_variant.json')
+STRUCTURAL_VARIANT_SAMPLE_SCHEMA = resolve_file_path('schemas/structural_variant_sample.json')
+
+VALIDATION_BLOCK_SIZE = 5000  # number of record lines validated at a time by a worker process
+MAX_REPORTED_ERRORS = 100  # errors after this many are counted, but not reported
+VCF_FIXED_COLUMNS = 8  # CHROM to INFO
+
+# VCF header types the values of a schema field of the given type can be cast from
+SCHEMA_TYPE_HEADER_TYPES = {
+    'integer': ['Integer', 'String'],
+    'number': ['Integer', 'Float', 'String'],
+    'boolean': ['Flag', 'Integer', 'String'],
+}
+
+_VALIDATION_PARSERS = {}  # parsers created in this (worker) process, see RecordBlockValidator
+
+
+class VCFValidationError(Exception):
+    """ To be thrown if a VCF record is malformed in a way the parser does not catch itself """
+    pass
+
+
+def iter_mapped_fields(schema_props):
+    """ Generator over the fields of the given schema properties mapped from the VCF (ie: by the mapping table),
+        including those of sub-embedded objects.
+
+    :returns: generator of 2-tuples (vcf_field, type), type being that of array items for arrays
+    """
+    for props in schema_props.values():
+        if props.get('type') == 'array' and props.get('items', {}).get('type') == 'object':
+            yield from iter_mapped_fields(props['items'].get('properties', {}))
+            continue
+        if 'vcf_field' in props:
+            field_type = props.get('type')
+            if field_type == 'array':
+                field_type = props.get('items', {}).get('type')
+            yield props['vcf_field'], field_type
+
+
+def open_vcf(path):
+    """ Opens the VCF at path as text, decompressing it if gzipped (ie: named .gz, as for vcf.Reader). """
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='utf-8')
+    return io.open(path, 'r', encoding='utf-8')
+
+
+class RecordBlockValidator:
+    """ Task validating blocks of raw VCF record lines in worker processes. As with
+        variant_utils.ParallelRecordBuilder, only what is needed to re-create the parser is pickled and
+        each worker process creates the parser once and reuses it for all blocks.
+    """
+
+    def __init__(self, parser, build_items=False):
+        self.key = uuid4().hex  # identifies this task's parser in the worker processes
+        self.parser_class = type(parser)
+        self.reader_class = type(parser.reader)
+        self.header_lines = parser.get_header_lines()
+        self.schemas = (parser.variant_schema_path, parser.variant_sample_schema_path)
+        self.build_items = build_items
+        samples = parser.reader.samples
+        self.columns = VCF_FIXED_COLUMNS + (1 + len(samples) if samples else 0)
+
+    def get_parser(self):
+        """ Returns the parser for this task in the current process, creating it if needed. """
+        parser = _VALIDATION_PARSERS.get(self.key)
+        if parser is None:
+            _VALIDATION_PARSERS.clear()  # parsers of previous validations are no longer needed
+            parser = self.parser_class.from_header_lines(self.header_lines, *self.schemas,
+                                                         reader_class=self.reader_class)
+            _VALIDATION_PARSERS[self.key] = parser
+        return parser
+
+    def validate_record(self, parser, line):
+        """ Validates the given raw record line, reading all its values as ingestion would.
+
+        :raises: VCFValidationError or any error of the parser if the record is malformed
+        """
+        columns = line.rstrip('\r\n').count('\t') + 1
+        if columns != self.columns:
+            raise VCFValidationError('Expected %s columns, found %s' % (self.columns, columns))
+        record = parser.parse_raw_record(line)
+        for key in record.INFO:  # cast all values, as the lazy reader otherwise only does for those read
+            record.INFO.get(key)
+        for call in record.samples:
+            call.data  # noQA - parses the call data
+        if self.build_items:
+            parser.create_variant_from_record(record)
+            parser.create_sample_variant_from_record(record)
+
+    def __call__(self, block):
+        """ Validates the given block of raw record lines.
+
+        :param block: list of 2-tuples (line number, raw record line)
+        :returns: list of the errors of the block, as dicts {'line': line number, 'error': message}
+        """
+        parser = self.get_parser()
+        errors = []
+        for line_number, line in block:
+            try:
+                self.validate_record(parser, line)
+            except Exception as e:
+                errors.append({'line': line_number, 'error': str(e) or type(e).__name__})
+        return errors
+
 
 class VCFValidator(object):
-    """ Wrapper class for 'vcf' that just validates the VCF can be read with no errors
-        due to VCF structure
+    """ Validates a VCF can be ingested: its header against the mapping table (as the variant and variant sample
+        schemas) and all its records, see get_report.
     """
 
-    def __init__(self, _vcf):
-        self.reader = vcf.Reader(open(_vcf, 'r'))
+    def __init__(self, _vcf, variant=VARIANT_SCHEMA, sample=VARIANT_SAMPLE_SCHEMA, parser_class=VCFParser,
+                 processes=None, max_errors=MAX_REPORTED_ERRORS, build_items=False,
+                 block_size=VALIDATION_BLOCK_SIZE):
+        """
+        :param _vcf: path to the VCF to validate, gzipped if named .gz
+        :param variant: path to variant schema
+        :param sample: path to variant_sample schema
+        :param parser_class: class of the parser ingesting the VCF, ie: vcf_utils.StructuralVariantVCFParser
+        :param processes: if more than 1, blocks of records are validated in that many worker processes
+        :param max_errors: number of errors reported, others are only counted
+        :param build_items: whether to also build the variants/variant samples of records, catching errors
+                            of values of annotation fields (ie: for a VCF already reformatted for ingestion)
+        :param block_size: number of record lines validated at a time
+        """
+        self.vcf = _vcf
+        self.schemas = (variant, sample)
+        self.parser_class = parser_class
+        self.processes = processes
+        self.max_errors = max_errors
+        self.build_items = build_items
+        self.block_size = block_size
 
-    def validate(self):
-        """ Validates the VCF ie: tries reading and parsing all VCF fields.
-            Note: this will NOT validate INFO subfields. """
-        idx = 0
+    def check_header(self, parser, header_line_numbers):
+        """ Checks the header of the VCF against the fields of the mapping table.
+
+        :param parser: parser created from the header of the VCF
+        :param header_line_numbers: dict of (INFO or FORMAT, ID) -> line number of its header line
+        :returns: 2-tuple of lists of the errors and warnings, as dicts {'line': line number, 'error': message}
+        """
+        errors, warnings = [], []
+        reader = parser.reader
+        mapped = {}
+        for schema_props in [parser.variant_props, parser.variant_sample_props]:
+            for vcf_field, field_type in iter_mapped_fields(schema_props):
+                mapped.setdefault(vcf_field, field_type)
+
+        # annotation fields of the mapping table should all be listed by their INFO field
+        for key in parser.annotation_keys:
+            line_number = header_line_numbers.get(('INFO', key), 0)
+            fields = parser.format.get(key)
+            if not isinstance(fields, list):
+                warnings.append({'line': line_number, 'error': 'Annotation field %s has no INFO header' % key})
+                continue
+            prefix = key.lower() + '_'
+            missing = sorted(field for field in mapped if field.startswith(prefix) and field not in fields)
+            if missing:
+                warnings.append({'line': line_number, 'error': 'Fields of the mapping table missing from the %s INFO '
+                                                               'header: %s' % (key, ', '.join(missing))})
+
+        # fields mapped as is should be castable to their schema type
+        for section, definitions in [('INFO', reader.infos), ('FORMAT', reader.formats)]:
+            for field_id, definition in definitions.items():
+                if field_id in parser.annotation_keys or field_id not in mapped:
+                    continue
+                header_types = SCHEMA_TYPE_HEADER_TYPES.get(mapped[field_id])
+                if header_types and definition.type not in header_types:
+                    errors.append({
+                        'line': header_line_numbers.get((section, field_id), 0),
+                        'error': '%s field %s has type %s, which is not castable to %s as in the mapping table'
+                                 % (section, field_id, definition.type, mapped[field_id])
+                    })
+        return errors, warnings
+
+    def iter_record_blocks(self, lines, start):
+        """ Generator over blocks of self.block_size record lines, as lists of 2-tuples (line number, line),
+            skipping blank lines. """
+        numbered = ((line_number, line) for line_number, line in enumerate(lines, start) if line.strip())
+        while True:
+            block = list(islice(numbered, self.block_size))
+            if not block:
+                return
+            yield block
+
+    def validate_records(self, task, lines, start, report):
+        """ Validates all the record lines, in parallel if self.processes, updating report. """
+        def counted(blocks):
+            for block in blocks:
+                report['records'] += len(block)
+                yield block
+
+        blocks = counted(self.iter_record_blocks(lines, start))
+        if self.processes and self.processes > 1:
+            results = ParallelTask(task, num_cpu=self.processes).run(blocks, max_pending=2 * self.processes)
+        else:
+            results = map(task, blocks)
+        for errors in results:
+            self.add_errors(report, errors)
+
+    def add_errors(self, report, errors):
+        """ Adds the given errors to the report, up to self.max_errors. """
+        report['error_count'] += len(errors)
+        report['errors'].extend(errors[:max(self.max_errors - len(report['errors']), 0)])
+
+    def get_report(self):
+        """ Validates the VCF, reading it once.
+
+        :returns: dict with keys:
+            - vcf: path to the VCF
+            - valid: whether no errors were found
+            - records: number of records read
+            - error_count: number of errors found
+            - errors: the first max_errors errors, as dicts {'line': line number, 'error': message}, line 0 for
+                      errors of the whole header or file (ie: a VCF that cannot be read or decompressed)
+            - truncated: whether errors were left out of errors
+            - warnings: header inconsistencies that do not prevent ingestion, as errors
+        """
+        report = {'vcf': self.vcf, 'valid': False, 'records': 0, 'error_count': 0, 'errors': [], 'warnings': []}
         try:
-            for idx, record in enumerate(self.reader):
-                print("Record %s validated" % idx)
-            return True
-        except Exception:  # catch all and re-raise, alerting the user to which record
-            print("Record %s failed vcf spec validation" % (idx + 1))
-            raise
+            with open_vcf(self.vcf) as f:
+                header_lines, header_line_numbers = [], {}
+                for line in f:
+                    header_lines.append(line.rstrip('\r\n'))
+                    if line.startswith('##INFO=<ID=') or line.startswith('##FORMAT=<ID='):
+                        section, _, rest = line[2:].partition('=<ID=')
+                        header_line_numbers.setdefault((section, rest.split(',')[0]), len(header_lines))
+                    if line.startswith('#CHROM'):
+                        break
+                try:
+                    if not header_lines or not header_lines[-1].startswith('#CHROM'):
+                        raise VCFValidationError('No #CHROM header line')
+                    parser = self.parser_class.from_header_lines(header_lines, *self.schemas,
+                                                                 reader_class=LazyVCFReader)
+                except Exception as e:
+                    self.add_errors(report, [{'line': 0, 'error': 'Could not parse VCF header: %s' % e}])
+                else:
+                    errors, report['warnings'] = self.check_header(parser, header_line_numbers)
+                    self.add_errors(report, errors)
+                    task = RecordBlockValidator(parser, build_items=self.build_items)
+                    self.validate_records(task, f, len(header_lines) + 1, report)
+        except (OSError, EOFError, UnicodeDecodeError, zlib.error) as e:  # ie: truncated or not gzipped
+            self.add_errors(report, [{'line': 0, 'error': 'Could not read VCF: %s' % e}])
+        report['valid'] = report['error_count'] == 0
+        report['truncated'] = report['error_count'] > len(report['errors'])
+        return report
+
+    def validate(self):
+        """ Validates the VCF ie: reads and parses all VCF fields of its records, and checks its header.
+            Note: this will NOT validate INFO subfields unless built with build_items.
+
+        :returns: True if the VCF is valid, False otherwise
+        """
+        return self.get_report()['valid']
 
 
 def main():
     parser = argparse.ArgumentParser(  # noqa - PyCharm wrongly thinks the formatter_class is invalid
-        description="Ingests a given VCF file",
+        description="Validates a given VCF file for ingestion",
         epilog=EPILOG,
         formatter_class=argparse.RawDescriptionHelpFormatter
     )
     parser.add_argument('vcf', help='path to vcf file')
+    parser.add_argument('--report', help='path to write the JSON report to, stdout if not given', default=None)
+    parser.add_argument('--structural-variant', help='validate a SV/CNV VCF', action='store_true', default=False)
+    parser.add_argument('--build-items', help='also build variants/variant samples from records, validating the '
+                                              'values of annotation fields (for a VCF reformatted for ingestion)',
+                        action='store_true', default=False)
+    parser.add_argument('--processes', help='number of worker processes validating blocks of records',
+                        type=int, default=1)
+    parser.add_argument('--max-errors', help='number of errors reported', type=int, default=MAX_REPORTED_ERRORS)
     args = parser.parse_args()
 
     # do the validation
     if not os.path.exists(args.vcf):
         print('Bad vcf path - got: %s' % args.vcf)
         exit(1)
-    validator = VCFValidator(args.vcf)
-    exit(validator.validate())
+    options = {}
+    if args.structural_variant:
+        options = dict(variant=STRUCTURAL_VARIANT_SCHEMA, sample=STRUCTURAL_VARIANT_SAMPLE_SCHEMA,
+                       parser_class=StructuralVariantVCFParser)
+    validator = VCFValidator(args.vcf, processes=args.processes, max_errors=args.max_errors,
+                             build_items=args.build_items, **options)
+    report = validator.get_report()
+    if args.report:
+        with io.open(args.report, 'w') as f:
+            json.dump(report, f, indent=4)
+    else:
+        json.dump(report, sys.stdout, indent=4)
+        print()
+    exit(0 if report['valid'] else 1)
 
 
 if __name__ == '__main__':
@@ -5,7 +5,7 @@ from dcicutils.misc_utils import VirtualApp
 from pyramid.paster import get_app
 
 from encoded.ingestion.table_utils import (
-    StructuralVariantTableParser, VariantTableParser
+    MappingTableDiff, StructuralVariantTableParser, VariantTableParser
 )
 
 logger = logging.getLogger(__name__)
@@ -24,6 +24,8 @@ def run_table_intake(
     post_inserts=False,
     structural_variant=False,
     app_name=None,
+    previous_mapping_table=None,
+    diff_report=None,
 ):
     """
     Intake the given mapping table, writing new schemas and posting
@@ -40,6 +42,10 @@ def run_table_intake(
     :param post_inserts: bool to post annotation inserts
     :param structural_variant: bool if structural variant mapping table
     :param app_name: str app name
+    :param previous_mapping_table: str path to the previous mapping table, if
+        given the schema changes from it are reported (see MappingTableDiff)
+    :param diff_report: str path where to write the JSON report of the schema
+        changes from the previous mapping table
     """
     logging.basicConfig()
 
@@ -60,6 +66,16 @@ def run_table_intake(
             write=write_schemas,
         )
 
+    # report schema changes from the previous mapping table
+    if previous_mapping_table:
+        diff = MappingTableDiff.from_tables(
+            type(parser), previous_mapping_table, mapping_table, annotation_schema
+        )
+        report = diff.generate_report()
+        diff.log_report(report)
+        if diff_report:
+            diff.write_report(report, diff_report)
+
     # if not a dry run try to post inserts
     if post_inserts:  # do imports here as they will fail in certain scenarios
         environ = {
@@ -89,6 +105,8 @@ def main():
         --write-schemas: default True, will write schemas to given output files
         --post-inserts: default False, will post inserts using testapp if specified
         --structural-variant: default False, will use SV table parser
+        --previous-table: previous mapping table, to report schema changes from
+        --diff-report: where to write the JSON report of schema changes
 
         config_uri: path to app config (usually production.ini)
         --app-name: app name, usually 'app'
@@ -137,6 +155,19 @@ def main():
         default=False,
         help="If specified, will use SV parser",
     )
+    parser.add_argument(
+        "--previous-table",
+        default=None,
+        help=(
+            "Path to the previous mapping table. If specified, will report the"
+            " schema changes from it and whether they need a reindex"
+        ),
+    )
+    parser.add_argument(
+        "--diff-report",
+        default=None,
+        help="Where to write the JSON report of schema changes, if any",
+    )
     args = parser.parse_args()
 
     run_table_intake(
@@ -151,6 +182,8 @@ def main():
         post_inserts=args.post_inserts,
         structural_variant=args.structural_variant,
         app_name=args.app_name,
+        previous_mapping_table=args.previous_table,
+        diff_report=args.diff_report,
     )
 
 
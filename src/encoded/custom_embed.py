@@ -1,12 +1,22 @@
+import json
 import re
+import threading
+from collections import Counter, OrderedDict
+from urllib.parse import urlencode
 from uuid import UUID
 
 from dcicutils.misc_utils import ignored
-from pyramid.httpexceptions import HTTPBadRequest, HTTPForbidden
+from pyramid.httpexceptions import HTTPBadRequest, HTTPForbidden, HTTPRequestEntityTooLarge
+from pyramid.response import Response
 from pyramid.security import Authenticated
 from pyramid.traversal import find_resource
 from pyramid.view import view_config
-from snovault.util import debug_log
+from snovault import CALCULATED_PROPERTIES, COLLECTIONS, CONNECTION, DBSESSION, STORAGE, TYPES, Item
+from snovault.calculated import ItemNamespace
+from snovault.embed import make_subrequest
+from snovault.storage import Key, Resource
+from snovault.util import debug_log, merge_calculated_into_properties, simple_path_ids
+from sqlalchemy import orm
 
 ATID_PATTERN = re.compile("/[a-zA-Z-]+/[a-zA-Z0-9-_:]+/")
 GENELIST_ATID = re.compile("/gene-lists/[a-zA-Z0-9-]+/")
@@ -25,14 +35,187 @@ KEYS_TO_IGNORE = [
     "actions",
 ]
 FORBIDDEN_MSG = {"error": "no view permissions"}
+# Fields always included in object views projected to the requested fields, see get_projection
+PROJECTION_FIELDS = {"@id", "@type", "uuid"}
 DATABASE_ITEM_KEY = "@type"  # Key specific to JSON objects that are CGAP items
+EMBED_OBJECT_CACHE = "embed_object_cache"  # registry key of the EmbedObjectCache
+# Application setting giving the maximum size (of their JSON, in bytes) of the object views kept by the
+# EmbedObjectCache; 0 disables the cache.
+EMBED_OBJECT_CACHE_BYTES_SETTING = "embed.object_cache_bytes"
+EMBED_OBJECT_CACHE_BYTES = 64 * 1024 * 1024
+# Application setting giving the maximum number of object views fetched by a bulk embed request, across all its
+# items; items not embedded within it are returned with BUDGET_EXCEEDED_MSG.
+EMBED_BULK_WORK_BUDGET_SETTING = "embed.bulk_work_budget"
+EMBED_BULK_WORK_BUDGET = 50000
+# Size (in bytes) of the EmbedObjectCache shared by the items of a bulk embed request if the process-level one
+# is disabled.
+EMBED_BULK_CACHE_BYTES = 16 * 1024 * 1024
+BUDGET_EXCEEDED_MSG = "work budget of the request exceeded"
 
 
 def includeme(config):
     config.add_route("embed", "/embed")
+    config.add_route("embed_bulk", "/embed-bulk")
+    config.add_route("embed_cache", "/embed-cache")
+    capacity = config.registry.settings.get(EMBED_OBJECT_CACHE_BYTES_SETTING, EMBED_OBJECT_CACHE_BYTES)
+    config.registry[EMBED_OBJECT_CACHE] = EmbedObjectCache(int(capacity))
     config.scan(__name__)
 
 
+class EmbedObjectCache:
+    """
+    Process-level LRU cache of the object views of items embedded by
+    CustomEmbed, shared across requests and bounded by the size of the
+    cached views (as JSON).
+
+    Views are cached by uuid and by the effective principals of the user
+    they were rendered for, and only given back for the same principals:
+    calculated properties may depend on what the user can view (ie: Variant
+    most_severe_location, on the variant consequences viewed), and whether
+    the user can view the item at all is then that of the cached view.
+    Since views may depend on other items (ie: through calculated
+    properties), the cache holds the views of a given database max sid: any
+    write empties it.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity  # in bytes
+        self.max_sid = None  # database max sid of the cached views
+        self.entries = OrderedDict()  # (uuid, principals) -> (JSON view, aliases), least recent first
+        self.aliases = {}  # (@id (or /uuid) an item was fetched with, principals) -> (uuid, principals)
+        self.size = 0
+        self.counters = Counter()
+        self.lock = threading.Lock()
+
+    def _check_max_sid(self, max_sid):
+        """
+        Empty the cache if the given max sid is not that of the cached
+        views, ie: the database was written since they were rendered. Must
+        be called with the lock held.
+
+        :param max_sid: int current database max sid
+        """
+        if max_sid != self.max_sid:
+            if self.entries:
+                self.counters["invalidations"] += 1
+            self.entries.clear()
+            self.aliases.clear()
+            self.size = 0
+            self.max_sid = max_sid
+
+    def get(self, item_id, principals, max_sid):
+        """
+        Get the cached object view of the given item, as rendered for the
+        given principals.
+
+        :param item_id: string @id (or uuid) starting with "/"
+        :param principals: effective principals of the user
+        :param max_sid: int current database max sid
+        :return: copy of the object view, or None if not cached
+        """
+        with self.lock:
+            self._check_max_sid(max_sid)
+            key = self.aliases.get((item_id, frozenset(principals)))
+            entry = self.entries.get(key)
+            if entry is None:
+                self.counters["misses"] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.counters["hits"] += 1
+        view, _ = entry
+        return json.loads(view)
+
+    def put(self, item_id, item, principals, max_sid):
+        """
+        Cache the object view of the given item, evicting the least
+        recently used views beyond capacity.
+
+        :param item_id: string @id (or uuid) starting with "/" the item was fetched with
+        :param item: dict item in object view
+        :param principals: effective principals of the user the view was rendered for
+        :param max_sid: int database max sid the view was rendered at
+        """
+        uuid = item.get("uuid")
+        if not uuid:
+            return
+        view = json.dumps(item)
+        if len(view) > self.capacity:
+            return
+        principals = frozenset(principals)
+        key = (uuid, principals)
+        with self.lock:
+            self._check_max_sid(max_sid)
+            previous = self.entries.pop(key, None)
+            aliases = {(alias, principals) for alias in [item_id, "/" + uuid, item.get("@id", item_id)]}
+            if previous is not None:
+                self.size -= len(previous[0])
+                aliases.update(previous[1])
+            for alias in aliases:
+                self.aliases[alias] = key
+            self.entries[key] = (view, aliases)
+            self.size += len(view)
+            self.counters["stores"] += 1
+            while self.size > self.capacity:
+                evicted, (evicted_view, evicted_aliases) = self.entries.popitem(last=False)
+                self.size -= len(evicted_view)
+                for alias in evicted_aliases:
+                    if self.aliases.get(alias) == evicted:
+                        del self.aliases[alias]
+                self.counters["evictions"] += 1
+
+    def get_stats(self):
+        """
+        Get the counters (hits, misses, stores, evictions, invalidations)
+        and size of the cache.
+
+        :return: dict of cache statistics
+        """
+        with self.lock:
+            stats = {
+                "entries": len(self.entries),
+                "bytes": self.size,
+                "capacity_bytes": self.capacity,
+                "max_sid": self.max_sid,
+            }
+            for counter in ["hits", "misses", "stores", "evictions", "invalidations"]:
+                stats[counter] = self.counters[counter]
+        return stats
+
+
+class EmbedBudgetExceeded(Exception):
+    """
+    Raised when a bulk embed request fetches more object views than its
+    work budget allows.
+    """
+    pass
+
+
+class EmbedWorkBudget:
+    """
+    Number of object views (cached or not) a bulk embed request may fetch
+    across all its items, in place of a cap on the number of items.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.exceeded = False
+
+    def spend(self, count):
+        """
+        Count the given number of object views as fetched.
+
+        :param count: int number of object views to fetch
+        :raises EmbedBudgetExceeded: if they exceed the budget
+        """
+        if self.used + count > self.limit:
+            self.exceeded = True
+            raise EmbedBudgetExceeded(
+                "Fetching %s more items exceeds the work budget of %s" % (count, self.limit)
+            )
+        self.used += count
+
+
 class CustomEmbed:
     """
     Class to handle custom embedding for /embed API.
@@ -46,13 +229,25 @@ class CustomEmbed:
         self.requested_fields = embed_props.get("requested_fields", [])
 
         self.cache = {}
+        self.fetched = {}
+        self.resources = {}  # uuid -> prefetched database resource, see prefetch_resources
+        self.projections = {}  # @id -> fields the object was fetched with (None if whole), see fetch_objects
+        self.object_cache = embed_props.get("object_cache", request.registry.get(EMBED_OBJECT_CACHE))
+        self.work_budget = embed_props.get("work_budget")
+        if self.object_cache is not None and not self.object_cache.capacity:
+            self.object_cache = None
+        self.max_sid = None
         self.invalid_ids = []
         if self.requested_fields:
             self.nested_fields = self.fields_to_nested_dict()
+            item_id = item if item.startswith("/") else "/" + item
+            self.fetch_objects([item_id], {item_id: self.get_projection(self.nested_fields)})
             item = self.user_embed(item, initial_item=True)
+            self.fetch_field_embeds(item, self.nested_fields)
             self.result = self.field_embed(item, self.nested_fields, initial_item=True)
         else:
             depth = -1
+            self.fetch_embeds(item)
             self.result = self.embed(item, depth)
 
     def add_actions(self, item):
@@ -103,7 +298,7 @@ class CustomEmbed:
         if not item_id.startswith("/"):
             item_id = "/" + item_id
         try:
-            item = self.request.embed(item_id, "@@object", as_user=True)
+            item = self.get_object(item_id)
         except HTTPForbidden:
             if not initial_item:
                 item = FORBIDDEN_MSG
@@ -113,6 +308,219 @@ class CustomEmbed:
             item = self.add_actions(item)
         return item
 
+    def get_object(self, item_id):
+        """
+        Get the object view of the given item, as fetched by fetch_objects,
+        fetching it if it was not. A fetched object is only returned once,
+        as it is modified when embedded.
+
+        :param item_id: string @id (or uuid) starting with "/"
+        :return: dict item in object view
+        :raises: HTTPForbidden or KeyError as the subrequest would
+        """
+        if item_id not in self.fetched:
+            self.fetch_objects([item_id])
+        fetched = self.fetched.pop(item_id)
+        if isinstance(fetched, Exception):
+            raise fetched
+        return fetched
+
+    def fetch_objects(self, item_ids, projections=None):
+        """
+        Fetch the object views of the given items together, their database
+        resources (and those of the items they link to) being loaded in a
+        few queries for all of them rather than one at a time.
+
+        Items with a projection are fetched with the object-fields view,
+        with only the given fields rather than the whole object.
+
+        Objects in the EmbedObjectCache for the user's principals are taken
+        from it, while (whole) objects fetched are added to it. All count against the work budget,
+        if any.
+
+        Permissions are checked per item, as with user_embed: the object
+        kept for an item the user cannot view (or that does not exist) is
+        the error raised when embedding it.
+
+        :param item_ids: list of string @ids (or uuids) starting with "/"
+        :param projections: dict of @id -> set of fields to fetch (see
+            get_projection), for items not fetched whole
+        :return objects: dict of @id -> object fetched, for items viewed
+        """
+        projections = projections or {}
+        item_ids = [item_id for item_id in dict.fromkeys(item_ids) if item_id not in self.fetched]
+        if self.work_budget is not None:
+            self.work_budget.spend(len(item_ids))
+        objects = {}
+        if self.object_cache is not None:
+            max_sid = self.get_max_sid()
+            to_fetch = []
+            for item_id in item_ids:
+                item = self.object_cache.get(item_id, self.request.effective_principals, max_sid)
+                if item is None:
+                    to_fetch.append(item_id)
+                    continue
+                self.fetched[item_id] = objects[item_id] = item
+                self.projections[item_id] = None
+            item_ids = to_fetch
+        self.prefetch_resources(item_ids)
+        for item_id in item_ids:
+            fields = projections.get(item_id)
+            if fields is None:
+                view = "@@object"
+            else:
+                view = "@@object-fields?" + urlencode([("field", field) for field in sorted(fields)])
+            try:
+                item = self.request.embed(item_id, view, as_user=True)
+            except (HTTPForbidden, KeyError) as e:
+                self.fetched[item_id] = e
+                continue
+            if fields is None:
+                self.cache_object(item_id, item)
+            self.fetched[item_id] = objects[item_id] = item
+            self.projections[item_id] = fields
+        return objects
+
+    @staticmethod
+    def get_projection(field_dict):
+        """
+        Get the fields of an item needed to embed the given requested
+        fields in it, ie: the fields to keep, the fields to embed further
+        and PROJECTION_FIELDS.
+
+        :param field_dict: nested dict of requested fields of the item
+        :return: set of fields, or None if all fields ("*") are requested
+        """
+        fields_to_keep = field_dict.get("fields_to_keep", [])
+        if "*" in fields_to_keep:
+            return None
+        return set(fields_to_keep).union(field_dict).union(PROJECTION_FIELDS) - {"fields_to_keep"}
+
+    @staticmethod
+    def merge_projections(projection, other_projection):
+        """
+        Get the fields needed for both of the given projections.
+
+        :param projection: set of fields, or None for all fields
+        :param other_projection: set of fields, or None for all fields
+        :return: set of fields, or None for all fields
+        """
+        if projection is None or other_projection is None:
+            return None
+        return projection | other_projection
+
+    def get_max_sid(self):
+        """
+        Get the database max sid, which the objects cached in the
+        EmbedObjectCache are valid for, once per instance.
+
+        :return: int database max sid
+        """
+        if self.max_sid is None:
+            self.max_sid = self.request.registry[STORAGE].write.get_max_sid()
+        return self.max_sid
+
+    def cache_object(self, item_id, item):
+        """
+        Add the object view of the given item to the EmbedObjectCache for
+        the effective principals of the user, unless whether its calculated
+        properties are included depends on the request.
+
+        :param item_id: string @id (or uuid) starting with "/"
+        :param item: dict item in object view
+        """
+        if self.object_cache is None or "@id" not in item:
+            return
+        context = find_resource(self.request.root, item["@id"])
+        calculated_properties = self.request.registry[CALCULATED_PROPERTIES].props_for(context)
+        if any(prop.condition is not None for prop in calculated_properties.values()):
+            return
+        self.object_cache.put(item_id, item, self.request.effective_principals, self.get_max_sid())
+
+    def prefetch_resources(self, item_ids):
+        """
+        Load the database resources of the given items in a single query
+        (plus one per unique key, for items identified by name), followed
+        by a single query for the resources of the items they link to,
+        which are needed to render their links as @ids, and a single query
+        for the unique keys of the resources loaded, so their @ids are
+        resolved without querying the database either.
+
+        Loaded resources are kept in the database session (which only holds
+        weak references to them, so they are referenced by self.resources),
+        so looking them up while rendering the items does not query the
+        database again. Nothing is loaded if items are read from Elasticsearch.
+
+        :param item_ids: list of string @ids (or uuids) starting with "/"
+        """
+        if self.request.datastore != "database":
+            return
+        registry = self.request.registry
+        collections = registry[COLLECTIONS]
+        session = registry[DBSESSION]()
+        unique_key_cache = registry[CONNECTION].unique_key_cache
+        uuids, names = set(), {}
+        for item_id in item_ids:
+            path = item_id.strip("/").split("/")
+            if self.is_uuid(path[-1], version=None):
+                uuids.add(path[-1])
+            elif len(path) == 2:
+                unique_key = getattr(collections.get(path[0]), "unique_key", None)
+                if not unique_key:
+                    continue
+                uuid = unique_key_cache.get((unique_key, path[1]))
+                if uuid is not None:
+                    uuids.add(str(uuid))
+                else:
+                    names.setdefault(unique_key, set()).add(path[1])
+        loaded = self.load_resources(session, uuids)
+        for unique_key, values in names.items():
+            keys = session.query(Key).options(
+                orm.joinedload(Key.resource, innerjoin=True)
+            ).filter(Key.name == unique_key, Key.value.in_(values))
+            for key in keys:
+                uuids.add(str(key.rid))
+                if str(key.rid) not in self.resources:
+                    self.resources[str(key.rid)] = key.resource
+                    loaded.append(key.resource)
+        types = registry[TYPES].by_item_type
+        linked_uuids = set()
+        for uuid in uuids:
+            resource = self.resources.get(uuid)
+            type_info = types.get(resource.item_type) if resource is not None else None
+            if type_info is None:
+                continue
+            properties = resource.get("", {})
+            for path in type_info.schema_links:
+                linked_uuids.update(
+                    linked for linked in simple_path_ids(properties, path) if isinstance(linked, str)
+                )
+        loaded += self.load_resources(session, linked_uuids)
+        if not loaded:
+            return
+        keys = session.query(Key).filter(Key.rid.in_([resource.rid for resource in loaded]))
+        for key in keys:
+            unique_key_cache[(key.name, key.value)] = key.rid
+
+    def load_resources(self, session, uuids):
+        """
+        Load the database resources with the given uuids in a single query,
+        keeping them in self.resources.
+
+        :param session: database session
+        :param uuids: iterable of string uuids
+        :return: list of the resources found, not loaded already
+        """
+        uuids = [
+            UUID(uuid) for uuid in set(uuids) if uuid not in self.resources and self.is_uuid(uuid, version=None)
+        ]
+        if not uuids:
+            return []
+        resources = session.query(Resource).filter(Resource.rid.in_(uuids)).all()
+        for resource in resources:
+            self.resources[str(resource.rid)] = resource
+        return resources
+
     def minimal_embed(self, item_id):
         """
         Embed minimal item info. Helpful for preventing recursions for
@@ -138,7 +546,7 @@ class CustomEmbed:
         Determine if given string is a valid uuid.
 
         :param uuid_to_test: string to check
-        :param version: int for uuid version
+        :param version: int for uuid version, or None for any version
         :return: bool if given string is valid uuid
         """
         try:
@@ -147,6 +555,67 @@ class CustomEmbed:
             return False
         return str(uuid_obj) == uuid_to_test
 
+    def fetch_embeds(self, item_id):
+        """
+        Fetch the objects to embed for the given item breadth-first, with
+        one batch (see fetch_objects) per depth rather than one subrequest
+        per @id, following the same rules as embed. Objects are embedded
+        from those fetched by embed.
+
+        :param item_id: string uuid or @id of the initial item
+        """
+        if not isinstance(item_id, str) or not (ATID_PATTERN.match(item_id) or self.is_uuid(item_id)):
+            return
+        if not item_id.startswith("/"):
+            item_id = "/" + item_id
+        seen = {item_id}
+        objects = list(self.fetch_objects([item_id]).values())
+        for _ in range(self.embed_depth):
+            item_ids, expanded_ids = [], []
+            for item in objects:
+                for linked_id in self.iter_embed_ids(item):
+                    if linked_id in seen or not self.is_embedded(linked_id):
+                        continue
+                    seen.add(linked_id)
+                    item_ids.append(linked_id)
+                    # minimal embeds are not embedded any further
+                    if self.desired_embeds or not MINIMAL_EMBED_ATID.match(linked_id):
+                        expanded_ids.append(linked_id)
+            if not item_ids:
+                break
+            fetched = self.fetch_objects(item_ids)
+            objects = [fetched[linked_id] for linked_id in expanded_ids if linked_id in fetched]
+
+    def iter_embed_ids(self, item):
+        """
+        Generator over the @ids within the given object that embed expands,
+        ie: not under KEYS_TO_IGNORE.
+
+        :param item: object to search for @ids
+        """
+        if isinstance(item, dict):
+            for key, value in item.items():
+                if key not in KEYS_TO_IGNORE:
+                    yield from self.iter_embed_ids(value)
+        elif isinstance(item, list):
+            for value in item:
+                yield from self.iter_embed_ids(value)
+        elif isinstance(item, str) and ATID_PATTERN.match(item):
+            yield item
+
+    def is_embedded(self, item_id):
+        """
+        Determine if embed embeds the item with the given @id, according
+        to desired/ignored embeds. Gene lists are not embedded by default.
+
+        :param item_id: string @id
+        :return: bool if the item is embedded
+        """
+        item_type = item_id.split("/")[1]
+        if self.desired_embeds:
+            return item_type in self.desired_embeds
+        return item_type not in self.ignored_embeds and not GENELIST_ATID.match(item_id)
+
     def embed(self, item, depth):
         """
         Embed items recursively according to input parameters. Unpack
@@ -271,6 +740,51 @@ class CustomEmbed:
             field_dict[key] = self.build_nested_dict(field_dict[key], field_keys)
         return field_dict
 
+    def fetch_field_embeds(self, item, field_dict):
+        """
+        Fetch the objects to embed for the requested fields breadth-first,
+        with one batch (see fetch_objects) per depth rather than one
+        subrequest per @id, following the same paths as field_embed.
+        Objects are embedded from those fetched by field_embed.
+
+        Objects are only fetched with the fields needed to embed the
+        requested fields, or all fields needed where an item is reached by
+        several paths: an object fetched at a previous depth is fetched
+        again if a deeper path needs fields it was not fetched with.
+
+        :param item: initial item in object view
+        :param field_dict: nested dict of requested fields
+        """
+        found = {}
+        to_walk = [(item, field_dict)]
+        while to_walk:
+            pending, walked = [], set()
+            while to_walk:
+                value, fields = to_walk.pop()
+                if isinstance(value, dict):
+                    for key in fields:
+                        if key != "fields_to_keep" and key in value:
+                            to_walk.append((value[key], fields[key]))
+                elif isinstance(value, list):
+                    to_walk.extend((member, fields) for member in value)
+                elif isinstance(value, str) and ATID_PATTERN.match(value):
+                    if (value, id(fields)) not in walked:
+                        walked.add((value, id(fields)))
+                        pending.append((value, fields))
+            projections = {}
+            for item_id, fields in pending:
+                projections[item_id] = self.merge_projections(
+                    projections.get(item_id, set()), self.get_projection(fields)
+                )
+            for item_id, projection in projections.items():
+                if item_id in self.projections:
+                    fetched_projection = self.projections[item_id]
+                    projections[item_id] = self.merge_projections(fetched_projection, projection)
+                    if projections[item_id] != fetched_projection:
+                        self.fetched.pop(item_id, None)
+            found.update(self.fetch_objects([item_id for item_id, _ in pending], projections))
+            to_walk = [(found[item_id], fields) for item_id, fields in pending if item_id in found]
+
     def field_embed(self, item, field_dict, initial_item=False):
         """
         Embed items recursively according to requested fields. Follows
@@ -334,6 +848,48 @@ class CustomEmbed:
         return item
 
 
+@view_config(route_name="embed_cache", request_method="GET", permission="index")
+@debug_log
+def embed_cache(context, request):
+    """
+    API to return the hit/miss counters and size of the process-level
+    cache of object views embedded by the embed API.
+
+    :param context: pyramid request context
+    :param request: pyramid request object
+    :return: dict of cache statistics, see EmbedObjectCache.get_stats
+    """
+    ignored(context)
+    return request.registry[EMBED_OBJECT_CACHE].get_stats()
+
+
+@view_config(context=Item, permission="view", request_method="GET", name="object-fields")
+@debug_log
+def item_view_object_fields(context, request):
+    """
+    Object view of an item projected to the fields given as "field" URL
+    parameters, with only these calculated properties calculated. Used by
+    CustomEmbed to fetch only the fields needed for the requested fields.
+
+    :param context: Item
+    :param request: pyramid request object
+    :return projected: dict item in object view with the given fields
+    """
+    fields = set(request.GET.getall("field"))
+    properties = context.item_with_links(request)
+    calculated_properties = request.registry[CALCULATED_PROPERTIES].props_for(context)
+    defined = {name: prop for name, prop in calculated_properties.items() if prop.define}
+    namespace = ItemNamespace(context, request, defined, properties)
+    calculated = {}
+    for name in fields.intersection(calculated_properties):
+        value = calculated_properties[name](namespace)
+        if value is not None:
+            calculated[name] = value
+    projected = {name: value for name, value in properties.items() if name in fields}
+    merge_calculated_into_properties(projected, calculated)
+    return projected
+
+
 @view_config(
     route_name="embed", request_method="POST", effective_principals=Authenticated
 )
@@ -348,14 +904,126 @@ def embed(context, request):
     :param request: pyramid request object
     :return results: list of dicts of custom-embedded views of items
     """
+    ignored(context)
+    ids, embed_props = get_embed_params(request)
+    if len(ids) > 5:
+        raise HTTPBadRequest(
+            "Too many items were given for embedding."
+            " Please limit to less than 5 items."
+        )
+    # Object cache and work budget shared by the subrequests of embed_bulk
+    embed_props.update(getattr(request, "_embed_bulk_props", {}))
+    results = []
+    invalid_ids = []
+    for item_id in ids:
+        try:
+            item_embed = CustomEmbed(request, item_id, embed_props)
+        except EmbedBudgetExceeded as e:
+            raise HTTPRequestEntityTooLarge(str(e))
+        results.append(item_embed.result)
+        invalid_ids += item_embed.invalid_ids
+    invalid_ids += [item for item in results if isinstance(item, str)]
+    if invalid_ids:
+        raise HTTPBadRequest(
+            "The following IDs were invalid: %s" % ", ".join(invalid_ids)
+        )
+    return results
+
+
+@view_config(
+    route_name="embed_bulk", request_method="POST", effective_principals=Authenticated
+)
+@debug_log
+def embed_bulk(context, request):
+    """
+    API to return custom-embedded views of any number of items, with the
+    same parameters as the embed API, streamed as newline-delimited JSON
+    as they are embedded.
+
+    Each line is the result for one of the given IDs, in order: either
+    {"id": <ID>, "item": <custom-embedded view>} or
+    {"id": <ID>, "error": <message>} if the ID is invalid, the item cannot
+    be viewed or the work budget of the request is exceeded (ie: for all
+    items after the one exceeding it). Object views are shared across items
+    through the EmbedObjectCache.
+
+    :param context: pyramid request context
+    :param request: pyramid request object
+    :return: pyramid Response streaming NDJSON lines
+    """
+    ignored(context)
+    ids, embed_props = get_embed_params(request)
+    settings = request.registry.settings
+    object_cache = request.registry.get(EMBED_OBJECT_CACHE)
+    if object_cache is None or not object_cache.capacity:
+        object_cache = EmbedObjectCache(EMBED_BULK_CACHE_BYTES)
+    work_budget = EmbedWorkBudget(int(settings.get(EMBED_BULK_WORK_BUDGET_SETTING, EMBED_BULK_WORK_BUDGET)))
+    embed_params = {
+        "ignored": embed_props["ignored_embeds"],
+        "desired": embed_props["desired_embeds"],
+        "depth": embed_props["embed_depth"],
+        "fields": embed_props["requested_fields"],
+    }
+    return Response(
+        app_iter=stream_bulk_embed(request, ids, embed_params, object_cache, work_budget),
+        headers={
+            "X-Accel-Buffering": "no",
+            "Content-Type": "application/x-ndjson",
+            "Cache-Control": "no-store",
+        },
+    )
+
+
+def stream_bulk_embed(request, ids, embed_params, object_cache, work_budget):
+    """
+    Generator of the NDJSON lines of a bulk embed, see embed_bulk.
+
+    As it runs once the bulk embed request is over, each item is embedded
+    by a subrequest to the embed API, with its own transaction, sharing
+    the object cache and work budget of the bulk embed.
+
+    :param request: pyramid request object
+    :param ids: list of item IDs to embed
+    :param embed_params: dict of embed API parameters, other than IDs
+    :param object_cache: EmbedObjectCache shared by the items
+    :param work_budget: EmbedWorkBudget of the request
+    :return: generator of bytes lines
+    """
+    for item_id in ids:
+        line = {"id": item_id}
+        if work_budget.exceeded:
+            line["error"] = BUDGET_EXCEEDED_MSG
+        else:
+            subreq = make_subrequest(request, "/embed", method="POST", json_body=dict(embed_params, ids=[item_id]))
+            subreq.content_type = "application/json"
+            subreq._embed_bulk_props = {"object_cache": object_cache, "work_budget": work_budget}
+            response = request.invoke_subrequest(subreq, use_tweens=True)
+            if response.status_code == HTTPRequestEntityTooLarge.code:
+                line["error"] = BUDGET_EXCEEDED_MSG
+            elif response.status_code != 200:
+                line["error"] = "invalid ID"
+            elif response.json[0] is None:
+                line["error"] = FORBIDDEN_MSG["error"]
+            else:
+                line["item"] = response.json[0]
+        yield (json.dumps(line) + "\n").encode("utf-8")
+
+
+def get_embed_params(request):
+    """
+    Get the IDs to embed and the CustomEmbed parameters of an embed
+    request, from its URL parameters or JSON body.
+
+    :param request: pyramid request object
+    :return: 2-tuple of the list of unique IDs, in order, and dict of
+        CustomEmbed parameters
+    :raises HTTPBadRequest: if no ID is given
+    """
     ids = []
     ignored_embeds = []
     desired_embeds = []
     requested_fields = []
-    results = []
-    invalid_ids = []
     embed_depth = 4  # Arbritary standard depth to search.
-    ignored(context)
     if request.GET:
         ids += request.GET.dict_of_lists().get("id", [])
         embed_depth = int(request.GET.get("depth", embed_depth))
@@ -368,12 +1036,7 @@ def embed(context, request):
         desired_embeds = request.json.get("desired", [])
         embed_depth = request.json.get("depth", embed_depth)
         requested_fields = request.json.get("fields", [])
-    ids = list(set(ids))
-    if len(ids) > 5:
-        raise HTTPBadRequest(
-            "Too many items were given for embedding."
-            " Please limit to less than 5 items."
-        )
+    ids = list(dict.fromkeys(ids))
     if not ids:
         raise HTTPBadRequest("No item identifier was provided.")
     embed_props = {
@@ -382,13 +1045,4 @@ def embed(context, request):
         "embed_depth": embed_depth,
         "requested_fields": requested_fields,
     }
-    for item_id in ids:
-        item_embed = CustomEmbed(request, item_id, embed_props)
-        results.append(item_embed.result)
-        invalid_ids += item_embed.invalid_ids
-    invalid_ids += [item for item in results if isinstance(item, str)]
-    if invalid_ids:
-        raise HTTPBadRequest(
-            "The following IDs were invalid: %s" % ", ".join(invalid_ids)
-        )
-    return results
+    return ids, embed_props
@@ -0,0 +1,252 @@
+import structlog
+import transaction
+from sqlalchemy import orm
+from pyramid.httpexceptions import HTTPBadRequest
+from pyramid.settings import asbool
+from pyramid.view import view_config
+from snovault import COLLECTIONS, DBSESSION
+from snovault.crud_views import create_item
+from snovault.interfaces import AfterModified, BeforeModified
+from snovault.invalidation import add_to_indexing_queue
+from snovault.schema_utils import validate
+from snovault.storage import Key
+from snovault.util import debug_log
+
+
+log = structlog.getLogger(__name__)
+
+
+# Item types that can be written through the bulk endpoint. All of these are identified by a unique
+# key that can be computed from the item properties: an annotation_id or, for genes and variant consequences,
+# their name key (ensgid/var_conseq_id).
+BULK_UPSERT_ITEM_TYPES = ['variant', 'variant_sample', 'structural_variant', 'structural_variant_sample', 'gene',
+                          'variant_consequence']
+BULK_UPSERT_MAX_ITEMS = 10000  # hard cap to protect the server from unbounded transactions
+
+# Item types whose unique key does not depend on linked items, so it can be computed from the
+# posted properties and looked up for the whole batch up front. Sample annotation_ids embed the
+# uuid of their variant, so those are only known once the variant has been written.
+PREFETCH_ITEM_TYPES = ['variant', 'structural_variant', 'gene', 'variant_consequence']
+# Sample item types -> field linking the variant whose uuid is part of their annotation_id
+VARIANT_LINK_FIELDS = {
+    'variant_sample': 'variant',
+    'structural_variant_sample': 'structural_variant',
+}
+
+# Fields not considered when checking if an item changed: these differ on every ingestion run or are
+# only added by validation
+UNCHANGED_IGNORED_FIELDS = ['last_modified', 'schema_version', 'uuid']
+
+STATUS_CREATED = 'created'
+STATUS_UPDATED = 'updated'
+STATUS_UNCHANGED = 'unchanged'
+STATUS_EXISTING = 'existing'
+STATUS_ERROR = 'error'
+
+
+def includeme(config):
+    config.add_route('bulk_upsert', '/bulk_upsert')
+    config.scan(__name__)
+
+
+class BulkUpsertItemError(Exception):
+    """ To be thrown if a single item in a bulk upsert cannot be written """
+    pass
+
+
+def format_validation_errors(errors):
+    """ Formats schema validation errors into a single human readable message. """
+    return '; '.join('%s: %s' % ('.'.join(str(p) for p in error.path) or 'body', error.message)
+                     for error in errors)
+
+
+def properties_unchanged(current, updated):
+    """ Returns True if writing updated over current would not change any content of the item. """
+    def content(properties):
+        return {k: v for k, v in properties.items() if k not in UNCHANGED_IGNORED_FIELDS}
+    return content(current) == content(updated)
+
+
+def build_unique_key_value(type_info, properties):
+    """ Returns the value of the unique key of an item of the given type from its properties: its annotation_id
+        for annotated items, otherwise the value of its name key (ie: the ensgid of a gene).
+    """
+    factory = type_info.factory
+    build_annotation_id = getattr(factory, 'build_annotation_id', None)
+    if build_annotation_id is not None:
+        return build_annotation_id(properties)
+    return properties[factory.name_key]
+
+
+def lookup_uuids_by_unique_key(request, unique_key, names):
+    """ Looks up the uuids of the items with the given unique key values in a single query.
+        The matching resources are loaded into the session, so subsequent gets on them are free.
+
+    :param request: current request
+    :param unique_key: unique key name ie: 'variant:annotation_id'
+    :param names: unique key values to look up
+    :returns: dict mapping the values that exist to the uuid of their item
+    """
+    names = list(set(names))
+    if not names:
+        return {}
+    session = request.registry[DBSESSION]()
+    keys = session.query(Key).options(
+        orm.joinedload(Key.resource, innerjoin=True)
+    ).filter(Key.name == unique_key, Key.value.in_(names))
+    return {key.value: str(key.rid) for key in keys}
+
+
+def update_upserted_item(context, request, properties):
+    """ Equivalent of snovault.crud_views.update_item for items written through the bulk endpoint.
+        update_item builds its invalidation diff from the request body, which here holds the whole
+        batch, so no diff is passed along (the item is invalidated as a whole).
+    """
+    registry = request.registry
+    registry.notify(BeforeModified(context, request))
+    context.update(properties.copy())
+    to_queue = {'uuid': str(context.uuid), 'sid': context.sid}
+    transaction.get().addAfterCommitHook(add_to_indexing_queue, args=(request, to_queue, 'edit',))
+    registry.notify(AfterModified(context, request))
+
+
+def upsert_item(request, item_type, properties, existing_uuids=None, created_uuids=None,
+                skip_unchanged=False, skip_existing=False):
+    """ Creates the item of the given type or updates it if an item with the same unique key (see
+        build_unique_key_value) already exists.
+
+    :param request: current request
+    :param item_type: snake case item type, one of BULK_UPSERT_ITEM_TYPES
+    :param properties: item properties as they would be POSTed
+    :param existing_uuids: optional dict of prefetched unique key value -> uuid for this item type; if given,
+                           values missing from it are known not to exist, and the key of a created item is
+                           added to it so a repeated key later in the batch updates that item
+    :param created_uuids: optional set of uuids created earlier in this transaction; items linking to one
+                          of these (ie: samples of a new variant) are known not to exist yet
+    :param skip_unchanged: if True, existing items whose content would not change are not written
+    :param skip_existing: if True, existing items are not written at all, only missing items are created
+    :returns: 2-tuple of the item and STATUS_CREATED, STATUS_UPDATED, STATUS_UNCHANGED or STATUS_EXISTING
+    :raises: BulkUpsertItemError if the item does not validate or cannot be written
+    """
+    collection = request.registry[COLLECTIONS][item_type]
+    type_info = collection.type_info
+    schema = type_info.schema
+    validated, errors = validate(schema, properties)
+    if errors:
+        raise BulkUpsertItemError(format_validation_errors(errors))
+    key_value = build_unique_key_value(type_info, validated)
+    if existing_uuids is not None:
+        existing = collection.get(existing_uuids[key_value]) if key_value in existing_uuids else None
+    elif created_uuids and validated.get(VARIANT_LINK_FIELDS.get(item_type)) in created_uuids:
+        existing = None  # the annotation_id contains the uuid of a variant that was just created
+    else:
+        existing = collection.get(key_value)
+    if existing is None:
+        if not request.has_permission('add', collection):
+            raise BulkUpsertItemError('No permission to add %s' % item_type)
+        item = create_item(type_info, request, validated)
+        if existing_uuids is not None:
+            existing_uuids[key_value] = str(item.uuid)
+        return item, STATUS_CREATED
+    if skip_existing:
+        return existing, STATUS_EXISTING
+
+    # re-validate as a PATCH against the existing item
+    if not request.has_permission('edit', existing):
+        raise BulkUpsertItemError('No permission to edit %s' % existing.uuid)
+    upgraded = existing.upgrade_properties()
+    current = upgraded.copy()
+    data = current.copy()
+    data.pop('schema_version', None)
+    data.update(properties)
+    current['uuid'] = str(existing.uuid)
+    validated, errors = validate(schema, data, current)
+    if errors:
+        raise BulkUpsertItemError(format_validation_errors(errors))
+    if skip_unchanged and properties_unchanged(upgraded, validated):
+        return existing, STATUS_UNCHANGED
+    update_upserted_item(existing, request, validated)
+    return existing, STATUS_UPDATED
+
+
+def prefetch_existing_uuids(request, items):
+    """ Looks up which of the given items of PREFETCH_ITEM_TYPES already exist, one query per item type.
+
+    :param request: current request
+    :param items: bulk upsert items (dicts with 'item_type' and 'properties')
+    :returns: dict of item_type -> (dict of unique key value -> uuid of the existing item)
+    """
+    existing_uuids = {}
+    for item_type in PREFETCH_ITEM_TYPES:
+        collection = request.registry[COLLECTIONS][item_type]
+        key_values = []
+        for entry in items:
+            if entry['item_type'] != item_type:
+                continue
+            try:
+                key_values.append(build_unique_key_value(collection.type_info, entry.get('properties', {})))
+            except (KeyError, TypeError):
+                continue  # invalid item, reported when it is written
+        if key_values:
+            existing_uuids[item_type] = lookup_uuids_by_unique_key(request, collection.unique_key, key_values)
+    return existing_uuids
+
+
+@view_config(route_name='bulk_upsert', request_method='POST', permission='add')
+@debug_log
+def bulk_upsert(context, request):
+    """ Writes a batch of annotated items (variants, variant samples and their structural variant
+        equivalents), genes or variant consequences in a single transaction, creating or updating each
+        according to its unique key (annotation_id, ensgid for genes, var_conseq_id for consequences).
+
+        Expected input:
+            {'items': [{'item_type': 'variant', 'properties': {...}}, ...], 'skip_unchanged': false,
+             'skip_existing': false}
+
+        Existing variants, genes and consequences are looked up for the whole batch in a single query per
+        item type. If 'skip_unchanged' is set, existing items whose content would not change are neither
+        written nor reindexed. If 'skip_existing' is set, existing items are left as they are, so only
+        missing items are created (ie: to bootstrap reference items). Given ?skip_indexing=true, as when
+        loading inserts, items written are not queued for indexing, so the caller queues them itself.
+
+        Items are written in order, so items may link to items earlier in the same batch (ie: a
+        variant_sample following its variant). An item that fails validation is reported in its
+        result entry and does not affect the rest of the batch.
+
+    :returns: result with '@graph' containing, for each given item, its 'status' ('created', 'updated',
+              'unchanged', 'existing' or 'error') and either its 'uuid' or the 'error' message
+    """
+    items = request.json.get('items')
+    if not isinstance(items, list):
+        raise HTTPBadRequest('Expected a list of items to write under "items".')
+    if len(items) > BULK_UPSERT_MAX_ITEMS:
+        raise HTTPBadRequest('Too many items given for bulk upsert: %s (limit %s).'
+                             % (len(items), BULK_UPSERT_MAX_ITEMS))
+    skip_unchanged = asbool(request.json.get('skip_unchanged', False))
+    skip_existing = asbool(request.json.get('skip_existing', False))
+    for entry in items:
+        item_type = entry.get('item_type')
+        if item_type not in BULK_UPSERT_ITEM_TYPES:
+            raise HTTPBadRequest('Bulk upsert is not supported for item type: %s' % item_type)
+    existing_uuids = prefetch_existing_uuids(request, items)
+    created_uuids = set()
+    results = []
+    for entry in items:
+        item_type = entry['item_type']
+        try:
+            item, status = upsert_item(request, item_type, entry.get('properties', {}),
+                                       existing_uuids=existing_uuids.get(item_type),
+                                       created_uuids=created_uuids, skip_unchanged=skip_unchanged,
+                                       skip_existing=skip_existing)
+        except BulkUpsertItemError as e:
+            results.append({'status': STATUS_ERROR, 'error': str(e)})
+            continue
+        if status == STATUS_CREATED:
+            created_uuids.add(str(item.uuid))
+        results.append({'status': status, 'uuid': str(item.uuid)})
+    log.info('Bulk upserted %s items' % len(results))
+    return {
+        'status': 'success',
+        '@type': ['result'],
+        '@graph': results,
+    }
@@ -1,52 +1,179 @@
 import json
+import structlog
+from collections import Counter
 from tqdm import tqdm
 from pyramid.httpexceptions import HTTPConflict
 from .common import CGAP_CORE_PROJECT, CGAP_CORE_INSTITUTION
 
 
+log = structlog.getLogger(__name__)
+
+
+class GeneIngestionError(Exception):
+    """ To be thrown if a gene could not be written """
+    pass
+
+
+JSON_WHITESPACE = ' \t\r\n'
+JSON_DELIMITERS = JSON_WHITESPACE + ',]'
+
+
+def iter_json_array(fp, chunk_size=1024 * 1024):
+    """ Generator over the elements of the JSON array in the given text file object, decoding one element at
+        a time from chunks of the file rather than loading the whole document.
+
+    :param fp: text file object whose content is a JSON array
+    :param chunk_size: number of characters read at a time
+    :returns: generator of the decoded elements of the array
+    :raises: ValueError if the content is not a JSON array
+    """
+    decoder = json.JSONDecoder()
+    buf, pos, eof = '', 0, False
+    started, expect_separator, first = False, False, True
+    while True:
+        while pos < len(buf) and buf[pos] in JSON_WHITESPACE:
+            pos += 1
+        if pos < len(buf):
+            char = buf[pos]
+            if not started:
+                if char != '[':
+                    raise ValueError('Expected a JSON array')
+                started = True
+                pos += 1
+                continue
+            if char == ']' and (expect_separator or first):
+                return
+            if expect_separator:
+                if char != ',':
+                    raise ValueError('Expected , or ] in JSON array at character %s' % pos)
+                expect_separator = False
+                pos += 1
+                continue
+            try:
+                value, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+            else:
+                # a value not followed by a delimiter (ie: a number) may continue in the next chunk
+                if eof or (end < len(buf) and buf[end] in JSON_DELIMITERS):
+                    yield value
+                    pos, expect_separator, first = end, True, False
+                    continue
+        elif eof:
+            raise ValueError('Unexpected end of JSON array')
+        chunk = fp.read(chunk_size)
+        eof = not chunk
+        buf = buf[pos:] + chunk
+        pos = 0
+
+
 class GeneIngestion(object):
     """ Class that encapsulates data/methods for ingesting genes.
         Note that this consists of nothing except a reference to the file containing
         JSON and some Python operators that make manipulation convenient.
+        Iterating over the genes streams them from the file, while len() and indexing
+        load the whole file.
     """
     GENE_ENDPOINT = '/gene'
+    GENE_ITEM_TYPE = 'gene'
+    BULK_UPSERT_ENDPOINT = '/bulk_upsert'
 
     def __init__(self, location):
-        """ Note that this load could potentially be very expensive. Should not be done
-            ever as part of a request.
+        self.location = location
+        self._genes = None
+
+    @property
+    def genes_to_ingest(self):
+        """ List of all the genes of the file. Note that this load could potentially be very expensive.
+            Should not be done ever as part of a request.
         """
-        self.genes_to_ingest = json.load(open(location, 'r'))
+        if self._genes is None:
+            with open(self.location, 'r') as f:
+                self._genes = json.load(f)
+        return self._genes
 
     def __len__(self):
         return len(self.genes_to_ingest)
 
     def __iter__(self):
-        for gene in self.genes_to_ingest:
-            yield gene
+        if self._genes is not None:
+            yield from self._genes
+            return
+        with open(self.location, 'r') as f:
+            yield from iter_json_array(f)
 
     def __getitem__(self, item):
         return self.genes_to_ingest[item]
 
-    def upload(self, vapp, project=CGAP_CORE_PROJECT, institution=CGAP_CORE_INSTITUTION, use_tqdm=False):
-        """ Uploads all (or some if a failure occurs) of the genes
+    @staticmethod
+    def _add_shared_fields(gene, project, institution):
+        gene['status'] = 'shared'  # default gene status to shared, so visible to everyone
+        if project:
+            gene['project'] = project
+        if institution:
+            gene['institution'] = institution
+
+    def _post_gene(self, vapp, gene):
+        """ Posts the given gene, patching the existing gene on conflict.
+
+        :returns: 'created' or 'updated'
+        :raises: VirtualAppError if a post is unsuccessful
+        """
+        try:
+            vapp.post_json(self.GENE_ENDPOINT, gene, status=201)
+            return 'created'
+        except HTTPConflict:  # XXX: PATCH on conflict - Should use put instead - See C4-272
+            vapp.patch_json('/'.join([self.GENE_ENDPOINT, gene['ensgid']]), gene)
+            return 'updated'
+
+    def _write_batch(self, vapp, batch, skip_unchanged=False):
+        """ Writes the given genes in a single request/transaction through the bulk endpoint. If the bulk
+            write itself fails, falls back to writing the batch one gene at a time.
+
+        :returns: list of the status of the write of each gene
+        :raises: GeneIngestionError if a gene could not be written
+        """
+        items = [{'item_type': self.GENE_ITEM_TYPE, 'properties': gene} for gene in batch]
+        try:
+            res = vapp.post_json(self.BULK_UPSERT_ENDPOINT, {'items': items, 'skip_unchanged': skip_unchanged},
+                                 status=200)
+        except Exception as e:
+            log.info('Error encountered in bulk write of %s genes (writing individually): %s' % (len(batch), e))
+            return [self._post_gene(vapp, gene) for gene in batch]
+        statuses = []
+        for gene, result in zip(batch, res.json['@graph']):
+            if 'error' in result:
+                raise GeneIngestionError('Could not write gene %s: %s' % (gene.get('ensgid'), result['error']))
+            statuses.append(result['status'])
+        return statuses
+
+    def upload(self, vapp, project=CGAP_CORE_PROJECT, institution=CGAP_CORE_INSTITUTION, use_tqdm=False,
+               batch_size=None, skip_unchanged=False):
+        """ Uploads all (or some if a failure occurs) of the genes, streamed from the file
 
         :param vapp: VirtualApp from dcicutils to post to
         :param project: project to attach to these genes
         :param institution: institution to attach to these genes
         :param use_tqdm: boolean on whether or not to show a progress bar
-        :raises: VirtualAppError if a post is unsuccessful
+        :param batch_size: if given, genes are written in batches of this size through the bulk endpoint,
+                           one transaction per batch, rather than posted one at a time
+        :param skip_unchanged: if set (with batch_size), existing genes whose content is unchanged are
+                               neither rewritten nor reindexed
+        :returns: Counter of the genes per status of their write ('created', 'updated' or 'unchanged')
+        :raises: VirtualAppError if a post is unsuccessful, GeneIngestionError if a bulk write of a gene is
         """
-        if use_tqdm:
-            _iter = tqdm(self.genes_to_ingest, unit='genes')
-        else:
-            _iter = self.genes_to_ingest
+        _iter = tqdm(iter(self), unit='genes') if use_tqdm else self  # iter, as tqdm would load all genes for len
+        statuses, batch = Counter(), []
         for gene in _iter:
-            gene['status'] = 'shared'  # default gene status to shared, so visible to everyone
-            if project:
-                gene['project'] = project
-            if institution:
-                gene['institution'] = institution
-            try:
-                vapp.post_json(self.GENE_ENDPOINT, gene, status=201)
-            except HTTPConflict:  # XXX: PATCH on conflict - Should use put instead - See C4-272
-                vapp.patch_json('/'.join([self.GENE_ENDPOINT, gene['ensgid']]), gene)
+            self._add_shared_fields(gene, project, institution)
+            if not batch_size:
+                statuses[self._post_gene(vapp, gene)] += 1
+                continue
+            batch.append(gene)
+            if len(batch) >= batch_size:
+                statuses.update(self._write_batch(vapp, batch, skip_unchanged=skip_unchanged))
+                batch = []
+        if batch:
+            statuses.update(self._write_batch(vapp, batch, skip_unchanged=skip_unchanged))
+        return statuses
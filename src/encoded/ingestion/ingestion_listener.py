@@ -0,0 +1,266 @@
+"""
+Ingestion listener that can process several ingestion messages (ie: VCF files) at once, each in its own
+worker process with its own application/DB session. Runs exactly as the snovault ingestion listener
+unless the ``ingestion.listener_processes`` setting (or ``--processes``) is more than 1.
+"""
+import argparse
+import multiprocessing
+import resource
+import structlog
+import time
+
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from dcicutils.misc_utils import VirtualApp
+from pyramid import paster
+from snovault.ingestion.ingestion_listener import IngestionListener
+from snovault.ingestion.ingestion_message import IngestionMessage
+from snovault.project_app import app_project
+from ..util import debuglog
+
+
+log = structlog.getLogger(__name__)
+EPILOG = __doc__
+
+# Application setting giving the number of ingestion messages processed at once, each in a worker process.
+INGESTION_LISTENER_PROCESSES_SETTING = 'ingestion.listener_processes'
+# Application setting capping the virtual address space (in MB, as RLIMIT_AS) of each worker process. This is
+# not a cap on its resident memory: it must leave room for what is mapped but not resident (ie: shared libraries,
+# thread stacks). A worker going over it fails the ingestion it is running (reported on the file as usual) rather
+# than the whole ingestion box.
+INGESTION_LISTENER_WORKER_MEMORY_LIMIT_SETTING = 'ingestion.listener_worker_memory_limit'
+
+_WORKER_LISTENER = None  # listener of this (worker) process, see init_worker
+
+
+class WorkerIngestionListener(IngestionListener):
+    """ Listener handling the messages given to a worker process by ConcurrentIngestionListener.
+        It never polls (nor deletes from) the queue itself, which is left to the parent listener.
+    """
+
+    def __init__(self, vapp):  # noQA - deliberately does not set up a queue manager
+        self.vapp = vapp
+        self.queue_manager = None
+        self.update_status = None
+
+
+def init_worker(config_uri, app_name, username, memory_limit=None):
+    """ Initializes a worker process of ConcurrentIngestionListener, loading its own application.
+
+    :param config_uri: path to the config file of the application
+    :param app_name: Pyramid app name in the config file
+    :param username: user to ingest as
+    :param memory_limit: optional cap on the virtual address space (not the resident memory) of this process, in MB
+    """
+    global _WORKER_LISTENER
+    if memory_limit:
+        limit = memory_limit * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    app = paster.get_app(config_uri, app_name)
+    _WORKER_LISTENER = WorkerIngestionListener(VirtualApp(app, get_listener_environ(username)))
+
+
+def handle_message_in_worker(message):
+    """ Handles the given raw message in a worker process, returning its disposition
+        (see IngestionListener.handle_one_message). """
+    return _WORKER_LISTENER.handle_one_message(message)
+
+
+def get_listener_environ(username):
+    """ Returns the environ of the requests made by the listener. """
+    return {
+        'HTTP_ACCEPT': 'application/json',
+        'REMOTE_USER': username,
+    }
+
+
+class ProjectFairQueue:
+    """ Queue of messages waiting for a worker, handing them out fairly across projects: the next message is
+        the oldest one of the project with the fewest messages running, so a large batch of files from one
+        project does not hold up the files of the others.
+    """
+
+    def __init__(self):
+        self.pending = []  # (project, message) in order of arrival
+
+    def __len__(self):
+        return len(self.pending)
+
+    def add(self, message, project):
+        self.pending.append((project, message))
+
+    def messages(self):
+        return [message for _, message in self.pending]
+
+    def pop(self, running_projects):
+        """ Removes and returns the next message to run.
+
+        :param running_projects: projects of the messages currently running, one entry per message
+        :returns: 2-tuple of the next message and its project
+        """
+        idx = min(range(len(self.pending)), key=lambda i: (running_projects.count(self.pending[i][0]), i))
+        project, message = self.pending.pop(idx)
+        return message, project
+
+
+class ConcurrentIngestionListener(IngestionListener):
+    """ Ingestion listener handling up to self.processes messages at once, each in a worker process. """
+
+    def __init__(self, vapp, processes=1, worker_args=None, _queue_manager=None, _update_status=None):
+        super().__init__(vapp, _queue_manager=_queue_manager, _update_status=_update_status)
+        self.processes = processes
+        self.worker_args = worker_args  # arguments of init_worker
+
+    def make_executor(self):
+        """ Creates the pool of worker processes. These are spawned rather than forked so they do not share
+            the DB connections of this process. """
+        return ProcessPoolExecutor(max_workers=self.processes, mp_context=multiprocessing.get_context('spawn'),
+                                   initializer=init_worker, initargs=self.worker_args)
+
+    def get_message_project(self, message):
+        """ Returns the project of the item the given message is about, or None if it cannot be found. """
+        try:
+            uuid = IngestionMessage(message).uuid
+            item = self.vapp.get('/' + uuid + '?frame=object&datastore=database').maybe_follow().json
+        except Exception as e:
+            log.warning('Could not get the project of ingestion message %s: %s' % (message.get('MessageId'), e))
+            return None
+        return item.get('project')
+
+    @staticmethod
+    def get_message_uuid(message):
+        """ Returns the uuid given by the message, or None if it is unparseable. """
+        try:
+            return IngestionMessage(message).uuid
+        except Exception:
+            return None
+
+    def get_messages(self, batch_size=None):
+        """ Same as IngestionListener.get_messages, but receives at most batch_size messages (if given). """
+        time.sleep(self.POLL_INTERVAL)  # sleep here before polling again
+        return self.queue_manager.receive_messages(batch_size=batch_size)
+
+    def finish_message(self, message, disposition, vapp=None):
+        """ Acknowledges (or not) the given message according to the disposition returned by its handler,
+            as IngestionListener.run does. """
+        if disposition == self.MESSAGE_DEFERRED:
+            return  # left for redelivery
+        self.delete_messages([message])
+        if disposition != self.MESSAGE_POISON:
+            app_project().note_post_ingestion(message, context=vapp)
+
+    def run(self, vapp=None):
+        """ Same as IngestionListener.run, but messages are handled in self.processes worker processes.
+
+            HIGH LEVEL LOGIC:
+                while True:
+                    poll for as many messages as there are idle workers
+                    hand out waiting messages to idle workers, fairly across projects
+                    as each message is done, delete it unless it is to be redelivered
+        """
+        if not self.processes or self.processes <= 1:
+            return super().run(vapp=vapp)
+        log.info('Ingestion listener successfully online with %s worker processes.' % self.processes)
+        pending = ProjectFairQueue()
+        running = {}  # future -> (message, project)
+        executor = self.make_executor()
+        try:
+            while self.should_remain_online():
+
+                # only receive as many messages as would run right away, leaving the rest on the queue: a message
+                # waiting here for hours behind long ingestions would outlive its visibility timeout and be redelivered
+                idle_workers = self.processes - len(pending) - len(running)
+                if idle_workers > 0:
+                    uuids = {self.get_message_uuid(message) for message in pending.messages()}
+                    uuids.update(self.get_message_uuid(message) for message, _ in running.values())
+                    for message in self.get_messages(batch_size=idle_workers):  # waits POLL_INTERVAL
+                        uuid = self.get_message_uuid(message)
+                        if uuid is None:
+                            self.finish_message(message, self.handle_one_message(message), vapp=vapp)
+                        elif uuid not in uuids:  # a redelivered message would ingest the same file twice
+                            uuids.add(uuid)
+                            pending.add(message, self.get_message_project(message))
+                elif running:
+                    wait(running, timeout=self.POLL_INTERVAL, return_when=FIRST_COMPLETED)
+
+                executor = self.collect_finished(executor, running, vapp=vapp)
+
+                while pending and len(running) < self.processes:
+                    message, project = pending.pop([project for _, project in running.values()])
+                    debuglog("Handing out message:", message)
+                    running[executor.submit(handle_message_in_worker, message)] = (message, project)
+            wait(running)
+            self.collect_finished(executor, running, vapp=vapp)
+        finally:
+            executor.shutdown(wait=True)
+
+    def collect_finished(self, executor, running, vapp=None):
+        """ Finishes the messages whose handling is done, returning the executor to use from now on:
+            if a worker process died (ie: killed going over its memory), a new pool is created. """
+        if not self.finish_done(running, vapp=vapp):
+            return executor
+        executor.shutdown(wait=True)
+        self.finish_done(running, vapp=vapp)  # the pool being broken, all its messages are done by now
+        return self.make_executor()
+
+    def finish_done(self, running, vapp=None):
+        """ Finishes the messages of running whose handling is done, removing them from it.
+
+        :returns: True if the pool of worker processes is broken, False otherwise
+        """
+        broken = False
+        for future in [future for future in running if future.done()]:
+            message, _ = running.pop(future)
+            try:
+                disposition = future.result()
+            except BrokenProcessPool as e:
+                log.error('Worker process died handling ingestion message %s, leaving it for redelivery: %s'
+                          % (message.get('MessageId'), e))
+                broken = True
+                disposition = self.MESSAGE_DEFERRED
+            except Exception as e:
+                log.error('Error handling ingestion message %s in worker process: %r' % (message.get('MessageId'), e))
+                disposition = self.MESSAGE_DEFERRED
+            self.finish_message(message, disposition, vapp=vapp)
+        return broken
+
+def run(vapp=None, processes=1, worker_args=None, _queue_manager=None, _update_status=None):
+    """ Entry-point for the ingestion listener. """
+    ingestion_listener = ConcurrentIngestionListener(vapp, processes=processes, worker_args=worker_args,
+                                                     _queue_manager=_queue_manager, _update_status=_update_status)
+    try:
+        ingestion_listener.run(vapp=vapp)
+    except Exception as e:
+        debuglog(str(e))
+        raise
+
+
+# Command Application (for waitress)
+def main():
+    """ Entry point for the local deployment. """
+    parser = argparse.ArgumentParser(  # noqa - PyCharm wrongly thinks the formatter_class is specified wrong here.
+        description='Listen for VCF File uuids to ingest',
+        epilog=EPILOG,
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument('--app-name', help='Pyramid app name in configfile')
+    parser.add_argument('--username', '-u', default='IMPORT', help='Import username')
+    # Kept for compatibility with the snovault listener's command line, which accepts it but does not use it either
+    parser.add_argument('--dry-run', action='store_true', help='Do not post variants, just validate')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='Number of messages to process at once, each in a worker process'
+                             ' (defaults to the %s setting, else 1)' % INGESTION_LISTENER_PROCESSES_SETTING)
+    parser.add_argument('config_uri', help="path to configfile")
+    args = parser.parse_args()
+
+    app = paster.get_app(args.config_uri, args.app_name)
+    settings = app.registry.settings
+    processes = args.processes or int(settings.get(INGESTION_LISTENER_PROCESSES_SETTING, 1))
+    memory_limit = int(settings.get(INGESTION_LISTENER_WORKER_MEMORY_LIMIT_SETTING, 0)) or None
+    vapp = VirtualApp(app, get_listener_environ(args.username))
+    return run(vapp, processes=processes,
+               worker_args=(args.config_uri, args.app_name, args.username, memory_limit))
+
+
+if __name__ == '__main__':
+    main()
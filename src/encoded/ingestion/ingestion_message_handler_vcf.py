@@ -1,12 +1,15 @@
+import os
+import pysam
 import requests  # XXX: C4-211 should not be needed but is // KMP needs this, too, until subrequest posts work
 import structlog
 import tempfile
 from dcicutils.misc_utils import PRINT
-from vcf import Reader
-from ..commands.reformat_vcf import runner as reformat_vcf
-from ..commands.add_altcounts_by_gene import main as add_altcounts
+from pyramid.settings import asbool
+from ..commands.preprocess_vcf import iter_preprocessed_vcf_lines, write_preprocessed_vcf_records
+from ..commands.validate_vcf import VCFValidator
+from .ingestion_metrics import IngestionMetrics
 from snovault.ingestion.ingestion_listener import IngestionListener
-from ..util import (gunzip_content, debuglog, resolve_file_path)
+from ..util import resolve_file_path
 from snovault.ingestion.ingestion_listener_base import (
     STATUS_INGESTED,
     STATUS_DISABLED,
@@ -15,6 +18,7 @@ from snovault.ingestion.ingestion_listener_base import (
 )
 from snovault.ingestion.ingestion_message import IngestionMessage
 from snovault.ingestion.ingestion_message_handler_decorator import ingestion_message_handler
+from .vcf_reader import LazyVCFReader, PreprocessedVCFReader
 from .vcf_utils import VCFParser, StructuralVariantVCFParser
 from .variant_utils import CNVBuilder, StructuralVariantBuilder, VariantBuilder
 
@@ -27,6 +31,30 @@ STRUCTURAL_VARIANT_SAMPLE_SCHEMA = resolve_file_path(
     "./schemas/structural_variant_sample.json"
 )
 
+VCF_DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+FILE_INGESTION_METRICS = 'file_ingestion_metrics'  # field of the ingested file holding the ingestion metrics
+
+# Application setting giving the number of VCF records written per bulk request by the listener.
+# If not set, items are written one at a time.
+VCF_INGESTION_BATCH_SIZE_SETTING = 'ingestion.vcf_batch_size'
+# Application setting to not rewrite (nor reindex) items whose content is unchanged on re-ingestion.
+VCF_INGESTION_SKIP_UNCHANGED_SETTING = 'ingestion.vcf_skip_unchanged'
+# Application setting giving the number of worker processes parsing and building records.
+VCF_INGESTION_PROCESSES_SETTING = 'ingestion.vcf_processes'
+# Application setting giving the number of records after which ingestion progress is saved on the file.
+# A message for a file whose ingestion was interrupted (ie: listener restarted) resumes from there.
+VCF_INGESTION_CHECKPOINT_INTERVAL_SETTING = 'ingestion.vcf_checkpoint_interval'
+VCF_INGESTION_CHECKPOINT_INTERVAL = 10000
+# Application setting to have preprocessing write SNV VCFs as binary records (see vcf_reader.PreprocessedVCFReader)
+# rather than stream VCF lines to the parser.
+VCF_INGESTION_PREPROCESSED_RECORDS_SETTING = 'ingestion.vcf_preprocessed_records'
+# Application setting to not validate VCFs (see commands.validate_vcf) before ingesting them, on by default.
+VCF_INGESTION_VALIDATE_SETTING = 'ingestion.vcf_validate'
+# Application setting to queue all variants/samples written for indexing at every checkpoint and at the end of
+# the ingestion, each once, rather than as they are written. Their uuids are held in memory until queued,
+# so without a checkpoint interval those of the whole ingestion are.
+VCF_INGESTION_DEFER_INDEXING_SETTING = 'ingestion.vcf_defer_indexing'
+
 log = structlog.getLogger(__name__)
 
 
@@ -34,6 +62,94 @@ def includeme(config):
     pass
 
 
+def download_to_temporary_file(location, suffix=None):
+    """ Downloads the file at location to a named temporary file in chunks of VCF_DOWNLOAD_CHUNK_SIZE bytes,
+        so memory use does not grow with the size of the file. The file is deleted once closed.
+    """
+    downloaded = tempfile.NamedTemporaryFile(suffix=suffix)
+    with requests.get(location, stream=True) as response:
+        response.raise_for_status()
+        for chunk in response.iter_content(chunk_size=VCF_DOWNLOAD_CHUNK_SIZE):
+            downloaded.write(chunk)
+    downloaded.flush()
+    return downloaded
+
+
+def tabix_index_vcf(path):
+    """ Tabix indexes the bgzipped (and sorted) VCF at path, so regions of it can be preprocessed in parallel.
+        Returns the path to the index, or None if the VCF cannot be indexed (ie: only gzipped).
+    """
+    try:
+        return pysam.tabix_index(path, preset='vcf', force=True) + '.tbi'
+    except Exception as e:
+        log.warning(f'Could not tabix index VCF {path}, preprocessing it in a single process: {e}')
+        return None
+
+
+def open_gzipped_vcf(path):
+    """ Returns a LazyVCFReader decompressing the gzipped VCF at path as it is read. """
+    # Note: it's not guaranteed that vcf.Reader reads utf-8, so pass explicitly
+    return LazyVCFReader(filename=path, compressed=True, encoding='utf-8')
+
+
+def get_listener_setting(listener, setting, default=None):
+    """ Returns the given setting of the application the listener ingests into, if available. """
+    registry = getattr(getattr(listener.vapp, 'app', None), 'registry', None)
+    settings = getattr(registry, 'settings', None) or {}
+    return settings.get(setting, default)
+
+
+def get_vcf_ingestion_batch_size(listener):
+    """ Returns the configured number of VCF records to write per bulk request, or None. """
+    batch_size = get_listener_setting(listener, VCF_INGESTION_BATCH_SIZE_SETTING)
+    return int(batch_size) if batch_size else None
+
+
+def get_vcf_builder_options(listener):
+    """ Returns the keyword arguments configuring how the variant builders write items. """
+    return {
+        'batch_size': get_vcf_ingestion_batch_size(listener),
+        'skip_unchanged': asbool(get_listener_setting(listener, VCF_INGESTION_SKIP_UNCHANGED_SETTING, False)),
+        'processes': int(get_listener_setting(listener, VCF_INGESTION_PROCESSES_SETTING, 0)) or None,
+        'checkpoint_interval': int(get_listener_setting(listener, VCF_INGESTION_CHECKPOINT_INTERVAL_SETTING,
+                                                        VCF_INGESTION_CHECKPOINT_INTERVAL)) or None,
+        'resume': True,
+        'defer_indexing': asbool(get_listener_setting(listener, VCF_INGESTION_DEFER_INDEXING_SETTING, False)),
+    }
+
+
+def validate_vcf(path, vcf_type, processes=None):
+    """ Validates the downloaded VCF at path before ingesting it, so a malformed file fails before any item is
+        written. Records of SV/CNV VCFs, ingested as is, are also built into items; those of SNV VCFs, which are
+        reformatted first, are only parsed.
+
+    :returns: report of the validation, see commands.validate_vcf.VCFValidator.get_report
+    """
+    if vcf_type == "SNV":
+        validator = VCFValidator(path, VARIANT_SCHEMA, VARIANT_SAMPLE_SCHEMA, processes=processes)
+    else:
+        validator = VCFValidator(path, STRUCTURAL_VARIANT_SCHEMA, STRUCTURAL_VARIANT_SAMPLE_SCHEMA,
+                                 parser_class=StructuralVariantVCFParser, processes=processes, build_items=True)
+    return validator.get_report()
+
+
+def build_validation_error_report(report):
+    """ Returns the errors of the given validation report as an ingestion error report (see file_processed.json),
+        rows being line numbers of the VCF. """
+    return [{'body': error['error'], 'row': error['line']} for error in report['errors']]
+
+
+def report_ingestion_metrics(listener, uuid, metrics):
+    """ Logs the given metrics of the ingestion of the file with the given uuid as a structured event and
+        patches them on the file. Not being able to patch them does not fail the ingestion. """
+    metrics = metrics.to_dict()
+    log.info('VCF ingestion metrics', uuid=uuid, **metrics)
+    try:
+        listener.vapp.patch_json('/' + uuid, {FILE_INGESTION_METRICS: metrics}, status=200)
+    except Exception as e:
+        log.error('Could not patch ingestion metrics of %s: %s' % (uuid, e))
+
+
 @ingestion_message_handler(ingestion_type=TYPE_VCF)
 def ingestion_message_handler_vcf(message: IngestionMessage, listener: IngestionListener) -> bool:
     """
@@ -59,70 +175,92 @@ def ingestion_message_handler_vcf(message: IngestionMessage, listener: Ingestion
         log.error('Skipping ingestion of file %s due to disabled ingestion status' % message.uuid)
         return False
 
-    # attempt download with workaround
+    # attempt download with workaround, streaming the (gzipped) VCF to disk
+    metrics = IngestionMetrics()
     try:
-        raw_content = requests.get(location).content
+        with metrics.timer('download'):
+            downloaded_vcf = download_to_temporary_file(location, suffix='.gz')
     except Exception as e:
         log.error('Could not download file uuid: %s with error: %s' % (message.uuid, e))
         return False
+    with downloaded_vcf:  # deleted once ingested, if not before (ie: SNV VCFs once preprocessed)
+        return ingest_downloaded_vcf(message, listener, file_meta, downloaded_vcf, metrics)
+
+
+def set_ingestion_error(listener, uuid, report, metrics):
+    """ Sets the error status of the file with the given uuid, patching the given ingestion error report and
+        the metrics of its ingestion on it. """
+    listener.set_status(uuid, STATUS_ERROR)
+    listener.patch_ingestion_report(report, uuid)
+    report_ingestion_metrics(listener, uuid, metrics)
+
 
-    # gunzip content, pass to parser, post variants/variant_samples
+def ingest_downloaded_vcf(message, listener, file_meta, downloaded_vcf, metrics):
+    """ Ingests the VCF of the given message once downloaded, see ingestion_message_handler_vcf.
+
+    :param message: ingestion message of the VCF file
+    :param listener: ingestion listener handling the message
+    :param file_meta: properties of the VCF file
+    :param downloaded_vcf: named temporary file the (gzipped) VCF was downloaded to
+    :param metrics: IngestionMetrics of the ingestion
+    :returns: True, the message being handled whether or not ingestion succeeded
+    """
+    # pass to parser, post variants/variant_samples
     # patch in progress status
     listener.set_status(message.uuid, STATUS_IN_PROGRESS)
-    # decoded_content = gunzip_content(raw_content)
-    # debuglog('Got decoded content: %s' % decoded_content[:20])
 
     vcf_type = file_meta.get("variant_type", "SNV")
-    if vcf_type == "SNV":
-        # Apply VCF reformat
-        vcf_to_be_formatted = tempfile.NamedTemporaryFile(suffix='.gz')
-        vcf_to_be_formatted.write(raw_content)
-        formatted = tempfile.NamedTemporaryFile()
-        reformat_args = {
-            'inputfile': vcf_to_be_formatted.name,
-            'outputfile': formatted.name,
-            'verbose': False
-        }
-        try:
-            reformat_vcf(reformat_args)
-        except Exception as e:
-            log.error(f'Exception encountered in reformat script {e} - input VCF may be malformed')
-            listener.set_status(message.uuid, STATUS_ERROR)
-            return True
+    builder_options = get_vcf_builder_options(listener)
 
-        # Add altcounts by gene
-        # Note: you cannot pass this file object to vcf.Reader if it's in rb mode
-        # It's also not guaranteed that it reads utf-8, so pass explicitly
-        formatted_with_alt_counts = tempfile.NamedTemporaryFile(mode='w+', encoding='utf-8')
-        alt_counts_args = {
-            'inputfile': formatted.name,
-            'outputfile': formatted_with_alt_counts.name
-        }
+    # validate the whole VCF up front, failing in seconds rather than partway through ingestion
+    if asbool(get_listener_setting(listener, VCF_INGESTION_VALIDATE_SETTING, True)):
+        with metrics.timer('validate'):
+            report = validate_vcf(downloaded_vcf.name, vcf_type, processes=builder_options['processes'])
+        for warning in report['warnings']:
+            log.warning('VCF %s line %s: %s' % (message.uuid, warning['line'], warning['error']))
+        if not report['valid']:
+            log.error('VCF %s failed validation with %s errors' % (message.uuid, report['error_count']))
+            set_ingestion_error(listener, message.uuid, build_validation_error_report(report), metrics)
+            return True
+    if vcf_type == "SNV":
+        # Reformat VCF and add altcounts by gene in one pass, streaming the resulting lines straight
+        # into the parser rather than writing them to another file first. The whole VCF is read when
+        # the header is, reformatted variants being spilled to a temporary file for the second pass.
+        # Given several processes, regions of the (tabix indexed) VCF are reformatted in parallel by
+        # as many worker processes as are used for building records.
+        processes = builder_options['processes']
+        index = tabix_index_vcf(downloaded_vcf.name) if processes and processes > 1 else None
         try:
-            add_altcounts(alt_counts_args)
+            # reformatting and counting alt alleles are a single stage, done in the same pass
+            with metrics.timer('preprocess'):
+                if asbool(get_listener_setting(listener, VCF_INGESTION_PREPROCESSED_RECORDS_SETTING, False)):
+                    # written as binary records, read memory-mapped without parsing VCF text
+                    with tempfile.NamedTemporaryFile(suffix='.records') as preprocessed:
+                        write_preprocessed_vcf_records(downloaded_vcf.name, preprocessed.name, processes=processes)
+                        reader = PreprocessedVCFReader.open(preprocessed.name)  # mapping outlives the file
+                else:
+                    preprocessed = iter_preprocessed_vcf_lines(downloaded_vcf.name, processes=processes)
+                    reader = LazyVCFReader(preprocessed)  # reads the header, so reformats and counts alt alleles
         except Exception as e:
-            log.error(f'Exception encountered in altcounts script {e} - input VCF may be malformed')
-            listener.set_status(message.uuid, STATUS_ERROR)
+            log.error(f'Exception encountered in VCF preprocessing {e} - input VCF may be malformed')
+            set_ingestion_error(listener, message.uuid, listener.build_ingestion_error_report(msg=str(e)), metrics)
             return True
-        parser = VCFParser(None, VARIANT_SCHEMA, VARIANT_SAMPLE_SCHEMA,
-                           reader=Reader(formatted_with_alt_counts))
+        finally:
+            downloaded_vcf.close()  # no longer needed, free the disk space
+            if index:
+                os.remove(index)
+        parser = VCFParser(None, VARIANT_SCHEMA, VARIANT_SAMPLE_SCHEMA, reader=reader)
         variant_builder = VariantBuilder(listener.vapp, parser, file_meta['accession'],
                                          project=file_meta['project']['@id'],
-                                         institution=file_meta['institution']['@id'])
+                                         institution=file_meta['institution']['@id'],
+                                         metrics=metrics, **builder_options)
     elif vcf_type == "SV":
         # No reformatting necesssary for SV VCF
-        decoded_content = gunzip_content(raw_content)
-        debuglog('Got decoded content: %s' % decoded_content[:20])
-        formatted_vcf = tempfile.NamedTemporaryFile(
-            mode="w+", encoding="utf-8"
-        )
-        formatted_vcf.write(decoded_content)
-        formatted_vcf.seek(0)
         parser = StructuralVariantVCFParser(
             None,
             STRUCTURAL_VARIANT_SCHEMA,
             STRUCTURAL_VARIANT_SAMPLE_SCHEMA,
-            reader=Reader(formatted_vcf),
+            reader=open_gzipped_vcf(downloaded_vcf.name),
         )
         variant_builder = StructuralVariantBuilder(
             listener.vapp,
@@ -130,20 +268,15 @@ def ingestion_message_handler_vcf(message: IngestionMessage, listener: Ingestion
             file_meta["accession"],
             project=file_meta["project"]["@id"],
             institution=file_meta["institution"]["@id"],
+            metrics=metrics,
+            **builder_options,
         )
     elif vcf_type == "CNV":
-        decoded_content = gunzip_content(raw_content)
-        debuglog('Got decoded content: %s' % decoded_content[:20])
-        formatted_vcf = tempfile.NamedTemporaryFile(
-            mode="w+", encoding="utf-8"
-        )
-        formatted_vcf.write(decoded_content)
-        formatted_vcf.seek(0)
         parser = StructuralVariantVCFParser(
             None,
             STRUCTURAL_VARIANT_SCHEMA,
             STRUCTURAL_VARIANT_SAMPLE_SCHEMA,
-            reader=Reader(formatted_vcf),
+            reader=open_gzipped_vcf(downloaded_vcf.name),
         )
         variant_builder = CNVBuilder(
             listener.vapp,
@@ -151,21 +284,25 @@ def ingestion_message_handler_vcf(message: IngestionMessage, listener: Ingestion
             file_meta["accession"],
             project=file_meta["project"]["@id"],
             institution=file_meta["institution"]["@id"],
+            metrics=metrics,
+            **builder_options,
         )
     try:
+        # records of SNV VCFs are streamed from preprocessing as they are ingested, so errors of
+        # preprocessing past the header are raised from here
         success, error = variant_builder.ingest_vcf()
     except Exception as e:
         # if exception caught here, we encountered an error reading the actual
         # VCF - this should not happen but can in certain circumstances. In this
         # case we need to patch error status and discard the current message.
         log.error('Caught error in VCF processing in ingestion listener: %s' % e)
-        listener.set_status(message.uuid, STATUS_ERROR)
-        listener.patch_ingestion_report(listener.build_ingestion_error_report(msg=e), message.uuid)
+        set_ingestion_error(listener, message.uuid, listener.build_ingestion_error_report(msg=str(e)), metrics)
         return True
 
     # report results in error_log regardless of status
     msg = variant_builder.ingestion_report.brief_summary()
     log.error(msg)
+    report_ingestion_metrics(listener, message.uuid, metrics)
     if listener.update_status is not None and callable(listener.update_status):
         listener.update_status(msg=msg)
 
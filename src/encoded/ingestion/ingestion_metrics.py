@@ -0,0 +1,118 @@
+"""
+ingestion_metrics.py - wall time and counters of the stages of an ingestion, to tell what it is bound by
+"""
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+
+RSS_SAMPLE_INTERVAL = 1  # seconds between samples of the memory use of the process, see IngestionMetrics.sample_rss
+
+
+def get_rss_mb():
+    """ Returns the current resident set size of this process in MB, from /proc/self/status, or None if it cannot
+        be read (ie: not on linux). Unlike the ru_maxrss of getrusage, this is not a high-water mark over the
+        lifetime of the process (ie: a listener having ingested other files before). """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return round(int(line.split()[1]) / 1024, 1)  # in kB
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+class IngestionMetrics:
+    """ Wall time and counters of the stages of an ingestion (ie: download, preprocess, parse, build, write).
+        Stages are timed with timer (or timed_iter for the items of an iterator) and the times of the same
+        stage add up, so a stage run once per record (or per block of records) gives its total time.
+        Stage times measured in other processes (ie: while building in parallel) are added with merge,
+        so are summed over processes rather than wall time.
+    """
+    RECORDS = 'records'  # counter of the records ingested, from which throughput is given
+
+    def __init__(self):
+        self.started = time.time()
+        self.stages = {}  # stage -> [seconds, count], in the order stages were first timed
+        self.counters = Counter()
+        self.peak_rss_mb = None  # largest memory use of this process sampled during the ingestion
+        self.peak_worker_rss_mb = None  # largest memory use of a worker process, as given to merge
+        self.rss_sampled = 0  # time of the last sample
+        self.sample_rss()
+
+    def sample_rss(self):
+        """ Samples the memory use of this process, keeping the largest sample as self.peak_rss_mb. """
+        self.rss_sampled = time.time()
+        rss_mb = get_rss_mb()
+        if rss_mb is not None and (self.peak_rss_mb is None or rss_mb > self.peak_rss_mb):
+            self.peak_rss_mb = rss_mb
+
+    def add_time(self, stage, seconds, count=1):
+        """ Adds the given time (and count of items processed) to the stage, sampling the memory use of this
+            process every RSS_SAMPLE_INTERVAL seconds. """
+        if time.time() - self.rss_sampled >= RSS_SAMPLE_INTERVAL:
+            self.sample_rss()
+        times = self.stages.get(stage)
+        if times is None:
+            self.stages[stage] = [seconds, count]
+        else:
+            times[0] += seconds
+            times[1] += count
+
+    @contextmanager
+    def timer(self, stage, count=1):
+        """ Context manager adding the time spent in its block to the stage. """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.perf_counter() - start, count)
+
+    def timed_iter(self, stage, iterable):
+        """ Generator over the items of the iterable, adding the time spent getting each item to the stage. """
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add_time(stage, time.perf_counter() - start, 0)
+                return
+            self.add_time(stage, time.perf_counter() - start)
+            yield item
+
+    def increment(self, counter, n=1):
+        """ Increments the given counter (ie: records, retries) by n. """
+        self.counters[counter] += n
+
+    def get_stage_times(self):
+        """ Returns the stage times, as a dict stage -> {'seconds': seconds, 'count': count}, for merge. """
+        return {stage: {'seconds': seconds, 'count': count} for stage, (seconds, count) in self.stages.items()}
+
+    def merge(self, stage_times, peak_rss_mb=None):
+        """ Adds the given stage times, as returned by get_stage_times (ie: of another process), keeping the
+            largest given peak memory use of that process (see sample_rss) as self.peak_worker_rss_mb. """
+        for stage, times in stage_times.items():
+            self.add_time(stage, times['seconds'], times['count'])
+        if peak_rss_mb is not None and (self.peak_worker_rss_mb is None or peak_rss_mb > self.peak_worker_rss_mb):
+            self.peak_worker_rss_mb = peak_rss_mb
+
+    def to_dict(self):
+        """ Returns the metrics, as patched on the ingested file (see file_processed.json, file_ingestion_metrics):
+            stages with their time and count, counters, total time, throughput and peak memory use sampled
+            during the ingestion (if it could be read). """
+        self.sample_rss()
+        total_seconds = time.time() - self.started
+        records = self.counters[self.RECORDS]
+        metrics = {
+            'stages': [{'stage': stage, 'seconds': round(seconds, 3), 'count': count}
+                       for stage, (seconds, count) in self.stages.items()],
+            'total_seconds': round(total_seconds, 3),
+            'records_per_second': round(records / total_seconds, 1) if total_seconds else 0,
+        }
+        for field in ['peak_rss_mb', 'peak_worker_rss_mb']:
+            if getattr(self, field) is not None:
+                metrics[field] = getattr(self, field)
+        metrics.update(self.counters)
+        return metrics
@@ -47,12 +47,14 @@ class VariantTableParser(object):
     EMBEDS_TO_GENERATE = [('variant', EMBEDDED_VARIANT_FIELDS),
                           ('variant_sample', EMBEDDED_VARIANT_SAMPLE_FIELDS)]
     NAME_FIELD = 'field_name'
+    ITEM_TYPES = ['variant', 'variant_sample']  # item types whose schemas are generated, see generate_item_properties
 
-    def __init__(self, _mp, schema, skip_embeds=False):
+    def __init__(self, _mp, schema, skip_embeds=False, write_embeds=True):
         self.mapping_table = _mp
         self.annotation_field_schema = json.load(io.open(schema, 'r'))
         self.version, self.date, self.fields = self.read_mp_meta()
-        if not skip_embeds:  # if calling from gene, do not wipe variant/variant_sample embeds
+        self.write_embeds = write_embeds  # if False, embeds files are neither wiped nor updated (ie: for diffs)
+        if not skip_embeds and write_embeds:  # if calling from gene, do not wipe variant/variant_sample embeds
             self.provision_embeds()
 
     @staticmethod
@@ -187,6 +189,8 @@ class VariantTableParser(object):
         :param scope: which item type this embed is for
         """
         # XXX: This does NOT work properly if for linkTos, embeds required .keyword!
+        if not self.write_embeds:
+            return
         for t, f in self.EMBEDS_TO_GENERATE:
             if scope == t:
                 with io.open(f, 'rb') as fd:
@@ -1029,6 +1033,22 @@ class VariantTableParser(object):
             json.dump(schema, out, indent=4)
         logger.info('Successfully wrote schema: %s to file: %s\n' % (schema['title'], fname))
 
+    def generate_item_properties(self):
+        """ Generates the schema 'properties' of each of ITEM_TYPES from the mapping table, along with their
+            'facets' and 'columns' where these are generated from the table too (ie: for genes).
+
+        Returns:
+            dict of item type -> dict with 'properties' (and 'facets' and 'columns')
+        """
+        inserts = self.process_annotation_field_inserts()
+        variant_props, _, _ = self.generate_properties(self.filter_fields_by_variant(inserts))
+        variant_sample_props, _, _ = self.generate_properties(self.filter_fields_by_sample(inserts), variant=False)
+        variant_type, variant_sample_type = self.ITEM_TYPES
+        return {
+            variant_type: {'properties': variant_props},
+            variant_sample_type: {'properties': variant_sample_props},
+        }
+
     def run(self, vs_out=None, v_out=None, institution=None, project=None, write=True):
         """ Runs the mapping table intake program, generates and writes schemas
             and returns inserts to be posted in main
@@ -1108,6 +1128,7 @@ class StructuralVariantTableParser(VariantTableParser):
         ("variant_sample", EMBEDDED_VARIANT_SAMPLE_FIELDS),
     ]
     VCF_FIELD_KEY = "vcf_field"
+    ITEM_TYPES = ["structural_variant", "structural_variant_sample"]
 
     def __init__(self, *args, **kwargs):
         super(StructuralVariantTableParser, self).__init__(*args, **kwargs)
@@ -1237,6 +1258,8 @@ class StructuralVariantTableParser(VariantTableParser):
         :param scope: which item type this embed is for
         """
         # XXX: This does NOT work properly if for linkTos, embeds required .keyword!
+        if not self.write_embeds:
+            return
         for t, f in self.EMBEDS_TO_GENERATE:
             if scope == t:
                 t = "structural_" + t
@@ -1346,6 +1369,7 @@ class StructuralVariantTableParser(VariantTableParser):
 
 class GeneTableParser(VariantTableParser):
     """ Subclass of MappingTableParser that overrides methods required for any differences across tables. """
+    ITEM_TYPES = ['gene']
 
     def __init__(self, *args, **kwargs):
         self.FIELD_TYPE_INDEX = 8
@@ -1377,6 +1401,14 @@ class GeneTableParser(VariantTableParser):
             {"$ref": "mixins.json#/interpretation"}
         ]
 
+    def generate_item_properties(self):
+        """ Generates the gene schema 'properties', 'facets' and 'columns' from the gene table.
+
+        :return: dict of 'gene' -> dict with 'properties', 'facets' and 'columns'
+        """
+        gene_props, columns, facets = self.generate_properties(self.process_annotation_field_inserts())
+        return {'gene': {'properties': gene_props, 'facets': facets, 'columns': columns}}
+
     def generate_gene_schema(self, gene_props, columns, facets):
         """
         Builds gene.json schema based on gene_props
@@ -1426,3 +1458,164 @@ class GeneTableParser(VariantTableParser):
             self.write_schema(gene_schema, gs_out)
             logger.info('Successfully wrote gene schema to %s' % gs_out)
         return inserts
+
+
+class MappingTableDiff(object):
+    """ Structured diff between the schemas generated from a previous and a new version of a mapping table,
+        so a mapping table bump only touches what it changes. For each item type of the table, fields (as
+        dotted paths, ie: 'transcript.csq_gene') are reported as:
+            * added: not generated from the previous table
+            * removed: not generated from the new table
+            * retyped: whose Elasticsearch mapping type changes (ie: string -> integer, value -> object)
+            * changed: whose schema changes without changing their mapping (ie: title, enum)
+        along with the facets and columns added/removed/changed where these are generated from the table.
+
+        Added fields only add to the Elasticsearch mapping (no reindex needed), while removed and retyped
+        fields change existing mappings (reindex needed), see get_mapping_change. The report also holds
+        the schema fragments affected, ie: the new value of every top level property with a change (None
+        if removed), so these are all that needs to be reviewed and updated.
+        NOTE: changes to embedded fields (written to the embeds files rather than to the schemas) are not
+        compared.
+    """
+    NO_MAPPING_CHANGE = 'none'
+    ADDITIVE_MAPPING_CHANGE = 'additive'
+    BREAKING_MAPPING_CHANGE = 'breaking'
+    FIELD_CHANGES = ['added', 'removed', 'retyped', 'changed']
+
+    def __init__(self, previous, new):
+        """
+        :param previous: parser of the previous mapping table
+        :param new: parser of the new mapping table, of the same class
+        """
+        self.previous = previous
+        self.new = new
+
+    @classmethod
+    def from_tables(cls, parser_class, previous_table, new_table, annotation_field_schema):
+        """ Builds the diff of the given mapping tables, read by parsers of the given class that do not touch
+            the embeds files.
+
+        :param parser_class: VariantTableParser or one of its subclasses
+        :param previous_table: path to the previous mapping table
+        :param new_table: path to the new mapping table
+        :param annotation_field_schema: path to the annotation field schema of the tables
+        :return: MappingTableDiff
+        """
+        return cls(parser_class(previous_table, annotation_field_schema, write_embeds=False),
+                   parser_class(new_table, annotation_field_schema, write_embeds=False))
+
+    @staticmethod
+    def get_mapping_type(prop):
+        """ Returns what determines the Elasticsearch mapping of the given schema property: its type (the type
+            of its items for arrays, which are mapped as their items) and its format. """
+        while prop.get('type') == 'array' and prop.get('items'):
+            prop = prop['items']
+        return prop.get('type'), prop.get('format')
+
+    @classmethod
+    def flatten_properties(cls, props, prefix=''):
+        """ Flattens the given schema properties into a dict of dotted path -> property, recursing into
+            objects (and arrays of objects). """
+        flat = {}
+        for name, prop in props.items():
+            path = prefix + name
+            flat[path] = prop
+            items = prop
+            while items.get('type') == 'array' and items.get('items'):
+                items = items['items']
+            if items.get('type') == 'object':
+                flat.update(cls.flatten_properties(items.get('properties', {}), prefix=path + '.'))
+        return flat
+
+    @classmethod
+    def diff_properties(cls, previous_props, new_props):
+        """ Compares the given schema properties, see class docstring.
+
+        :return: dict of 'added', 'removed', 'retyped' and 'changed' -> sorted list of dotted paths
+        """
+        previous_flat, new_flat = cls.flatten_properties(previous_props), cls.flatten_properties(new_props)
+        diff = {
+            'added': sorted(set(new_flat) - set(previous_flat)),
+            'removed': sorted(set(previous_flat) - set(new_flat)),
+            'retyped': [],
+            'changed': [],
+        }
+        for path in sorted(set(previous_flat) & set(new_flat)):
+            previous_prop, new_prop = previous_flat[path], new_flat[path]
+            if cls.get_mapping_type(previous_prop) != cls.get_mapping_type(new_prop):
+                diff['retyped'].append(path)
+            elif cls.get_mapping_type(new_prop)[0] != 'object' and previous_prop != new_prop:
+                diff['changed'].append(path)  # changes of objects are those of their properties
+        return diff
+
+    @staticmethod
+    def diff_keys(previous, new):
+        """ Compares the given facets or columns.
+
+        :return: dict of 'added', 'removed' and 'changed' -> sorted list of facet/column keys
+        """
+        return {
+            'added': sorted(set(new) - set(previous)),
+            'removed': sorted(set(previous) - set(new)),
+            'changed': sorted(key for key in set(previous) & set(new) if previous[key] != new[key]),
+        }
+
+    @classmethod
+    def get_mapping_change(cls, diff):
+        """ Returns whether the given properties diff changes the Elasticsearch mapping: not at all,
+            additively (new fields only, no reindex needed) or breaking existing mappings (reindex needed). """
+        if diff['removed'] or diff['retyped']:
+            return cls.BREAKING_MAPPING_CHANGE
+        if diff['added']:
+            return cls.ADDITIVE_MAPPING_CHANGE
+        return cls.NO_MAPPING_CHANGE
+
+    def generate_report(self):
+        """ Generates the diff report of the mapping tables.
+
+        :return: dict with the versions of the tables, 'item_types', a dict of item type -> diff of its
+                 properties (see diff_properties), 'mapping_change', affected schema fragments under
+                 'properties' and 'facets'/'columns' diffs if generated from the table, and 'reindex_required',
+                 the list of item types whose mapping change is breaking
+        """
+        previous_items, new_items = self.previous.generate_item_properties(), self.new.generate_item_properties()
+        report = {
+            'previous_version': self.previous.version,
+            'version': self.new.version,
+            'item_types': {},
+            'reindex_required': [],
+        }
+        for item_type, new_item in new_items.items():
+            previous_item = previous_items.get(item_type, {})
+            new_props = new_item['properties']
+            item_report = self.diff_properties(previous_item.get('properties', {}), new_props)
+            item_report['mapping_change'] = self.get_mapping_change(item_report)
+            affected = {path.split('.')[0] for change in self.FIELD_CHANGES for path in item_report[change]}
+            item_report['properties'] = {name: new_props.get(name) for name in sorted(affected)}
+            for key in ['facets', 'columns']:
+                if key in new_item:
+                    item_report[key] = self.diff_keys(previous_item.get(key, {}), new_item[key])
+            if item_report['mapping_change'] == self.BREAKING_MAPPING_CHANGE:
+                report['reindex_required'].append(item_type)
+            report['item_types'][item_type] = item_report
+        return report
+
+    @staticmethod
+    def log_report(report):
+        """ Logs a summary of the given diff report. """
+        logger.info('Mapping table diff %s -> %s' % (report['previous_version'], report['version']))
+        for item_type, item_report in report['item_types'].items():
+            logger.info('%s: %s mapping change, %s' % (
+                item_type, item_report['mapping_change'],
+                ', '.join('%s %s' % (len(item_report[change]), change)
+                          for change in MappingTableDiff.FIELD_CHANGES)
+            ))
+        if report['reindex_required']:
+            logger.info('Reindex required for: %s' % ', '.join(report['reindex_required']))
+
+    @staticmethod
+    def write_report(report, fname):
+        """ Writes the given diff report (JSON) to the given file 'fname' """
+        with io.open(fname, 'w+') as out:
+            json.dump(report, out, indent=4)
+        logger.info('Successfully wrote mapping table diff report to file: %s\n' % fname)
@@ -2,20 +2,33 @@ import io
 import os
 import json
 import structlog
+from itertools import count, islice
 from tqdm import tqdm
-from snovault.ingestion.common import IngestionReport
+from uuid import uuid4
+from snovault.ingestion.common import IngestionError, IngestionReport
 from ..inheritance_mode import InheritanceMode
 from ..server_defaults import add_last_modified
 from snovault.loadxl import LOADXL_USER_UUID
-from ..types.variant import build_variant_display_title, ANNOTATION_ID_SEP, build_variant_sample_annotation_id
+from ..commands.parallel import ParallelTask
+from ..types.variant import build_variant_display_title, ANNOTATION_ID_SEP
 from ..types.structural_variant import build_structural_variant_display_title
 from ..util import resolve_file_path
 from .common import CGAP_CORE_PROJECT, CGAP_CORE_INSTITUTION
+from .ingestion_metrics import IngestionMetrics
 
 
 log = structlog.getLogger(__name__)
 
 
+FILE_INGESTION_CHECKPOINT = 'file_ingestion_checkpoint'  # field of the ingested file holding the checkpoint
+PARALLEL_BUILD_CHUNK_SIZE = 500  # records sent to a worker process at once when building in parallel
+INHERITANCE_BLOCK_SIZE = 500  # records whose inheritance modes are computed at once, see build_record_block
+DEFERRED_INDEXING_BATCH_SIZE = 5000  # uuids queued for indexing per request, see queue_deferred_indexing
+_PARALLEL_BUILDERS = {}  # builders created in this (worker) process, see ParallelRecordBuilder
+# var_conseq_name -> uuid of the variant consequences known to exist, see post_variant_consequence_items
+VARIANT_CONSEQUENCE_UUIDS = {}
+
+
 class IngestionConfigError(Exception):
     pass
 
@@ -49,16 +62,74 @@ class IngestionConfig:
                 raise IngestionConfigError('Required file location does not exist: %s' % field)
 
 
+class FamilyContext:
+    """ Sample relations of the VCF being ingested (as given by VariantBuilder.extract_sample_relations),
+        computed once per file and shared by all its records: samples appear in the same order in every
+        record, so which relation goes with each samplegeno entry is only looked up once.
+    """
+
+    def __init__(self, sample_relations):
+        self.sample_relations = sample_relations
+        self._relations_by_sample_ids = {}
+
+    @classmethod
+    def of(cls, sample_relations):
+        """ Returns the family context of the given sample relations, which may already be one. """
+        if isinstance(sample_relations, cls):
+            return sample_relations
+        return cls(sample_relations)
+
+    def get_relations(self, sample_ids):
+        """ Returns the relations of the given (tuple of) sample ids, None for samples without any. """
+        relations = self._relations_by_sample_ids.get(sample_ids)
+        if relations is None:
+            relations = self._relations_by_sample_ids[sample_ids] = [
+                self.sample_relations.get(sample_id) for sample_id in sample_ids
+            ]
+        return relations
+
+    def add_relations(self, samplegeno):
+        """ Adds familial relations (role, sex) to the given samplegeno entries in place. """
+        sample_ids = tuple(geno['samplegeno_sampleid'] for geno in samplegeno)
+        for geno, relation in zip(samplegeno, self.get_relations(sample_ids)):
+            if relation:
+                geno.update(relation)
+
+
+class VariantBuilderError(Exception):
+    """ To be thrown if a variant or variant sample could not be written """
+    pass
+
+
 class VariantBuilder:
     """ Class used globally to build variants/variant samples. """
-
-    def __init__(self, vapp, vcf_parser, file, project=CGAP_CORE_PROJECT, institution=CGAP_CORE_INSTITUTION):
+    VARIANT_ITEM_TYPE = 'variant'
+    VARIANT_SAMPLE_ITEM_TYPE = 'variant_sample'
+    STRUCTURAL_VARIANT = False  # passed to InheritanceMode
+    BULK_UPSERT_ENDPOINT = '/bulk_upsert'
+    QUEUE_INDEXING_ENDPOINT = '/queue_indexing'
+    VARIANT_CONSEQUENCE_ITEM_TYPE = 'variant_consequence'
+    VARIANT_CONSEQUENCE_FIELD = 'csq_consequence'  # transcript field linking variant consequences
+
+    def __init__(self, vapp, vcf_parser, file, project=CGAP_CORE_PROJECT, institution=CGAP_CORE_INSTITUTION,
+                 batch_size=None, skip_unchanged=False, processes=None, checkpoint_interval=None, resume=False,
+                 metrics=None, defer_indexing=False):
         self.vapp = vapp  # VirtualApp handle to application
         self.parser = vcf_parser  # VCF Parser
         self.project = project  # project/institution to post these items under
         self.institution = institution
         self.file = file  # source VCF file, should be the accession of a processed file
+        self.batch_size = batch_size  # if set, records are written in batches of this size through the bulk endpoint
+        self.skip_unchanged = skip_unchanged  # if set, existing items whose content is unchanged are not rewritten
+        self.processes = processes  # if more than 1, records are parsed and built in this many worker processes
+        self.checkpoint_interval = checkpoint_interval  # if set, progress is saved on the file every so many records
+        self.resume = resume  # if set, ingestion resumes from the checkpoint saved on the file, if any
+        self.resumed = False  # whether this ingestion resumed from a checkpoint
+        self.defer_indexing = defer_indexing  # if set, items written are queued for indexing once, in batches
+        self.deferred_uuids = {}  # uuids of the items written not queued for indexing yet, as an ordered set
+        self.consequence_uuids = VARIANT_CONSEQUENCE_UUIDS  # used to link consequences by uuid rather than name
         self.ingestion_report = IngestionReport()
+        self.metrics = metrics or IngestionMetrics()  # time spent in each stage of the ingestion
 
     def _add_project_and_institution(self, obj, variant=False):
         """ Helper function that adds project/institution to the given dict object. """
@@ -74,40 +145,29 @@ class VariantBuilder:
         """ Helper function that sets status to 'shared' on the given dict object. """
         obj['status'] = 'shared'
 
-    def _post_or_patch_variant(self, variant):
-        """ POST/PATCH the variant ie: create it if it doesn't exist, or update existing.
+    def _upsert_item(self, item_type, properties):
+        """ Creates the item or updates the existing item with the same annotation_id through the bulk
+            endpoint, which looks the item up by annotation_id rather than POSTing and PATCHing on failure.
             NOTE: snovault does not implement standard HTTP PUT.
+
+        :returns: result of the write, a dict with 'status' and 'uuid'
+        :raises: VariantBuilderError if the item could not be written
         """
-        try:
-            res = self.vapp.post_json('/variant', variant, status=201)
-        except Exception as e:  # noqa exceptions thrown by the above call are not reported correctly
-            log.info('Exception encountered on variant post (attempting patch): %s' % e)
-            res = self.vapp.patch_json('/variant/%s' % build_variant_display_title(
-                variant['CHROM'],
-                variant['POS'],
-                variant['REF'],
-                variant['ALT'],
-                sep=ANNOTATION_ID_SEP
-            ), variant, status=200)
-        return res.json
-
-    def _post_or_patch_variant_sample(self, variant_sample, variant_uuid):
-        """ POST/PATCH the variant_sample ie: create it if it doesn't exist, or update existing.
+        [result] = self._bulk_upsert([{'item_type': item_type, 'properties': properties}])
+        if 'error' in result:
+            raise VariantBuilderError('Could not write %s: %s' % (item_type, result['error']))
+        return result
+
+    def _upsert_variant(self, variant):
+        """ Creates or updates the variant, returning the result of the write. """
+        return self._upsert_item(self.VARIANT_ITEM_TYPE, variant)
+
+    def _upsert_variant_sample(self, variant_sample):
+        """ Creates or updates the variant sample, returning the result of the write.
             The VariantSample annotation_id format is (see variant.py):
                 "CALL_INFO:variant_uuid:file_accession"
-
-            NOTE: snovault does not implement standard HTTP PUT.
         """
-        try:
-            self.vapp.post_json('/variant_sample', variant_sample, status=201)
-        except Exception as e:  # noqa exceptions thrown by the above call are not reported correctly
-            log.info('Exception encountered on variant_sample post (attempting patch): %s' % e)
-            self.vapp.patch_json('/variant_sample/%s' %
-
-                                 build_variant_sample_annotation_id(variant_sample['CALL_INFO'],
-                                                                    variant_uuid, self.file),
-                                 variant_sample,
-                                 status=200)
+        return self._upsert_item(self.VARIANT_SAMPLE_ITEM_TYPE, variant_sample)
 
     def build_variant(self, record):
         """ Builds a raw variant from the given VCF record. """
@@ -115,6 +175,7 @@ class VariantBuilder:
         self._add_project_and_institution(raw_variant)
         self._set_shared_obj_status(raw_variant)
         self.parser.format_variant_sub_embedded_objects(raw_variant)
+        self.resolve_consequence_links(raw_variant)
         add_last_modified(raw_variant, userid=LOADXL_USER_UUID)
         return raw_variant
 
@@ -147,10 +208,15 @@ class VariantBuilder:
                     sample_relations[sample_id][key] = value
         return sample_relations
 
-    def build_variant_samples(self, variant, record, sample_relations):
-        """ Builds variant samples from the record row, returning the resulting samples. """
+    def build_variant_samples(self, variant, record, sample_relations, inheritance=True):
+        """ Builds variant samples from the record row, returning the resulting samples.
+
+        :param sample_relations: sample relations as given by extract_sample_relations, or their FamilyContext
+        :param inheritance: whether to add inheritance mode information, see add_inheritance_modes otherwise
+        """
         if variant is None:
             return []
+        family = FamilyContext.of(sample_relations)
         variant_samples = self.parser.create_sample_variant_from_record(record)
         for sample in variant_samples:
             sample['project'] = self.project
@@ -160,63 +226,453 @@ class VariantBuilder:
             sample['file'] = self.file
 
             # add familial relations to samplegeno field
-            for geno in sample.get('samplegeno', []):
-                sample_id = geno['samplegeno_sampleid']
-                if sample_id in sample_relations:
-                    geno.update(sample_relations[sample_id])
+            family.add_relations(sample.get('samplegeno', []))
 
             # add inheritance mode information
-            variant_name = sample['variant']
-            chrom = variant_name[variant_name.index('chr') + 3]  # find chr* and get *
-            sample.update(InheritanceMode.compute_inheritance_modes(sample, chrom=chrom))
+            if inheritance:
+                sample.update(InheritanceMode.compute_inheritance_modes(sample, chrom=variant['CHROM']))
             add_last_modified(variant, userid=LOADXL_USER_UUID)
         return variant_samples
 
     def post_variant_consequence_items(self):
-        """ Posts variant_consequence items under the given project/institution. Required for poasting variants.
+        """ Posts the variant_consequence items missing from the portal under the given project/institution,
+            in a single request/transaction through the bulk endpoint. Existing consequences are looked up
+            in a single query and left untouched, so this can be run on every ingestion. Required for posting
+            variants.
 
-        :param virtualapp: application_handle to post under
-        :param project: project to post under
-        :param institution: institution to post under
-=       """
+            The uuids of all the consequences (existing or created) are cached in this process, so variants
+            built afterwards link their consequences by uuid instead of by name, see resolve_consequence_links.
+
+        :returns: dict of var_conseq_name -> uuid of the consequences
+        """
         with io.open(resolve_file_path('annotations/variant_consequence.json'), 'r') as f:
             vcs = json.load(f)
-            for entry in vcs:
-                entry['project'] = self.project
-                entry['institution'] = self.institution
-                try:
-                    self.vapp.post_json('/variant_consequence', entry, status=201)
-                except Exception as e:  # can happen with master-inserts collision
-                    log.error('Failed to post variant consequence %s' % str(e))
+        for entry in vcs:
+            entry['project'] = self.project
+            entry['institution'] = self.institution
+        try:
+            res = self.vapp.post_json(self.BULK_UPSERT_ENDPOINT, {
+                'items': [{'item_type': self.VARIANT_CONSEQUENCE_ITEM_TYPE, 'properties': entry} for entry in vcs],
+                'skip_existing': True,
+            }, status=200)
+        except Exception as e:
+            log.error('Failed to post variant consequences: %s' % str(e))
+            return {}
+        consequence_uuids = {}
+        for entry, result in zip(vcs, res.json['@graph']):
+            if 'error' in result:
+                log.error('Failed to post variant consequence %s: %s' % (entry['var_conseq_name'], result['error']))
+                continue
+            consequence_uuids[entry['var_conseq_name']] = result['uuid']
+        self.consequence_uuids.update(consequence_uuids)
+        return consequence_uuids
+
+    def resolve_consequence_links(self, variant):
+        """ Replaces the names of the variant consequences linked by the transcripts of the given variant with
+            their uuids, where known, so these need not be looked up by name when the variant is validated. """
+        consequence_uuids = self.consequence_uuids
+        if not consequence_uuids:
+            return
+        for transcript in variant.get('transcript', []):
+            consequences = transcript.get(self.VARIANT_CONSEQUENCE_FIELD)
+            if consequences:
+                transcript[self.VARIANT_CONSEQUENCE_FIELD] = [
+                    consequence_uuids.get(consequence, consequence) for consequence in consequences
+                ]
+
+    def write_record(self, idx, variant, variant_samples):
+        """ Upserts the variant and variant samples built from the record at idx one item at a time,
+            marking the result on the ingestion report. """
+        try:
+            self._upsert_variant(variant)
+            for sample in variant_samples:
+                self._upsert_variant_sample(sample)
+            self.ingestion_report.mark_success()
+        except Exception as e:
+            log.info('Error encountered posting variant/variant_sample: %s' % e)
+            self.ingestion_report.mark_failure(body=str(e), row=idx)
+
+    def _bulk_upsert(self, items):
+        """ Writes the given items (dicts with 'item_type' and 'properties') in a single request/transaction
+            through the bulk endpoint, returning the per-item results in order. If self.defer_indexing is set,
+            items written are not queued for indexing, but kept to be queued by queue_deferred_indexing. """
+        endpoint = self.BULK_UPSERT_ENDPOINT
+        if self.defer_indexing:
+            endpoint += '?skip_indexing=true'
+        res = self.vapp.post_json(endpoint, {'items': items, 'skip_unchanged': self.skip_unchanged}, status=200)
+        results = res.json['@graph']
+        if self.defer_indexing:
+            self.defer_indexing_of(results)
+        return results
+
+    def defer_indexing_of(self, results):
+        """ Keeps the uuids of the items written (created or updated) with the given bulk upsert results, to
+            be queued for indexing by queue_deferred_indexing. Once resumed, unchanged items are kept too: those
+            were written after the last checkpoint of the interrupted ingestion, so may never have been queued.
+        """
+        statuses = ['created', 'updated', 'unchanged'] if self.resumed else ['created', 'updated']
+        deferred_uuids = self.deferred_uuids
+        for result in results:
+            if result.get('status') in statuses:
+                deferred_uuids[result['uuid']] = True
+
+    def queue_deferred_indexing(self):
+        """ Queues the items written since the last call for indexing (see defer_indexing_of), each once,
+            in requests of DEFERRED_INDEXING_BATCH_SIZE uuids. Associated items (ie: embedding the items
+            written) are found by the indexer, as when items are queued as they are written.
+
+        :returns: number of uuids queued
+        :raises: VirtualAppError if a request fails, uuids not queued yet being kept for the next call
+        """
+        uuids = list(self.deferred_uuids)
+        if not uuids:
+            return 0
+        with self.metrics.timer('queue_indexing', count=len(uuids)):
+            for start in range(0, len(uuids), DEFERRED_INDEXING_BATCH_SIZE):
+                batch = uuids[start:start + DEFERRED_INDEXING_BATCH_SIZE]
+                self.vapp.post_json(self.QUEUE_INDEXING_ENDPOINT,
+                                    {'uuids': batch, 'target_queue': 'primary', 'strict': False}, status=200)
+                for uuid in batch:
+                    del self.deferred_uuids[uuid]
+                self.metrics.increment('queued_for_indexing', len(batch))
+        return len(uuids)
+
+    def write_batch(self, batch):
+        """ Writes a batch of built records through the bulk endpoint, marking the result of each record
+            on the ingestion report. If the bulk write itself fails, falls back to writing the batch one
+            item at a time so a single bad record does not fail the whole batch.
+
+        :param batch: list of (idx, variant, variant_samples) 3-tuples
+        """
+        items = []
+        for _, variant, variant_samples in batch:
+            items.append({'item_type': self.VARIANT_ITEM_TYPE, 'properties': variant})
+            items.extend({'item_type': self.VARIANT_SAMPLE_ITEM_TYPE, 'properties': sample}
+                         for sample in variant_samples)
+        self.metrics.increment('batches')
+        try:
+            results = iter(self._bulk_upsert(items))
+        except Exception as e:
+            log.info('Error encountered in bulk write of %s records (writing individually): %s' % (len(batch), e))
+            self.metrics.increment('retries')
+            for idx, variant, variant_samples in batch:
+                self.write_record(idx, variant, variant_samples)
+            return
+        for idx, _, variant_samples in batch:
+            record_results = list(islice(results, 1 + len(variant_samples)))
+            errors = [result['error'] for result in record_results if 'error' in result]
+            if errors:
+                log.info('Error encountered writing variant/variant_sample: %s' % errors[0])
+                self.ingestion_report.mark_failure(body='; '.join(errors), row=idx)
+            else:
+                self.ingestion_report.mark_success()
 
-    def ingest_vcf(self, use_tqdm=False):
-        """ Ingests the VCF, building/posting variants and variant samples until done, creating a report
-            at the end of the run. """
-        sample_relations = self.extract_sample_relations()
-        for idx, record in enumerate(self.parser if not use_tqdm else tqdm(self.parser)):
+    def build_record(self, record, sample_relations, inheritance=True):
+        """ Builds the variant and variant samples from the given VCF record. """
+        variant = self.build_variant(record)
+        variant_samples = self.build_variant_samples(variant, record, sample_relations, inheritance=inheritance)
+        return variant, variant_samples
 
-            # build the items
+    def add_inheritance_modes(self, records):
+        """ Adds inheritance mode information to all the variant samples of the given built records at once.
+
+        :param records: list of (variant, variant_samples) 2-tuples, as returned by build_record
+        """
+        variant_samples, chroms = [], []
+        for variant, samples in records:
+            variant_samples.extend(samples)
+            chroms.extend([variant['CHROM']] * len(samples))
+        inheritance_modes = InheritanceMode.compute_inheritance_modes_batch(
+            variant_samples, chroms, structural_variant=self.STRUCTURAL_VARIANT
+        )
+        for variant_sample, fields in zip(variant_samples, inheritance_modes):
+            variant_sample.update(fields)
+
+    def build_record_block(self, block, sample_relations):
+        """ Builds the given block of VCF records, computing the inheritance modes of all their variant
+            samples at once (see InheritanceMode.compute_inheritance_modes_batch).
+
+        :param block: list of (idx, record) 2-tuples
+        :param sample_relations: sample relations as given by extract_sample_relations, or their FamilyContext
+        :returns: list of (idx, variant, variant_samples, error) 4-tuples as in build_records
+        """
+        family = FamilyContext.of(sample_relations)
+        results = []
+        with self.metrics.timer('build', count=len(block)):
+            for idx, record in block:
+                try:
+                    variant, variant_samples = self.build_record(record, family, inheritance=False)
+                except Exception as e:
+                    results.append((idx, None, None, str(e)))
+                    continue
+                results.append((idx, variant, variant_samples, None))
+        built = [(variant, variant_samples) for _, variant, variant_samples, error in results if error is None]
+        with self.metrics.timer('inheritance_modes', count=len(built)):
             try:
-                variant = self.build_variant(record)
-                variant_samples = self.build_variant_samples(variant, record, sample_relations)
+                self.add_inheritance_modes(built)
+            except Exception:
+                # redo them record by record so the error is only reported on the records causing it
+                results = [self._add_record_inheritance_modes(*result) for result in results]
+        return results
+
+    def _add_record_inheritance_modes(self, idx, variant, variant_samples, error):
+        """ Adds inheritance mode information to the variant samples of the given build_record_block result. """
+        if error is not None:
+            return idx, variant, variant_samples, error
+        try:
+            self.add_inheritance_modes([(variant, variant_samples)])
+        except Exception as e:
+            return idx, None, None, str(e)
+        return idx, variant, variant_samples, None
+
+    def skip_records(self, n):
+        """ Skips the next n records of the VCF without parsing them. """
+        for _ in islice(self.parser.iter_raw_records(), n):
+            pass
+
+    def build_records(self, sample_relations, start=0):
+        """ Generator that parses and builds the records of the VCF in order.
+
+        :param sample_relations: sample relations as given by extract_sample_relations
+        :param start: index of the record to start from, previous records are skipped
+        :returns: generator of (idx, variant, variant_samples, error) 4-tuples, where error is None
+                  or the message of the error encountered building the record at idx
+        """
+        family = FamilyContext.of(sample_relations)
+        self.skip_records(start)
+        block = []
+        try:
+            for idx, record in enumerate(self.metrics.timed_iter('parse', self.parser), start):
+                block.append((idx, record))
+                if len(block) == INHERITANCE_BLOCK_SIZE:
+                    block, full_block = [], block
+                    yield from self.build_record_block(full_block, family)
+        except Exception:
+            yield from self.build_record_block(block, family)  # records read before the malformed one
+            raise
+        yield from self.build_record_block(block, family)
+
+    def build_records_in_parallel(self, sample_relations, start=0):
+        """ Same as build_records, but raw records are parsed and built in self.processes worker
+            processes, a chunk of PARALLEL_BUILD_CHUNK_SIZE records at a time. Results are yielded
+            in record order, and only a few chunks per process are read ahead of them so memory stays
+            bounded regardless of the size of the VCF. Unlike build_records, a malformed record is
+            reported as an error on that record rather than aborting the ingestion.
+        """
+        self.skip_records(start)
+        raw_records = self.parser.iter_raw_records()
+
+        def chunks():
+            for chunk_start in count(start, PARALLEL_BUILD_CHUNK_SIZE):
+                lines = list(islice(raw_records, PARALLEL_BUILD_CHUNK_SIZE))
+                if not lines:
+                    return
+                yield chunk_start, lines
+
+        task = ParallelRecordBuilder(self, sample_relations)
+        parallel_task = ParallelTask(task, num_cpu=self.processes)
+        for results, stage_times, peak_rss_mb in parallel_task.run(chunks(), max_pending=2 * self.processes):
+            self.metrics.merge(stage_times, peak_rss_mb=peak_rss_mb)
+            yield from results
+
+    def get_file_path(self):
+        """ Returns the path of the ingested file, given by uuid or accession. """
+        return '/' + self.file
+
+    def get_checkpoint(self):
+        """ Returns the ingestion checkpoint saved on the ingested file, if any. """
+        file_meta = self.vapp.get(self.get_file_path() + '?frame=object&datastore=database').maybe_follow().json
+        return file_meta.get(FILE_INGESTION_CHECKPOINT)
+
+    def save_checkpoint(self, records, report=None):
+        """ Saves the progress of the ingestion on the ingested file, once the first records have been written.
+
+        :param records: number of records ingested, ingestion resumes from the record following these
+        :param report: ingestion report of these records, self.ingestion_report if not given
+        """
+        report = report or self.ingestion_report
+        checkpoint = {
+            'records': records,
+            'total_successful': report.total_successful(),
+            'total_errors': report.total_errors(),
+            'errors': report.get_errors(),
+        }
+        self.vapp.patch_json(self.get_file_path(), {FILE_INGESTION_CHECKPOINT: checkpoint}, status=200)
+
+    def clear_checkpoint(self):
+        """ Removes the checkpoint from the ingested file. """
+        self.vapp.patch_json(self.get_file_path() + '?delete_fields=%s' % FILE_INGESTION_CHECKPOINT, {}, status=200)
+
+    def restore_checkpoint(self, checkpoint):
+        """ Restores the ingestion report from the given checkpoint, returning the record to resume from. """
+        report = IngestionReport()
+        report.grand_total = checkpoint['total_successful'] + checkpoint['total_errors']
+        # only the first errors are kept on the checkpoint (as on the error report), so the remaining ones
+        # are only counted
+        report.errors = list(checkpoint.get('errors', []))
+        missing_errors = checkpoint['total_errors'] - len(report.errors)
+        report.errors.extend([IngestionError('Error details not kept on ingestion checkpoint', -1).to_dict()]
+                             * missing_errors)
+        self.ingestion_report = report
+        return checkpoint['records']
+
+    def checkpoint(self, records, last_checkpoint):
+        """ Saves a checkpoint if at least self.checkpoint_interval records were ingested since the last one.
+
+        :param records: number of records ingested
+        :param last_checkpoint: number of records ingested as of the last checkpoint
+        :returns: number of records ingested as of the last checkpoint, after this one
+        """
+        if not self.checkpoint_interval or records - last_checkpoint < self.checkpoint_interval:
+            return last_checkpoint
+        try:
+            if self.defer_indexing:  # before saving, so items written before the checkpoint are never lost
+                self.queue_deferred_indexing()
+            self.save_checkpoint(records)
+        except Exception as e:  # not being able to checkpoint should not fail the ingestion
+            log.error('Could not save ingestion checkpoint of %s: %s' % (self.file, e))
+            return last_checkpoint
+        return records
+
+    def queue_remaining_deferred_indexing(self, last_checkpoint):
+        """ Queues the items written since the last checkpoint for indexing at the end of the ingestion. If they
+            cannot be queued, the failure is reported as an ingestion error and the checkpoint is kept (saved at
+            the first record if none was) so ingesting the file again resumes from it, queueing all items written
+            since, unchanged ones included (see defer_indexing_of).
+
+        :param last_checkpoint: number of records ingested as of the last checkpoint
+        :returns: True if the items were queued, False otherwise
+        """
+        try:
+            self.queue_deferred_indexing()
+            return True
+        except Exception as e:
+            msg = 'Could not queue %s items of %s for indexing: %s' % (len(self.deferred_uuids), self.file, e)
+            log.error(msg)
+            self.ingestion_report.mark_failure(body=msg, row=-1)
+        if not last_checkpoint:
+            try:
+                self.save_checkpoint(0, report=IngestionReport())
             except Exception as e:
-                log.info('Error encountered building variant/variant_sample: %s' % e)
-                self.ingestion_report.mark_failure(body=str(e), row=idx)
+                log.error('Could not save ingestion checkpoint of %s: %s' % (self.file, e))
+        return False
+
+    def ingest_vcf(self, use_tqdm=False):
+        """ Ingests the VCF, building/posting variants and variant samples until done, creating a report
+            at the end of the run. If self.batch_size is set, items are written through the bulk endpoint
+            in batches of that many records. If self.processes is more than 1, records are parsed and
+            built in that many worker processes. If self.checkpoint_interval is set, progress is saved on
+            the ingested file as records are written, and if self.resume is set, ingestion resumes from
+            the saved progress. If self.defer_indexing is set, items written are queued for indexing at every
+            checkpoint and at the end of the ingestion rather than one at a time as they are written; their
+            uuids are held in memory until then, so without self.checkpoint_interval those of the whole run are.
+            The time spent in each stage is recorded on self.metrics. """
+        metrics = self.metrics
+        start = 0
+        if self.resume:
+            checkpoint = self.get_checkpoint()
+            if checkpoint:
+                start = self.restore_checkpoint(checkpoint)
+                self.resumed = True
+                log.info('Resuming ingestion of %s from record %s' % (self.file, start))
+        with metrics.timer('sample_relations'):
+            sample_relations = self.extract_sample_relations()
+        if self.processes and self.processes > 1:
+            built_records = self.build_records_in_parallel(sample_relations, start=start)
+        else:
+            built_records = self.build_records(sample_relations, start=start)
+        batch = []
+        last_checkpoint = start
+        for idx, variant, variant_samples, error in (built_records if not use_tqdm else tqdm(built_records)):
+            metrics.increment(metrics.RECORDS)
+
+            # report items that could not be built
+            if error is not None:
+                log.info('Error encountered building variant/variant_sample: %s' % error)
+                self.ingestion_report.mark_failure(body=error, row=idx)
                 continue
 
             # Post/Patch Variants/Samples
-            try:
-                variant_response = self._post_or_patch_variant(variant)
-                variant_uuid = variant_response['@graph'][0]['uuid']
-                for sample in variant_samples:
-                    self._post_or_patch_variant_sample(sample, variant_uuid)
-                self.ingestion_report.mark_success()
-            except Exception as e:
-                log.info('Error encountered posting variant/variant_sample: %s' % e)
-                self.ingestion_report.mark_failure(body=str(e), row=idx)
+            metrics.increment('variant_samples', len(variant_samples))
+            if not self.batch_size:
+                with metrics.timer('write'):
+                    self.write_record(idx, variant, variant_samples)
+                last_checkpoint = self.checkpoint(idx + 1, last_checkpoint)
+                continue
+            batch.append((idx, variant, variant_samples))
+            if len(batch) >= self.batch_size:
+                with metrics.timer('write', count=len(batch)):
+                    self.write_batch(batch)
+                batch = []
+                last_checkpoint = self.checkpoint(idx + 1, last_checkpoint)
+        if batch:
+            with metrics.timer('write', count=len(batch)):
+                self.write_batch(batch)
+        queued = self.queue_remaining_deferred_indexing(last_checkpoint) if self.defer_indexing else True
+        if queued and (last_checkpoint or self.resumed):  # complete, so later ingestions of this file start over
+            self.clear_checkpoint()
+        metrics.counters['errors'] = self.ingestion_report.total_errors()
         return self.ingestion_report.total_successful(), self.ingestion_report.total_errors()
 
 
+class ParallelRecordBuilder:
+    """ Task building variants/variant samples from chunks of raw VCF records in worker processes.
+        Only the configuration needed to re-create the builder is pickled and sent to the workers;
+        each worker process creates the builder (and its parser) once and reuses it for all chunks.
+    """
+
+    def __init__(self, builder, sample_relations):
+        parser = builder.parser
+        self.key = uuid4().hex  # identifies this task's builder in the worker processes
+        self.builder_class = type(builder)
+        self.parser_class = type(parser)
+        self.reader_class = type(parser.reader)
+        self.header_lines = parser.get_header_lines()
+        self.schemas = (parser.variant_schema_path, parser.variant_sample_schema_path)
+        self.file = builder.file
+        self.project = builder.project
+        self.institution = builder.institution
+        self.consequence_uuids = builder.consequence_uuids
+        self.family = FamilyContext.of(sample_relations)
+
+    def get_builder(self):
+        """ Returns the builder for this task in the current process, creating it if needed. """
+        builder = _PARALLEL_BUILDERS.get(self.key)
+        if builder is None:
+            _PARALLEL_BUILDERS.clear()  # builders of previous ingestions are no longer needed
+            parser = self.parser_class.from_header_lines(self.header_lines, *self.schemas,
+                                                         reader_class=self.reader_class)
+            builder = self.builder_class(None, parser, self.file, project=self.project,
+                                         institution=self.institution)
+            builder.consequence_uuids = self.consequence_uuids
+            _PARALLEL_BUILDERS[self.key] = builder
+        return builder
+
+    def __call__(self, chunk):
+        """ Parses and builds the given chunk of raw records.
+
+        :param chunk: 2-tuple of the index of the first record in the chunk and the raw record lines
+        :returns: 3-tuple of the list of (idx, variant, variant_samples, error) 4-tuples as in
+                  VariantBuilder.build_records, the time spent in each stage and the peak memory use of this
+                  worker process while building the chunk, see IngestionMetrics.merge
+        """
+        start, lines = chunk
+        builder = self.get_builder()
+        builder.metrics = metrics = IngestionMetrics()
+        errors, block = [], []
+        with metrics.timer('parse', count=len(lines)):
+            for idx, line in enumerate(lines, start):
+                try:
+                    block.append((idx, builder.parser.parse_raw_record(line)))
+                except Exception as e:
+                    errors.append((idx, None, None, str(e)))
+        results = builder.build_record_block(block, self.family)
+        if errors:
+            results = sorted(results + errors, key=lambda result: result[0])
+        metrics.sample_rss()
+        return results, metrics.get_stage_times(), metrics.peak_rss_mb
+
+
 class StructuralVariantBuilderError(Exception):
     pass
 
@@ -227,57 +683,9 @@ class StructuralVariantBuilder(VariantBuilder):
     updated methods for SVs and a validation method to catch possible
     bioinformatics errors unique to SVs.
     """
-
-    def _post_or_patch_variant(self, variant):
-        """ POST/PATCH the structural variant ie: create it if it doesn't exist,
-            or update existing.
-
-            NOTE: snovault does not implement standard HTTP PUT.
-        """
-        try:
-            res = self.vapp.post_json("/structural_variant", variant, status=201)
-        except Exception as e:  # noqa exceptions thrown by the above call are not reported correctly
-            log.info(
-                "Exception encountered on structural_variant post (attempting patch): %s"
-                % e
-            )
-            res = self.vapp.patch_json(
-                "/structural_variant/%s" % build_structural_variant_display_title(
-                    variant["SV_TYPE"],
-                    variant["CHROM"],
-                    variant["START"],
-                    variant["END"],
-                ),
-                variant,
-                status=200
-            )
-        return res.json
-
-    def _post_or_patch_variant_sample(self, variant_sample, variant_uuid):
-        """ POST/PATCH the structural_variant_sample ie: create it if it doesn't
-            exist, or update existing.
-
-            The StructuralVariantSample annotation_id format is
-                "CALL_INFO:structural_variant_uuid:file_accession"
-
-            NOTE: snovault does not implement standard HTTP PUT.
-        """
-        try:
-            self.vapp.post_json("/structural_variant_sample", variant_sample, status=201)
-        except Exception as e:  # noqa exceptions thrown by the above call are not reported correctly
-            log.info(
-                "Exception encountered on structural_variant_sample post"
-                " (attempting patch): %s" % e
-            )
-            self.vapp.patch_json(
-                "/structural_variant_sample/%s" % (
-                    build_variant_sample_annotation_id(
-                        variant_sample["CALL_INFO"], variant_uuid, self.file,
-                    )
-                ),
-                variant_sample,
-                status=200,
-            )
+    VARIANT_ITEM_TYPE = 'structural_variant'
+    VARIANT_SAMPLE_ITEM_TYPE = 'structural_variant_sample'
+    STRUCTURAL_VARIANT = True
 
     def _validate_structural_variant(self, variant):
         """
@@ -309,16 +717,22 @@ class StructuralVariantBuilder(VariantBuilder):
         self._add_project_and_institution(raw_variant)
         self._set_shared_obj_status(raw_variant)
         self.parser.format_variant_sub_embedded_objects(raw_variant)
+        self.resolve_consequence_links(raw_variant)
         add_last_modified(raw_variant, userid=LOADXL_USER_UUID)
         return raw_variant
 
-    def build_variant_samples(self, variant, record, sample_relations):
+    def build_variant_samples(self, variant, record, sample_relations, inheritance=True):
         """
         Builds structural variant samples from the record row, returning
         the resulting samples.
+
+        :param sample_relations: sample relations as given by
+            extract_sample_relations, or their FamilyContext
+        :param inheritance: whether to add inheritance mode information
         """
         if variant is None:
             return []
+        family = FamilyContext.of(sample_relations)
         variant_samples = self.parser.create_sample_variant_from_record(record)
         for sample in variant_samples:
             sample["project"] = self.project
@@ -331,18 +745,14 @@ class StructuralVariantBuilder(VariantBuilder):
             self.parser.format_variant_sub_embedded_objects(sample, sample=True)
 
             # add familial relations to samplegeno field
-            for geno in sample.get("samplegeno", []):
-                sample_id = geno["samplegeno_sampleid"]
-                if sample_id in sample_relations:
-                    geno.update(sample_relations[sample_id])
+            family.add_relations(sample.get("samplegeno", []))
 
             # add inheritance mode information
-            variant_name = sample["structural_variant"]
-            chrom = variant_name[variant_name.index("chr") + 3]  # find chr* and get *
-            inheritance_modes = InheritanceMode.compute_inheritance_modes(
-                sample, chrom=chrom, structural_variant=True
-            )
-            sample.update(inheritance_modes)
+            if inheritance:
+                inheritance_modes = InheritanceMode.compute_inheritance_modes(
+                    sample, chrom=variant["CHROM"], structural_variant=True
+                )
+                sample.update(inheritance_modes)
             add_last_modified(sample, userid=LOADXL_USER_UUID)
         return variant_samples
 
@@ -0,0 +1,335 @@
+"""
+Lightweight alternative to the records of vcf.Reader (PyVCF) for ingestion.
+
+PyVCF builds a _Record for every VCF row, casting every INFO field and every sample call (a _Call with a
+namedtuple of its data) up front, although ingestion only reads some INFO fields and re-splits annotation
+strings itself. LazyVCFReader reads the header exactly as vcf.Reader does, but gives records that only
+split the INFO field into raw key/value strings, casting a value the first time it is read, and that keep
+sample calls as raw strings until their data is read. Values read are the same as PyVCF's.
+
+PreprocessedVCFReader reads the same records from a compact binary file written by VCF preprocessing
+(commands.preprocess_vcf) instead of VCF text: the header lines, then one length-prefixed marshal record
+per variant with its fields and INFO already split, so reading the file skips text parsing altogether.
+This is an internal format, only read by the process (ie: ingestion listener) that wrote it.
+"""
+import marshal
+import mmap
+import struct
+
+import vcf
+
+from vcf.parser import RESERVED_INFO
+
+
+PREPROCESSED_MAGIC = b'CGAPVCF1'  # first bytes of a preprocessed records file
+RECORD_LENGTH = struct.Struct('<I')  # prefix of every record, length of its marshal data
+
+# Version of PyVCF (dcicpyvcf) this module is written against, checked by test_vcf_reader. The readers below
+# override how vcf.Reader parses records, so rely on its internals (ie: _parse_filter, _map). vcf.Reader has no
+# public API either to get its header lines back, to read raw record lines or to parse a line given to it, so
+# the functions below use its _header_lines, _column_headers and reader, the iterator over the raw record lines
+# not read yet (which vcf.Reader.fetch also reassigns). Ingestion only accesses these through those functions.
+PYVCF_VERSION = '3.1'
+
+
+def get_reader_header_lines(reader):
+    """ Returns the header lines read by the given vcf.Reader, the #CHROM line included, from which a reader
+        of the same VCF can be created. """
+    column_headers = reader._column_headers + reader.samples  # noQA - see PYVCF_VERSION
+    return reader._header_lines + ['#' + '\t'.join(column_headers)]  # noQA - see PYVCF_VERSION
+
+
+def get_raw_records(reader):
+    """ Returns the iterator over the raw record lines the given vcf.Reader has not read yet. """
+    return reader.reader  # see PYVCF_VERSION
+
+
+def set_raw_records(reader, records):
+    """ Has the given vcf.Reader read its next records from the given iterator over raw record lines. """
+    reader.reader = records  # see PYVCF_VERSION
+
+
+class LazyVCFInfo:
+    """ INFO field of a LazyVCFRecord, read like the INFO dict of a PyVCF record. """
+    __slots__ = ('_raw', '_values', '_reader')
+
+    def __init__(self, raw, reader):
+        self._raw = raw  # INFO key -> raw value string, None for flags
+        self._values = {}  # INFO key -> value cast so far
+        self._reader = reader
+
+    def get(self, key, default=None):
+        values = self._values
+        if key in values:
+            return values[key]
+        raw = self._raw
+        if key not in raw:  # most keys looked up are not there, so no exceptions here
+            return default
+        value = values[key] = self._reader.cast_info_value(key, raw[key])
+        return value
+
+    def __getitem__(self, key):
+        if key not in self._raw:
+            raise KeyError(key)
+        return self.get(key)
+
+    def __contains__(self, key):
+        return key in self._raw
+
+    def __iter__(self):
+        return iter(self._raw)
+
+    def __len__(self):
+        return len(self._raw)
+
+    def keys(self):
+        return self._raw.keys()
+
+    def values(self):
+        return [self.get(key) for key in self._raw]
+
+    def items(self):
+        return [(key, self.get(key)) for key in self._raw]
+
+    def __eq__(self, other):
+        return dict(self.items()) == other
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+
+class LazyVCFCall:
+    """ Sample call of a LazyVCFRecord, read like a PyVCF _Call: data is parsed the first time it is read. """
+    __slots__ = ('site', 'sample', '_raw', '_data')
+
+    def __init__(self, site, sample, raw):
+        self.site = site  # LazyVCFRecord of this call
+        self.sample = sample  # sample name
+        self._raw = raw
+        self._data = None
+
+    @property
+    def data(self):
+        """ Namedtuple of the data of this call, as in PyVCF. """
+        if self._data is None:
+            self._data = self.site.reader.parse_call_data(self.site.FORMAT, self._raw)
+        return self._data
+
+    def __repr__(self):
+        return "Call(sample=%s, %s)" % (self.sample, str(self.data))
+
+
+class LazyVCFRecord:
+    """ VCF record with the attributes of a PyVCF _Record read by ingestion. """
+    __slots__ = ('CHROM', 'POS', 'ID', 'REF', 'ALT', 'QUAL', 'FILTER', 'INFO', 'FORMAT', 'reader', '_samples',
+                 '_calls')
+
+    def __init__(self, reader, chrom, pos, ID, ref, alt, qual, filt, info, fmt, samples):
+        self.reader = reader
+        self.CHROM = chrom
+        self.POS = pos
+        self.ID = ID
+        self.REF = ref
+        self.ALT = alt
+        self.QUAL = qual
+        self.FILTER = filt
+        self.INFO = info
+        self.FORMAT = fmt
+        self._samples = samples  # raw sample call strings
+        self._calls = None
+
+    @property
+    def samples(self):
+        """ List of the LazyVCFCall of each sample, as in PyVCF. """
+        if self._calls is None:
+            if self.FORMAT is None:
+                self._calls = []
+            else:
+                self._calls = [LazyVCFCall(self, name, raw) for name, raw in zip(self.reader.samples, self._samples)]
+        return self._calls
+
+    def __repr__(self):
+        return "Record(CHROM=%(CHROM)s, POS=%(POS)s, REF=%(REF)s, ALT=%(ALT)s)" % {
+            field: getattr(self, field) for field in ['CHROM', 'POS', 'REF', 'ALT']
+        }
+
+
+class LazyVCFReader(vcf.Reader):
+    """ vcf.Reader giving LazyVCFRecords. Takes the same arguments as vcf.Reader. """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._info_types = {}  # INFO key -> (type, whether single valued), see get_info_type
+
+    def get_info_type(self, key, has_value):
+        """ Returns the 2-tuple of the type of the given INFO key and whether it is single valued,
+            as PyVCF resolves it from the header. """
+        info_type = self._info_types.get(key)
+        if info_type is None:
+            header = self.infos.get(key)
+            if header is not None:
+                info_type = (header.type, header.num == 1)
+            elif key in RESERVED_INFO:
+                info_type = (RESERVED_INFO[key], False)
+            else:
+                info_type = ('String' if has_value else 'Flag', False)
+            if header is not None or key in RESERVED_INFO:  # otherwise depends on has_value
+                self._info_types[key] = info_type
+        return info_type
+
+    def cast_info_value(self, key, raw):
+        """ Casts the given raw value of the given INFO key as PyVCF does.
+
+        :param key: INFO key
+        :param raw: raw value string, None if the key has no value
+        :returns: cast value
+        """
+        entry_type, single = self.get_info_type(key, raw is not None)
+        if entry_type == 'Flag' or (raw is None and entry_type in ('String', 'Character')):
+            return True
+        vals = raw.split(',')
+        if entry_type == 'Integer':
+            try:
+                val = self._map(int, vals)
+            except ValueError:  # allow specified integers to be flexibly parsed as floats
+                val = self._map(float, vals)
+        elif entry_type == 'Float':
+            val = self._map(float, vals)
+        else:  # String or Character, the only other types of the header
+            val = self._map(str, vals)
+        return val[0] if single else val
+
+    def parse_call_data(self, samp_fmt, raw):
+        """ Parses the raw data of a sample call with the given FORMAT as PyVCF does, returning its namedtuple. """
+        if samp_fmt not in self._format_cache:
+            self._format_cache[samp_fmt] = self._parse_sample_format(samp_fmt)
+        samp_fmt = self._format_cache[samp_fmt]
+        fields, nums, types = samp_fmt._fields, samp_fmt._nums, samp_fmt._types
+        sampdat = [None] * len(fields)
+        for i, vals in enumerate(raw.split(':')):
+            field = fields[i]
+            if field == 'GT':
+                sampdat[i] = vals
+                continue
+            elif field == 'FT':
+                sampdat[i] = self._parse_filter(vals)
+                continue
+            elif not vals or vals == '.':
+                continue
+            entry_type = types[i]
+            if nums[i] == 1:
+                if entry_type == 'Integer':
+                    try:
+                        sampdat[i] = int(vals)
+                    except ValueError:
+                        sampdat[i] = float(vals)
+                elif entry_type == 'Float' or entry_type == 'Numeric':
+                    sampdat[i] = float(vals)
+                else:
+                    sampdat[i] = vals
+                continue
+            vals = vals.split(',')
+            if entry_type == 'Integer':
+                try:
+                    sampdat[i] = self._map(int, vals)
+                except ValueError:
+                    sampdat[i] = self._map(float, vals)
+            elif entry_type == 'Float' or entry_type == 'Numeric':
+                sampdat[i] = self._map(float, vals)
+            else:
+                sampdat[i] = vals
+        return samp_fmt(*sampdat)
+
+    @staticmethod
+    def split_info(info_str):
+        """ Splits the given INFO field into a dict of key -> raw value string (None for flags). """
+        if info_str == '.':
+            return {}
+        return LazyVCFReader.split_info_entries(info_str.split(';'))
+
+    @staticmethod
+    def split_info_entries(entries):
+        """ Splits the given key=value INFO entries into a dict of key -> raw value string (None for flags). """
+        raw = {}
+        for entry in entries:
+            key, sep, value = entry.partition('=')
+            raw[key] = value if sep else None
+        return raw
+
+    def make_record(self, chrom, pos, ID, ref, alt, qual, filt, raw_info, fmt, samples):
+        """ Returns the LazyVCFRecord of the given raw VCF fields.
+
+        :param pos: position, as int
+        :param raw_info: INFO field split into a dict of key -> raw value string, see split_info
+        :param fmt: FORMAT field, None if there are no samples
+        :param samples: list of the raw sample call strings
+        """
+        if self._prepend_chr:
+            chrom = 'chr' + chrom
+        alt = self._map(self._parse_alt, alt.split(','))
+        try:
+            qual = int(qual)
+        except ValueError:
+            try:
+                qual = float(qual)
+            except ValueError:
+                qual = None
+        return LazyVCFRecord(self, chrom, pos, ID if ID != '.' else None, ref, alt, qual, self._parse_filter(filt),
+                             LazyVCFInfo(raw_info, self), fmt if fmt != '.' else None, samples)
+
+    def __next__(self):
+        """ Returns the next record of the VCF. """
+        line = next(self.reader)
+        if self._separator == '\t' or ' ' not in line:
+            row = line.rstrip().split('\t')
+        else:
+            row = self._row_pattern.split(line.rstrip())
+        return self.make_record(row[0], int(row[1]), row[2], row[3], row[4], row[5], row[6], self.split_info(row[7]),
+                                row[8] if len(row) > 8 else None, row[9:])
+
+
+def write_preprocessed_record(fo, record):
+    """ Writes the given record to the binary buffer fo of a preprocessed records file, length-prefixed. """
+    data = marshal.dumps(record)
+    fo.write(RECORD_LENGTH.pack(len(data)))
+    fo.write(data)
+
+
+def write_preprocessed_header(fo, header_lines):
+    """ Writes the start of a preprocessed records file to binary buffer fo: magic bytes, then the VCF header lines
+        (the last one being the #CHROM line), as a record. """
+    fo.write(PREPROCESSED_MAGIC)
+    write_preprocessed_record(fo, list(header_lines))
+
+
+def iter_preprocessed_records(buffer, offset=0):
+    """ Generator over the raw (marshal data) records of the given buffer of preprocessed records,
+        starting at offset. """
+    size, end = RECORD_LENGTH.size, len(buffer)
+    while offset < end:
+        length, = RECORD_LENGTH.unpack_from(buffer, offset)
+        offset += size
+        yield buffer[offset:offset + length]
+        offset += length
+
+
+class PreprocessedVCFReader(LazyVCFReader):
+    """ LazyVCFReader reading a preprocessed records file, see open. As for vcf.Reader, raw records not read
+        yet are given by self.reader, so created from header lines (ie: by VCFParser.from_header_lines),
+        it parses raw records given to it. """
+
+    @classmethod
+    def open(cls, path):
+        """ Returns a reader of the preprocessed records file at path, memory-mapped. """
+        with open(path, 'rb') as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if buffer[:len(PREPROCESSED_MAGIC)] != PREPROCESSED_MAGIC:
+            raise ValueError('%s is not a preprocessed records file' % path)
+        records = iter_preprocessed_records(buffer, len(PREPROCESSED_MAGIC))
+        reader = cls(iter(marshal.loads(next(records))))
+        set_raw_records(reader, records)
+        return reader
+
+    def __next__(self):
+        """ Returns the next record of the file. """
+        return self.make_record(*marshal.loads(next(self.reader)))
@@ -2,6 +2,8 @@ import vcf
 import json
 import logging
 from collections import OrderedDict
+from functools import cached_property, partial
+from .vcf_reader import get_raw_records, get_reader_header_lines, set_raw_records
 # from granite.lib import vcf_parser
 
 logger = logging.getLogger(__name__)
@@ -102,19 +104,20 @@ class VCFParser(object):
     BOOLEAN_TRUE = ["1", "YES", True]
     BOOLEAN_FALSE = ["0", "-1", "", False]
 
-    def __init__(self, _vcf, variant, sample, reader=None):
+    def __init__(self, _vcf, variant, sample, reader=None, reader_class=vcf.Reader):
         """ Constructor for the parser
 
         :param _vcf: path to vcf to process
         :param variant: path to variant schema to read
         :param sample: path to variant_sample schema to read
         :param reader: if specified will ignore path passed and set reader directly
+        :param reader_class: class of the reader of the vcf at path, ie: vcf_reader.LazyVCFReader
         :raises: Parsing error within 'vcf' if given VCF is malformed
         """
         if reader is not None:
             self.reader = reader
         else:
-            self.reader = vcf.Reader(open(_vcf, 'r'))
+            self.reader = reader_class(open(_vcf, 'r'))
         self._initialize(variant, sample)
 
     def _initialize(self, variant, sample):
@@ -123,6 +126,8 @@ class VCFParser(object):
             :param variant: path to variant schema
             :param sample: path variant_sample schema
         """
+        self.variant_schema_path = variant
+        self.variant_sample_schema_path = sample
         self.variant_schema = json.load(open(variant, 'r'))
         self.variant_sample_schema = json.load(open(sample, 'r'))
         self.annotation_keys = OrderedDict()  # list of INFO fields that contain annotation fields
@@ -130,6 +135,8 @@ class VCFParser(object):
         self.sub_embedded_mapping = OrderedDict()  # denotes which INFO fields belong in a SEO
         self.read_vcf_metadata()
         self.parse_vcf_fields()
+        self.variant_cast_plan = self.compile_variant_cast_plan()
+        self.variant_sample_casters = self.compile_variant_sample_casters()
 
     def __iter__(self):
         """ Return generator to VCF rows """
@@ -145,21 +152,21 @@ class VCFParser(object):
         """ Variant sample schema properties """
         return self.variant_sample_schema['properties']
 
-    @property
+    @cached_property
     def variant_sub_embedded_fields(self):
         """ Fields in the variant properties that are nested """
         return [prop for prop in self.variant_props.keys()
                 if self.variant_props[prop].get('type', None) == 'array' and
                 self.variant_props[prop]['items']['type'] == 'object']
 
-    @property
+    @cached_property
     def variant_sample_sub_embedded_fields(self):
         """ Fields in the variant sample properties that are nested """
         return [prop for prop in self.variant_sample_props.keys()
                 if self.variant_sample_props[prop].get('type', None) == 'array' and
                 self.variant_sample_props[prop]['items']['type'] == 'object']
 
-    @property
+    @cached_property
     def variant_defaults(self):
         """ Acquires all default values for *top-level* fields on variant """
         _defaults = {}
@@ -170,7 +177,7 @@ class VCFParser(object):
                 _defaults[name] = props['default']
         return _defaults
 
-    @property
+    @cached_property
     def variant_sample_defaults(self):
         """ Acquires all default values for *top-level* fields on variant sample """
         _defaults = {}
@@ -297,6 +304,41 @@ class VCFParser(object):
         """
         return next(self.reader)
 
+    def get_header_lines(self):
+        """ Returns the header lines of the VCF, from which a parser for the same VCF
+            can be re-created (ie: in another process) with from_header_lines.
+        """
+        return get_reader_header_lines(self.reader)
+
+    @classmethod
+    def from_header_lines(cls, header_lines, variant, sample, reader_class=vcf.Reader):
+        """ Creates a parser for a VCF from its header lines only. Records are then
+            given to parse_raw_record rather than read from a file.
+
+        :param header_lines: VCF header lines, as given by get_header_lines
+        :param variant: path to variant schema to read
+        :param sample: path to variant_sample schema to read
+        :param reader_class: class of the reader parsing the records
+        :return: parser for the VCF
+        """
+        return cls(None, variant, sample, reader=reader_class(iter(header_lines)))
+
+    def iter_raw_records(self):
+        """ Returns an iterator over the raw (unparsed) VCF record lines not read yet.
+            Like read_next_record, this is stateful with respect to the VCF reader.
+        """
+        return get_raw_records(self.reader)
+
+    def parse_raw_record(self, line):
+        """ Parses the given raw VCF record line as read by iter_raw_records into a record,
+            as if it had been read from this parser's VCF.
+
+        :param line: raw VCF record line
+        :return: parsed record
+        """
+        set_raw_records(self.reader, iter([line]))
+        return next(self.reader)
+
     def get_sub_embedded_label(self, annotation):
         """ Gets the sub_embedded_group of the given annotation type
 
@@ -346,10 +388,42 @@ class VCFParser(object):
         # uncomment below to enable: tolerate using '.' in vcf spec for single valued fields
         # if isinstance(val, list) and len(val) == 1 and isinstance(val[0], str):
         #     val = val[0]
+        if '%' not in val:  # all restricted characters are percent-encoded
+            return val
         for encoded, decoded in self.RESTRICTED_CHARACTER_ENCODING.items():
             val = val.replace(encoded, decoded)
         return val
 
+    @staticmethod
+    def cast_integer(value):
+        """ Casts the given value to an integer """
+        try:
+            return int(value)
+        except ValueError:  # required if casting string->float->int, such as '0.000'
+            return int(float(value))  # throw exception here if need be
+
+    @staticmethod
+    def cast_number(value):
+        """ Casts the given value to a float """
+        try:
+            return float(value)
+        except Exception:
+            try:
+                return float(value[0])
+            except Exception:  # XXX: This shouldn't happen but does in case of malformed entries, see uk10k_esp_maf
+                return 0.0
+
+    def cast_boolean(self, value):
+        """ Casts the given value to a boolean """
+        if value in self.BOOLEAN_FALSE:
+            return False
+        elif value in self.BOOLEAN_TRUE:
+            return True
+        else:
+            raise VCFParserException(
+                "Received an unexpected value for a boolean: %s." % value
+            )
+
     def cast_field_value(self, t, value, sub_type=None):
         """ Casts the given value to the type given by 'type'
 
@@ -367,27 +441,11 @@ class VCFParser(object):
         if t == 'string':
             return self.fix_encoding(value)
         elif t == 'integer':
-            try:
-                return int(value)
-            except ValueError:  # required if casting string->float->int, such as '0.000'
-                return int(float(value))  # throw exception here if need be
+            return self.cast_integer(value)
         elif t == 'number':
-            try:
-                return float(value)
-            except Exception:
-                try:
-                    return float(value[0])
-                except Exception:  # XXX: This shouldn't happen but does in case of malformed entries, see uk10k_esp_maf
-                    return 0.0
+            return self.cast_number(value)
         elif t == 'boolean':
-            if value in self.BOOLEAN_FALSE:
-                return False
-            elif value in self.BOOLEAN_TRUE:
-                return True
-            else:
-                raise VCFParserException(
-                    "Received an unexpected value for a boolean: %s." % value
-                )
+            return self.cast_boolean(value)
         elif t == 'array':
             if sub_type:
                 if not isinstance(value, list):
@@ -400,20 +458,49 @@ class VCFParser(object):
         else:
             raise VCFParserException('Type was %s and not one of: string, integer, number, boolean, array' % t)
 
-    def validate_variant_value(self, field, value, key='', exit_on_validation=False):
-        """ Given a field, check the variant schema for the type of that field and cast
-        the given value to that type. This constitutes our 'validation' step
+    def compile_caster(self, t, sub_type=None):
+        """ Returns a function of a value equivalent to cast_field_value(t, value, sub_type), resolving
+            the type once rather than on every value.
+
+        Args:
+            t: type to cast values to
+            sub_type: should be present if t is an array
+
+        Returns:
+            function casting a value
+        """
+        if t == 'string':
+            return self.fix_encoding
+        elif t == 'integer':
+            return self.cast_integer
+        elif t == 'number':
+            return self.cast_number
+        elif t == 'boolean':
+            return self.cast_boolean
+        elif t == 'array' and sub_type:
+            cast_item = self.compile_caster(sub_type)
+            fix_encoding = self.fix_encoding
+
+            def cast_array(value):
+                items = fix_encoding(value).split('&') if not isinstance(value, list) else value
+                return [cast_item(v) for v in items]
+
+            return cast_array
+        return partial(self.cast_field_value, t, sub_type=sub_type)  # raises once used, as cast_field_value would
+
+    def get_variant_field_type(self, field, key='', exit_on_validation=False):
+        """ Given a field, check the variant schema for the type of that field.
 
         Args:
             field: name of the field we are looking to process. This should exist somewhere
             in the schema properties either at the top level or as a sub-embedded object
-            value: value of the field to be cast
             key: annotation field (sub-embedded) that this field is part of
             exit_on_validation: boolean flag to determine whether or not we bail if
             we fail validation in this step. Default to False
 
         Returns:
-            casted value
+            2-tuple of the type and array item type (or None) of the field, or None if the
+            field is not to be set on the variant
 
         Raises:
             VCFParserException if the given field does not exist
@@ -446,8 +533,97 @@ class VCFParser(object):
         # if this field is specifically disabled (due to formatting error), drop it here
         if field in self.DISABLED_FIELDS:
             return None
+        return t, sub_type
+
+    def validate_variant_value(self, field, value, key='', exit_on_validation=False):
+        """ Given a field, check the variant schema for the type of that field and cast
+        the given value to that type. This constitutes our 'validation' step
+
+        Args:
+            field: name of the field we are looking to process. This should exist somewhere
+            in the schema properties either at the top level or as a sub-embedded object
+            value: value of the field to be cast
+            key: annotation field (sub-embedded) that this field is part of
+            exit_on_validation: boolean flag to determine whether or not we bail if
+            we fail validation in this step. Default to False
+
+        Returns:
+            casted value
+
+        Raises:
+            VCFParserException if the given field does not exist
+        """
+        field_type = self.get_variant_field_type(field, key=key, exit_on_validation=exit_on_validation)
+        if field_type is None:
+            return None
+        t, sub_type = field_type
         return self.cast_field_value(t, value, sub_type)
 
+    def compile_variant_caster(self, field, key=''):
+        """ Returns a function casting values of the given field as validate_variant_value would,
+            or None if the field is not to be set on the variant.
+        """
+        field_type = self.get_variant_field_type(field, key=key)
+        if field_type is None:
+            return None
+        return self.compile_caster(*field_type)
+
+    def compile_variant_cast_plan(self):
+        """ Compiles, once per VCF, how every INFO field of a record is cast and where it is placed on
+            the variant, so that create_variant_from_record does not look up the schema for every value.
+            Called by the constructor.
+
+        Returns:
+            list, in self.format order, of 4-tuples (INFO key, caster, sub_embedded_group, field_plan):
+                - for non-annotation fields, caster casts the whole value and the rest is None
+                - for annotation fields, caster is None, sub_embedded_group is the group the fields are
+                  nested under (None if not sub-embedded) and field_plan gives, for each field index,
+                  None if the field is dropped or a 3-tuple of the (overwritten) field name, its caster
+                  (None if not on the schema) and whether it is placed on the top level of the variant
+        """
+        plan = []
+        for key in self.format.keys():
+
+            # handle non-annotation fields
+            if key not in self.annotation_keys:
+                caster = self.compile_variant_caster(key)
+                if caster is not None:
+                    plan.append((key, caster, None, None))
+                continue
+
+            # drop if variant_sample sub-embedded field
+            sub_embedded_group = self.sub_embedded_mapping.get(key, None)
+            if sub_embedded_group in self.variant_sample_sub_embedded_fields:
+                continue
+
+            # handle annotation fields
+            field_plan = []
+            for fn in self.format[key]:
+                if fn == self.DROPPED_FIELD:
+                    field_plan.append(None)
+                    continue
+
+                # if the field we are processing is an overwrite field, apply the overwrite
+                if fn in self.OVERWRITE_FIELDS:
+                    fn = self.OVERWRITE_FIELDS[fn]
+                field_plan.append((fn, self.compile_variant_caster(fn, key), fn in self.variant_props))
+            plan.append((key, None, sub_embedded_group, field_plan))
+        return plan
+
+    def compile_variant_sample_casters(self):
+        """ Compiles, once per VCF, the casters of variant_sample fields set from INFO fields.
+            Called by the constructor.
+
+        Returns:
+            dict of variant_sample field -> caster
+        """
+        casters = {}
+        for field, props in self.variant_sample_props.items():
+            prop_type = props.get('type')
+            sub_type = props['items']['type'] if prop_type == 'array' else None
+            casters[field] = self.compile_caster(prop_type, sub_type)
+        return casters
+
     @staticmethod
     def get_record_attribute(record, field):
         return getattr(record, field, None)
@@ -490,64 +666,49 @@ class VCFParser(object):
                 if attr is not None:
                     result[vcf_key] = attr
 
-        for key in self.format.keys():
-
-            # handle non-annotation fields
-            if key not in self.annotation_keys:
-                if record.INFO.get(key, None):
-                    val = self.validate_variant_value(key, record.INFO.get(key), exit_on_validation=False)
-                    if val is not None:
-                        result[key] = val
+        info = record.INFO
+        for key, caster, sub_embedded_group, field_plan in self.variant_cast_plan:
+            raw = info.get(key, None)
+            if not raw:
                 continue
 
-            # drop if variant_sample sub-embedded field
-            sub_embedded_group = self.sub_embedded_mapping.get(key, None)
-            if sub_embedded_group in self.variant_sample_sub_embedded_fields:
+            # handle non-annotation fields
+            if field_plan is None:
+                result[key] = caster(raw)
                 continue
 
             # handle annotation fields
-            raw = record.INFO.get(key, None)
-            if raw:
-                annotations = self.parse_annotation_field_value(raw)
-            else:
-                continue
+            annotations = self.parse_annotation_field_value(raw)
             # annotation could be multi-valued split into groups
             for g_idx, group in enumerate(annotations):
 
                 # in nearly all cases there are multiple fields. match them
-                # up with format
+                # up with the compiled format
                 for f_idx, field in enumerate(group):
-                    if field:
-                        fn = self.format[key][f_idx]
-                        if fn == self.DROPPED_FIELD:
-                            continue
-
-                        # if the field we are processing is an overwrite field, apply the overwrite
-                        if fn in self.OVERWRITE_FIELDS:
-                            fn = self.OVERWRITE_FIELDS[fn]
-
-                        # handle sub-embedded
-                        if key in self.sub_embedded_mapping:
-                            if sub_embedded_group not in result:  # create sub-embedded group if not there
-                                result[sub_embedded_group] = {}
-                            if g_idx not in result[sub_embedded_group]:
-                                result[sub_embedded_group][g_idx] = {}
-
-                            # XXX: Special Behavior here in light of VEP annotations
-                            # VEP duplicates annotations in the same CSQ INFO field, so while some fields
-                            # vary by VEP transcript, a large set of others (that are in our data set)
-                            # do not and are duplicated in every transcript entry. Detect when this occurs
-                            # and place the field value at top level instead of in the transcript object.
-                            possible_value = self.validate_variant_value(fn, field, key)
-                            if possible_value is not None:
-                                if fn in self.variant_props:
-                                    result[fn] = self.validate_variant_value(fn, field, key)
-                                else:
-                                    result[sub_embedded_group][g_idx][fn] = self.validate_variant_value(fn, field, key)
-                        else:
-                            possible_value = self.validate_variant_value(fn, field, key)
-                            if possible_value is not None:
-                                result[fn] = possible_value
+                    if not field:
+                        continue
+                    field_entry = field_plan[f_idx]
+                    if field_entry is None:  # dropped field
+                        continue
+                    fn, caster, top_level = field_entry
+
+                    # handle sub-embedded
+                    if sub_embedded_group is not None:
+                        # create sub-embedded group if not there
+                        sub_embedded = result.setdefault(sub_embedded_group, {}).setdefault(g_idx, {})
+
+                        # XXX: Special Behavior here in light of VEP annotations
+                        # VEP duplicates annotations in the same CSQ INFO field, so while some fields
+                        # vary by VEP transcript, a large set of others (that are in our data set)
+                        # do not and are duplicated in every transcript entry. Detect when this occurs
+                        # and place the field value at top level instead of in the transcript object.
+                        if caster is not None:
+                            if top_level:
+                                result[fn] = caster(field)
+                            else:
+                                sub_embedded[fn] = caster(field)
+                    elif caster is not None:
+                        result[fn] = caster(field)
         return dict(self.variant_defaults, **result)  # copy defaults, merge in result
 
     @staticmethod
@@ -605,17 +766,15 @@ class VCFParser(object):
             a (dict) sample_variant item
         """
         result = []
+        # INFO values are the same for all samples, so only look them up once
+        info = record.INFO
+        info_values = {field: info.get(field) for field in self.variant_sample_props.keys()}
         for sample in record.samples:
             s = {}
             for field in self.variant_sample_props.keys():
-                if record.INFO.get(field) is not None:  # first check INFO tag, then check record attributes
-                    val = record.INFO.get(field)
-                    prop_type = self.variant_sample_props[field]['type']
-                    if prop_type == 'array':
-                        sub_type = self.variant_sample_props[field]['items']['type']
-                        s[field] = self.cast_field_value(prop_type, val, sub_type)
-                    else:
-                        s[field] = self.cast_field_value(prop_type, val)
+                info_value = info_values[field]
+                if info_value is not None:  # first check INFO tag, then check record attributes
+                    s[field] = self.variant_sample_casters[field](info_value)
                 if field in self.VCF_SAMPLE_FIELDS:
                     if field == 'FILTER':  # XXX: default to PASS, should handle on all fields generally
                         if getattr(record, field):
@@ -627,7 +786,7 @@ class VCFParser(object):
 
                 # Special variant sample fields
                 if field == 'samplegeno':
-                    genotypes = record.INFO.get('SAMPLEGENO')
+                    genotypes = info.get('SAMPLEGENO')
                     s['samplegeno'] = []
                     for gt in genotypes:
                         numgt, gt, ad, sample_id, ac = gt.split('|')
@@ -639,7 +798,7 @@ class VCFParser(object):
                         tmp['samplegeno_ac'] = int(ac)  # must be cast to int
                         s['samplegeno'].append(tmp)
                 elif field == 'cmphet':
-                    comhet = record.INFO.get('comHet', None)
+                    comhet = info.get('comHet', None)
                     if comhet:
                         s['cmphet'] = []
                         field_names = self.format['comHet']
@@ -736,7 +895,18 @@ class StructuralVariantVCFParser(VCFParser):
     SUB_TYPE = "sub_type"
     FILTER_DEFAULT = "PASS"
 
-    @property
+    def _initialize(self, variant, sample):
+        """ Does initialization other than reading/validating the vcf, also
+            compiling where annotation fields are found in the VCF.
+
+            :param variant: path to variant schema
+            :param sample: path variant_sample schema
+        """
+        super()._initialize(variant, sample)
+        self.annotation_field_indexes = self.compile_annotation_field_indexes()
+        self._record_annotations = (None, {})  # see get_record_annotations
+
+    @cached_property
     def variant_vcf_props(self):
         """
         Dictionary of VCF fields in variant schema with key, value
@@ -746,7 +916,7 @@ class StructuralVariantVCFParser(VCFParser):
         """
         return self.parse_props_for_vcf_info(self.variant_props)
 
-    @property
+    @cached_property
     def variant_sample_vcf_props(self):
         """
         Dictionary of VCF fields in variant sample schema with key,
@@ -757,7 +927,7 @@ class StructuralVariantVCFParser(VCFParser):
         """
         return self.parse_props_for_vcf_info(self.variant_sample_props)
 
-    @property
+    @cached_property
     def variant_sub_embedded_groups(self):
         """
         Extracts all sub-embedded groups present from VCF fields
@@ -772,7 +942,7 @@ class StructuralVariantVCFParser(VCFParser):
                 result.append(sub_embedded_group)
         return result
 
-    @property
+    @cached_property
     def variant_sample_sub_embedded_groups(self):
         """
         Extracts all sub-embedded groups present from VCF fields
@@ -883,6 +1053,47 @@ class StructuralVariantVCFParser(VCFParser):
         entries = list(map(lambda f: hdr.id.lower() + '_' + self._strip(f), entries))
         return entries
 
+    def compile_annotation_field_indexes(self):
+        """
+        Compiles, once per VCF, in which annotation INFO fields each
+        annotation field is found and at which index of their values.
+        Called by the constructor.
+
+        :returns: dict of field -> list of (annotation INFO key, index)
+            2-tuples, in self.annotation_keys order
+        """
+        result = {}
+        for annotation in self.annotation_keys:
+            fields = self.format.get(annotation)
+            if not fields:
+                continue
+            for idx, field in enumerate(fields):
+                field_indexes = result.setdefault(field, [])
+                if not field_indexes or field_indexes[-1][0] != annotation:  # first index only, as list.index
+                    field_indexes.append((annotation, idx))
+        return result
+
+    def get_record_annotations(self, record, annotation):
+        """
+        Returns the values of the given annotation INFO field of the
+        record as given by self.parse_annotation_field_value, or None if
+        the record has none. Values are split once per record, then
+        reused for all schema fields (of the variant and its samples).
+
+        :param record: class representing one VCF entry
+        :param annotation: str annotation INFO key
+        """
+        cached_record, annotations = self._record_annotations
+        if cached_record is not record:
+            annotations = {}
+            self._record_annotations = (record, annotations)
+        if annotation not in annotations:
+            annotation_items = record.INFO.get(annotation)
+            if annotation_items:
+                annotation_items = self.parse_annotation_field_value(annotation_items)
+            annotations[annotation] = annotation_items or None
+        return annotations[annotation]
+
     def add_result_value(
             self, result, schema_key, schema_props, field_value, index=None
     ):
@@ -1018,17 +1229,14 @@ class StructuralVariantVCFParser(VCFParser):
                 field_value = record.INFO.get(vcf_field)
                 self.add_result_value(result, schema_key, schema_props, field_value)
             else:  # INFO annotation fields
-                field_not_found = True
-                for annotation in self.annotation_keys:
-                    if vcf_field in self.format[annotation]:
-                        field_not_found = False
-                        annotation_items = record.INFO.get(annotation)
+                field_indexes = self.annotation_field_indexes.get(vcf_field)
+                if field_indexes:
+                    for annotation, vcf_field_idx in field_indexes:
+                        annotation_items = self.get_record_annotations(
+                            record, annotation
+                        )
                         if not annotation_items:
                             continue
-                        annotation_items = self.parse_annotation_field_value(
-                            annotation_items
-                        )
-                        vcf_field_idx = self.format[annotation].index(vcf_field)
                         for idx, annotation_item in enumerate(annotation_items):
                             field_value = annotation_item[vcf_field_idx]
                             self.add_result_value(
@@ -1043,7 +1251,7 @@ class StructuralVariantVCFParser(VCFParser):
                                 # annotation items.
                                 break
                         break
-                if field_not_found:
+                else:
                     # vcf_field not found in any areas of the VCF. This shouldn't
                     # happen with an up-to-date mapping table and correctly processed
                     # VCF, but there may be remnant fields that we don't want to
@@ -1,4 +1,6 @@
+import numpy as np
 import structlog
+from functools import lru_cache
 
 
 log = structlog.getLogger(__name__)
@@ -73,6 +75,37 @@ class InheritanceMode:
     # value related constants
     DE_NOVO_STRONG_CUTOFF = .9
     DE_NOVO_MEDIUM_CUTOFF = .1
+    NOVOPP_MISSING = -1
+    NOVOPP_SEX_CHROMOSOME_ERROR = "novoPP is different from 0 or -1 on sex chromosome: %s"
+
+    # number of distinct family genotype combinations whose labels/inheritance modes are remembered
+    FAMILY_INHERITANCE_CACHE_SIZE = 4096
+
+    # Codes used by the batch (array) API, see compute_trio_inheritance_batch. Genotypes are encoded as
+    # allele1 * GENOTYPE_CODE_BASE + allele2, or GENOTYPE_CODE_MISSING, and the other values by their index
+    # in the lists below.
+    GENOTYPE_CODE_MISSING = -1
+    GENOTYPE_CODE_BASE = 1024
+    BATCH_ROLES = [SELF, MOTHER, FATHER]
+    CHROMOSOME_CLASSES = [AUTOSOME, 'X', 'Y']
+    GENOTYPE_LABELS = [
+        GENOTYPE_LABEL_DOT, GENOTYPE_LABEL_00, GENOTYPE_LABEL_0M, GENOTYPE_LABEL_MM, GENOTYPE_LABEL_MN,
+        GENOTYPE_LABEL_0, GENOTYPE_LABEL_M, GENOTYPE_LABEL_FEMALE_CHRY, GENOTYPE_LABEL_SEX_INCONSISTENT,
+        GENOTYPE_LABEL_SEX_AMBIGUOUS,
+    ]
+    TRIO_INHERITANCE_MODES = [
+        [], [INHMODE_LABEL_DE_NOVO_STRONG], [INHMODE_LABEL_DE_NOVO_MEDIUM], [INHMODE_LABEL_DE_NOVO_WEAK],
+        [INHMODE_LABEL_DE_NOVO_CHRXY], [INHMODE_LABEL_SV_DE_NOVO], [INHMODE_DOMINANT_FATHER],
+        [INHMODE_DOMINANT_MOTHER], [INHMODE_LABEL_RECESSIVE], [INHMODE_LABEL_X_LINKED_RECESSIVE],
+        [INHMODE_LABEL_X_LINKED_RECESSIVE, INHMODE_LABEL_X_LINKED_DOMINANT_MOTHER],
+        [INHMODE_LABEL_X_LINKED_DOMINANT_MOTHER], [INHMODE_LABEL_X_LINKED_DOMINANT_FATHER],
+        [INHMODE_LABEL_Y_LINKED], [INHMODE_LABEL_LOH],
+    ]
+    OTHER_INHERITANCE_MODES = [
+        [INHMODE_LABEL_NONE_DOT], [INHMODE_LABEL_NONE_MN], [INHMODE_LABEL_NONE_SEX_INCONSISTENT],
+        [INHMODE_LABEL_NONE_SEX_AMBIGUOUS], [INHMODE_LABEL_NONE_HOMOZYGOUS_PARENT],
+        [INHMODE_LABEL_NONE_HEMIZYGOUS_PARENT], [INHMODE_LABEL_NONE_BOTH_PARENTS], [INHMODE_LABEL_NONE_OTHER],
+    ]
 
     @staticmethod
     def is_sex_chromosome(chrom):
@@ -243,7 +276,7 @@ class InheritanceMode:
                 and ((genotypes[cls.SELF] == '0/1' and sexes[cls.SELF] == cls.FEMALE and chrom == 'X')
                      or (genotypes[cls.SELF] == '1/1' and sexes[cls.SELF] == cls.MALE and chrom != cls.AUTOSOME))):
             if novoPP > 0:
-                raise ValueError("novoPP is different from 0 or -1 on sex chromosome: %s" % novoPP)
+                raise ValueError(cls.NOVOPP_SEX_CHROMOSOME_ERROR % novoPP)
             if novoPP == -1 and not structural_variant:
                 return [cls.INHMODE_LABEL_DE_NOVO_CHRXY]
 
@@ -412,18 +445,16 @@ class InheritanceMode:
         if cls.SELF not in genotypes:
             raise InheritanceModeError('Role "proband" not present in genotypes: %s' % genotypes)
 
-        genotype_labels = cls.compute_family_genotype_labels(genotypes, sexes, chrom)
-        inheritance_modes = cls.compute_inheritance_mode_trio(
-            genotypes=genotypes,
-            genotype_labels=genotype_labels,
-            sexes=sexes,
+        genotype_labels, inheritance_modes, other_inheritance_modes = cls.compute_family_inheritance(
+            genotypes=tuple(genotypes.items()),
+            sexes=tuple(sexes.items()),
             chrom=chrom,
             novoPP=novoPP,
             structural_variant=structural_variant,
         )
-        inheritance_modes += cls.compute_cmphet_inheritance_modes(cmphet)
+        inheritance_modes = inheritance_modes + cls.compute_cmphet_inheritance_modes(cmphet)
         if len(inheritance_modes) == 0:
-            inheritance_modes = cls.inheritance_modes_other_labels(genotypes, genotype_labels)
+            inheritance_modes = other_inheritance_modes
 
         new_fields = {
             'genotype_labels': cls.build_genotype_label_structure(genotype_labels, sample_ids),
@@ -431,3 +462,280 @@ class InheritanceMode:
         }
 
         return new_fields
+
+    @classmethod
+    def novoPP_class(cls, novoPP):
+        """ Returns a value of novoPP that compute_inheritance_mode_trio treats the same as the given one, so
+            results computed for it can be reused: only the de novo cutoffs novoPP falls between matter.
+            Values other than numbers (ie: None or '.' if missing) are returned as is, as
+            compute_inheritance_mode_trio returns early without comparing them for no-calls or missing roles. """
+        if not isinstance(novoPP, (int, float)):
+            return novoPP
+        if novoPP > cls.DE_NOVO_STRONG_CUTOFF:
+            return 1
+        if novoPP > cls.DE_NOVO_MEDIUM_CUTOFF:
+            return cls.DE_NOVO_MEDIUM_CUTOFF * 2
+        if novoPP > 0:
+            return cls.DE_NOVO_MEDIUM_CUTOFF / 2
+        if novoPP == cls.NOVOPP_MISSING:
+            return cls.NOVOPP_MISSING
+        return 0
+
+    @classmethod
+    def compute_family_inheritance(cls, *, genotypes, sexes, chrom, novoPP, structural_variant=False):
+        """ Computes the genotype labels and (trio) inheritance modes of a family. Families of a VCF share a
+            handful of distinct genotype combinations, so results are computed once per combination.
+
+        :param genotypes: tuple of (role, genotype) pairs
+        :param sexes: tuple of (role, sex) pairs
+        :param chrom: chromosome class, one of 'X', 'Y' or AUTOSOME
+        :param novoPP: novoCaller post-posterior probability
+        :param structural_variant: boolean True for SVs
+        :returns: 3-tuple of genotype_labels (dictionary of role -> list of genotype labels), inheritance modes
+                  of the trio and inheritance modes to give instead if there are none otherwise
+        """
+        try:
+            genotype_labels, inheritance_modes, other_inheritance_modes = cls._compute_family_inheritance(
+                genotypes, sexes, chrom, cls.novoPP_class(novoPP), structural_variant
+            )
+        except ValueError:  # raised for the novoPP class, so report the actual novoPP
+            raise ValueError(cls.NOVOPP_SEX_CHROMOSOME_ERROR % novoPP) from None
+        # results are shared between calls, so hand out copies
+        genotype_labels = {role: list(labels) for role, labels in genotype_labels.items()}
+        return genotype_labels, list(inheritance_modes), list(other_inheritance_modes)
+
+    @classmethod
+    @lru_cache(maxsize=FAMILY_INHERITANCE_CACHE_SIZE)
+    def _compute_family_inheritance(cls, genotypes, sexes, chrom, novoPP, structural_variant):
+        """ Memoized implementation of compute_family_inheritance, see there. """
+        genotypes, sexes = dict(genotypes), dict(sexes)
+        genotype_labels = cls.compute_family_genotype_labels(genotypes, sexes, chrom)
+        inheritance_modes = cls.compute_inheritance_mode_trio(
+            genotypes=genotypes,
+            genotype_labels=genotype_labels,
+            sexes=sexes,
+            chrom=chrom,
+            novoPP=novoPP,
+            structural_variant=structural_variant,
+        )
+        other_inheritance_modes = cls.inheritance_modes_other_labels(genotypes, genotype_labels)
+        return genotype_labels, inheritance_modes, other_inheritance_modes
+
+    @classmethod
+    def encode_genotype(cls, gt):
+        """ Encodes the given genotype for the batch API, ie: "0/1" -> 1, "./." -> GENOTYPE_CODE_MISSING.
+
+        :param gt: single genotype ex: "0/1"
+        :returns: genotype code, or None if the genotype is not in the canonical "<int>/<int>" form
+        """
+        allele1, _, allele2 = gt.partition('/')
+        if allele1 == cls.MISSING:
+            return cls.GENOTYPE_CODE_MISSING
+        if not (allele1.isdigit() and allele2.isdigit()) or str(int(allele1)) != allele1 \
+                or str(int(allele2)) != allele2:
+            return None
+        allele1, allele2 = int(allele1), int(allele2)
+        if allele1 >= cls.GENOTYPE_CODE_BASE or allele2 >= cls.GENOTYPE_CODE_BASE:
+            return None
+        return allele1 * cls.GENOTYPE_CODE_BASE + allele2
+
+    @staticmethod
+    def _select(values, checks, default):
+        """ Returns the array of the codes (index in values) of the value of the first check that holds for each
+            element, or of default if none does.
+
+        :param values: list of the possible values
+        :param checks: list of (boolean array, value) pairs
+        :param default: value if no check holds
+        """
+        return np.select([condition for condition, _ in checks], [values.index(value) for _, value in checks],
+                         default=values.index(default))
+
+    @classmethod
+    def compute_trio_inheritance_batch(cls, *, genotypes, sexes, chroms, novoPP, structural_variant=False):
+        """ Array version of compute_family_genotype_labels/compute_inheritance_mode_trio/
+            inheritance_modes_other_labels, computing the genotype labels and inheritance modes of a block of
+            trios (one per record) at once.
+
+        :param genotypes: int array of shape (n, 3), genotype codes (see encode_genotype) of BATCH_ROLES
+        :param sexes: int array of shape (n, 3), sex codes (index in SEXES) of BATCH_ROLES
+        :param chroms: int array of shape (n,), chromosome class codes (index in CHROMOSOME_CLASSES)
+        :param novoPP: float array of shape (n,), novoCaller post-posterior probabilities
+        :param structural_variant: boolean True for SVs
+        :returns: 5-tuple of arrays:
+                    - genotype label codes (index in GENOTYPE_LABELS) of shape (n, 3)
+                    - multiallelic site flags, whose trios get GENOTYPE_LABEL_MN_ADDON added to their labels
+                    - trio inheritance mode codes (index in TRIO_INHERITANCE_MODES)
+                    - inheritance mode codes to use if there are none otherwise (index in OTHER_INHERITANCE_MODES)
+                    - flags of the trios compute_inheritance_mode_trio raises a ValueError for (de novo on a
+                      sex chromosome with 0 < novoPP), whose results are not to be used
+        """
+        genotypes = np.asarray(genotypes)
+        sexes = np.asarray(sexes)
+        chroms = np.asarray(chroms)[:, None]
+        novoPP = np.asarray(novoPP, dtype=float)
+        base = cls.GENOTYPE_CODE_BASE
+
+        # genotype labels, in the order of the checks of compute_genotype_label
+        missing = genotypes == cls.GENOTYPE_CODE_MISSING
+        allele1, allele2 = genotypes // base, genotypes % base
+        male, female, unknown = (sexes == cls.SEXES.index(sex) for sex in [cls.MALE, cls.FEMALE, cls.UNKNOWN])
+        chr_y = chroms == cls.CHROMOSOME_CLASSES.index('Y')
+        sex_chrom = chroms != cls.CHROMOSOME_CLASSES.index(cls.AUTOSOME)
+        ref_ref = (allele1 == 0) & (allele2 == 0)
+        labels = cls._select(cls.GENOTYPE_LABELS, [
+            (missing & female & chr_y, cls.GENOTYPE_LABEL_FEMALE_CHRY),
+            (missing, cls.GENOTYPE_LABEL_DOT),
+            (female & chr_y & ref_ref, cls.GENOTYPE_LABEL_FEMALE_CHRY),
+            (female & chr_y, cls.GENOTYPE_LABEL_SEX_INCONSISTENT),
+            (unknown & sex_chrom, cls.GENOTYPE_LABEL_SEX_AMBIGUOUS),
+            (male & sex_chrom & (allele1 != allele2), cls.GENOTYPE_LABEL_SEX_INCONSISTENT),
+            (male & sex_chrom & (allele1 == 0), cls.GENOTYPE_LABEL_0),
+            (male & sex_chrom, cls.GENOTYPE_LABEL_M),
+            (ref_ref, cls.GENOTYPE_LABEL_00),
+            (allele1 == 0, cls.GENOTYPE_LABEL_0M),
+            (allele1 == allele2, cls.GENOTYPE_LABEL_MM),
+        ], default=cls.GENOTYPE_LABEL_MN)
+        multiallelic = (~missing & ((allele1 > 1) | (allele2 > 1))).any(axis=1)
+
+        def has_label(label):
+            return (labels == cls.GENOTYPE_LABELS.index(label)).any(axis=1)
+
+        def role_has_label(role, label):
+            return labels[:, cls.BATCH_ROLES.index(role)] == cls.GENOTYPE_LABELS.index(label)
+
+        def role_has_gt(role, gt):
+            return genotypes[:, cls.BATCH_ROLES.index(role)] == cls.encode_genotype(gt)
+
+        chrom = chroms[:, 0]
+        autosome = chrom == cls.CHROMOSOME_CLASSES.index(cls.AUTOSOME)
+        chr_x = chrom == cls.CHROMOSOME_CLASSES.index('X')
+        chr_y = chrom == cls.CHROMOSOME_CLASSES.index('Y')
+        self_male = male[:, cls.BATCH_ROLES.index(cls.SELF)]
+        self_female = female[:, cls.BATCH_ROLES.index(cls.SELF)]
+        mother_00, mother_01, mother_11 = (role_has_gt(cls.MOTHER, gt) for gt in ['0/0', '0/1', '1/1'])
+        father_00, father_01, father_11 = (role_has_gt(cls.FATHER, gt) for gt in ['0/0', '0/1', '1/1'])
+        self_01, self_11 = (role_has_gt(cls.SELF, gt) for gt in ['0/1', '1/1'])
+        father_hemizygous = role_has_label(cls.FATHER, cls.GENOTYPE_LABEL_M)
+        self_hemizygous = role_has_label(cls.SELF, cls.GENOTYPE_LABEL_M)
+        parents_ref_ref = mother_00 & father_00
+        de_novo_chrxy = parents_ref_ref & ((self_01 & self_female & chr_x) | (self_11 & self_male & ~autosome))
+
+        # inheritance modes, in the order of the checks of compute_inheritance_mode_trio
+        no_call = (has_label(cls.GENOTYPE_LABEL_DOT) | multiallelic
+                   | has_label(cls.GENOTYPE_LABEL_SEX_INCONSISTENT) | has_label(cls.GENOTYPE_LABEL_SEX_AMBIGUOUS))
+        modes = cls._select(cls.TRIO_INHERITANCE_MODES, [
+            (no_call, []),
+            (novoPP > cls.DE_NOVO_STRONG_CUTOFF, [cls.INHMODE_LABEL_DE_NOVO_STRONG]),
+            (novoPP > cls.DE_NOVO_MEDIUM_CUTOFF, [cls.INHMODE_LABEL_DE_NOVO_MEDIUM]),
+            ((novoPP > 0) & parents_ref_ref & self_01 & autosome, [cls.INHMODE_LABEL_DE_NOVO_WEAK]),
+            (de_novo_chrxy & (novoPP == cls.NOVOPP_MISSING) & (not structural_variant),
+             [cls.INHMODE_LABEL_DE_NOVO_CHRXY]),
+            (parents_ref_ref & (self_01 | self_11) & structural_variant, [cls.INHMODE_LABEL_SV_DE_NOVO]),
+            (mother_00 & role_has_label(cls.FATHER, cls.GENOTYPE_LABEL_0M) & self_01, [cls.INHMODE_DOMINANT_FATHER]),
+            (mother_01 & father_00 & self_01 & autosome, [cls.INHMODE_DOMINANT_MOTHER]),
+            (mother_01 & father_01 & self_11, [cls.INHMODE_LABEL_RECESSIVE]),
+            (mother_01 & father_11 & self_11 & self_female & chr_x, [cls.INHMODE_LABEL_X_LINKED_RECESSIVE]),
+            (mother_01 & father_00 & self_11 & self_male & chr_x,
+             [cls.INHMODE_LABEL_X_LINKED_RECESSIVE, cls.INHMODE_LABEL_X_LINKED_DOMINANT_MOTHER]),
+            (mother_01 & father_00 & self_01 & self_female & chr_x, [cls.INHMODE_LABEL_X_LINKED_DOMINANT_MOTHER]),
+            (mother_00 & father_11 & self_01 & self_female & chr_x, [cls.INHMODE_LABEL_X_LINKED_DOMINANT_FATHER]),
+            (father_hemizygous & chr_y & self_hemizygous, [cls.INHMODE_LABEL_Y_LINKED]),
+            (((mother_01 & father_00) | (mother_00 & father_01)) & self_11, [cls.INHMODE_LABEL_LOH]),
+        ], default=[])
+        novoPP_error = ~no_call & (novoPP > 0) & (novoPP <= cls.DE_NOVO_MEDIUM_CUTOFF) & de_novo_chrxy
+
+        # inheritance modes otherwise, in the order of the checks of inheritance_modes_other_labels
+        other_modes = cls._select(cls.OTHER_INHERITANCE_MODES, [
+            (has_label(cls.GENOTYPE_LABEL_DOT), [cls.INHMODE_LABEL_NONE_DOT]),
+            (multiallelic, [cls.INHMODE_LABEL_NONE_MN]),
+            (has_label(cls.GENOTYPE_LABEL_SEX_INCONSISTENT), [cls.INHMODE_LABEL_NONE_SEX_INCONSISTENT]),
+            (has_label(cls.GENOTYPE_LABEL_SEX_AMBIGUOUS), [cls.INHMODE_LABEL_NONE_SEX_AMBIGUOUS]),
+            (mother_11 | (father_11 & ~father_hemizygous), [cls.INHMODE_LABEL_NONE_HOMOZYGOUS_PARENT]),
+            (father_11 & mother_00 & father_hemizygous & self_hemizygous, [cls.INHMODE_LABEL_NONE_HEMIZYGOUS_PARENT]),
+            ((mother_11 | mother_01) & (father_11 | father_01), [cls.INHMODE_LABEL_NONE_BOTH_PARENTS]),
+        ], default=[cls.INHMODE_LABEL_NONE_OTHER])
+        return labels, multiallelic, modes, other_modes, novoPP_error
+
+    @classmethod
+    def encode_trio(cls, variant_sample, chrom):
+        """ Encodes the trio of the given variant sample for compute_trio_inheritance_batch.
+
+        :param variant_sample: variant sample, as given to compute_inheritance_modes
+        :param chrom: chromosome of the variant
+        :returns: 4-tuple of genotype codes, sex codes, chromosome class code and novoPP, or None if the
+                  variant sample is not that of a trio (or is one compute_inheritance_modes handles otherwise)
+        """
+        sample_geno = variant_sample.get('samplegeno', [])
+        if len(sample_geno) != len(cls.BATCH_ROLES) or chrom == cls.MITOCHONDRIAL:
+            return None
+        try:
+            by_role = {s['samplegeno_role']: (s['samplegeno_numgt'], s['samplegeno_sex'], s['samplegeno_sampleid'])
+                       for s in sample_geno}
+        except (KeyError, TypeError):
+            return None
+        novoPP = variant_sample.get('novoPP', cls.NOVOPP_MISSING)
+        if sorted(by_role) != sorted(cls.BATCH_ROLES) or type(novoPP) not in (int, float):
+            return None
+        genotypes, sexes = [], []
+        for role in cls.BATCH_ROLES:
+            gt, sex, _ = by_role[role]
+            genotypes.append(cls.encode_genotype(gt) if isinstance(gt, str) else None)
+            sexes.append(cls.SEXES.index(sex) if sex in cls.SEXES else None)
+        if None in genotypes or None in sexes:
+            return None
+        chrom_class = chrom if chrom in ['X', 'Y'] else cls.AUTOSOME
+        return genotypes, sexes, cls.CHROMOSOME_CLASSES.index(chrom_class), novoPP
+
+    @classmethod
+    def compute_inheritance_modes_batch(cls, variant_samples, chroms, structural_variant=False):
+        """ Same as compute_inheritance_modes for each of the given variant samples, computing those of trios
+            (the vast majority) at once through compute_trio_inheritance_batch.
+
+        :param variant_samples: list of variant samples, linking their variant by uuid
+        :param chroms: list of the chromosomes of the variants of variant_samples
+        :param structural_variant: boolean True for SVs
+        :returns: list of the fields to add to each variant sample, as returned by compute_inheritance_modes
+        """
+        results = [None] * len(variant_samples)
+        batch = []  # (position, chromosome, encoded trio) of the variant samples computed at once
+        for position, (variant_sample, chrom) in enumerate(zip(variant_samples, chroms)):
+            trio = cls.encode_trio(variant_sample, chrom)
+            if trio is None:
+                results[position] = cls.compute_inheritance_modes(variant_sample, chrom=chrom,
+                                                                  structural_variant=structural_variant)
+            else:
+                batch.append((position, chrom, trio))
+        if not batch:
+            return results
+        labels, multiallelic, modes, other_modes, novoPP_error = (
+            array.tolist() for array in cls.compute_trio_inheritance_batch(
+                genotypes=[trio[0] for _, _, trio in batch],
+                sexes=[trio[1] for _, _, trio in batch],
+                chroms=[trio[2] for _, _, trio in batch],
+                novoPP=[trio[3] for _, _, trio in batch],
+                structural_variant=structural_variant,
+            )
+        )
+        for i, (position, chrom, _) in enumerate(batch):
+            variant_sample = variant_samples[position]
+            if novoPP_error[i]:  # raises as compute_inheritance_modes does
+                results[position] = cls.compute_inheritance_modes(variant_sample, chrom=chrom,
+                                                                  structural_variant=structural_variant)
+                continue
+            sample_ids, genotype_labels = {}, {}
+            for s in variant_sample['samplegeno']:  # labels are given in samplegeno order
+                role = s['samplegeno_role']
+                sample_ids[role] = s['samplegeno_sampleid']
+                genotype_labels[role] = [cls.GENOTYPE_LABELS[labels[i][cls.BATCH_ROLES.index(role)]]]
+                if multiallelic[i]:
+                    genotype_labels[role].append(cls.GENOTYPE_LABEL_MN_ADDON)
+            inheritance_modes = (cls.TRIO_INHERITANCE_MODES[modes[i]]
+                                 + cls.compute_cmphet_inheritance_modes(variant_sample.get('cmphet')))
+            if len(inheritance_modes) == 0:
+                inheritance_modes = list(cls.OTHER_INHERITANCE_MODES[other_modes[i]])
+            results[position] = {
+                'genotype_labels': cls.build_genotype_label_structure(genotype_labels, sample_ids),
+                'inheritance_modes': inheritance_modes,
+            }
+        return results
@@ -0,0 +1,53 @@
+import gzip
+import re
+
+import pytest
+from vcf import Reader
+
+from ..commands.add_altcounts_by_gene import iter_altcounts_lines, main as add_altcounts
+from .test_vcf_utils import TEST_VCF
+
+
+pytestmark = [pytest.mark.working, pytest.mark.ingestion]
+
+
+def strip_altcounts(line):
+    """ Removes the alt counts (and sample ID suffix) from SAMPLEGENO entries, as in reformat output. """
+    match = re.search(r"SAMPLEGENO=([^;\t]*)", line)
+    if line.startswith("#") or not match:
+        return line
+    samplegeno = ",".join(
+        "|".join(entry.split("|")[:3] + [entry.split("|")[3].replace("-WGS", "")])
+        for entry in match.group(1).split(",")
+    )
+    return line[:match.start(1)] + samplegeno + line[match.end(1):]
+
+
+@pytest.fixture
+def reformatted_vcf(tmp_path):
+    """ Gzipped VCF as output by reformat_vcf, ie: without alt counts. """
+    path = tmp_path / "reformatted.vcf.gz"
+    with open(TEST_VCF, "r", encoding="utf-8") as f:
+        with gzip.open(path, "wt", encoding="utf-8") as out:
+            for line in f:
+                out.write(strip_altcounts(line))
+    return str(path)
+
+
+def test_iter_altcounts_lines_matches_main(reformatted_vcf, tmp_path):
+    """ Tests the streamed lines are identical to the file written by the script. """
+    outputfile = str(tmp_path / "altcounts.vcf")
+    add_altcounts({"inputfile": reformatted_vcf, "outputfile": outputfile})
+    with open(outputfile, "r", encoding="utf-8") as f:
+        expected = f.read()
+    assert "".join(iter_altcounts_lines(reformatted_vcf)) == expected
+
+
+def test_iter_altcounts_lines_read_by_vcf_reader(reformatted_vcf):
+    """ Tests the streamed lines can be parsed directly, with alt counts added to SAMPLEGENO. """
+    expected = list(Reader(open(TEST_VCF, "r", encoding="utf-8")))
+    records = list(Reader(iter_altcounts_lines(reformatted_vcf)))
+    assert len(records) == len(expected)
+    for record in records:
+        for entry in record.INFO["SAMPLEGENO"]:
+            assert len(entry.split("|")) == 5
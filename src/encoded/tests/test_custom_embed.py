@@ -1,8 +1,14 @@
+import json
+from unittest import mock
+
 import pytest
 
 from dcicutils.qa_utils import notice_pytest_fixtures
 
-from ..custom_embed import ATID_PATTERN, MINIMAL_EMBEDS, FORBIDDEN_MSG
+from ..custom_embed import (
+    ATID_PATTERN, BUDGET_EXCEEDED_MSG, EMBED_BULK_WORK_BUDGET_SETTING, EMBED_OBJECT_CACHE, MINIMAL_EMBEDS,
+    FORBIDDEN_MSG, CustomEmbed, EmbedObjectCache
+)
 
 from .test_permissions import bwh_institution, deleted_user, deleted_user_testapp
 
@@ -13,6 +19,7 @@ notice_pytest_fixtures(bwh_institution, deleted_user, deleted_user_testapp)
 pytestmark = [pytest.mark.working, pytest.mark.indexing]
 
 EMBED_URL = "/embed"
+EMBED_BULK_URL = "/embed-bulk"
 KEYS_NOT_INCLUDED = ["@context", "actions", "aggregated-items", "validation-errors"]
 
 
@@ -46,6 +53,13 @@ def embed_with_json_params(testapp, embed_json, status="*"):
     return response
 
 
+def bulk_embed(testapp, embed_json):
+    """POST to bulk embed endpoint, returning the NDJSON lines parsed."""
+    response = testapp.post_json(EMBED_BULK_URL, embed_json, status=200)
+    assert response.content_type == "application/x-ndjson"
+    return [json.loads(line) for line in response.text.splitlines()]
+
+
 def convert_atid_to_key(atid_name_list):
     """Removes last letter from all strings in list."""
     key_name_list = [atid_name[:-1] for atid_name in atid_name_list]
@@ -342,3 +356,194 @@ class TestCustomEmbed:
         json_params = {"ids": [file_fastq_uuid], "fields": fields}
         admin_embed = embed_with_json_params(testapp, json_params)
         assert admin_embed["file_format"]["file_format"] == "fastq"
+
+    @pytest.mark.parametrize("embed_json,max_batches", [
+        ({"depth": 3, "ignored": ["variant-sample-lists"]}, 4),
+        ({"depth": 2, "desired": ["variant-samples", "variants", "projects"]}, 3),
+        ({"fields": ["variant_samples.variant_sample_item.variant.display_title", "project.title", "*"]}, 4),
+    ])
+    def test_embed_fetched_by_depth(self, testapp, variant_sample_list, embed_json, max_batches):
+        """
+        Test that items are fetched in one batch per depth before being
+        embedded, with the same result as fetching them one at a time as
+        they are embedded.
+        """
+        vsl_uuid = variant_sample_list["uuid"]
+        json_params = dict(embed_json, ids=[vsl_uuid])
+        with mock.patch.object(CustomEmbed, "fetch_embeds"):
+            with mock.patch.object(CustomEmbed, "fetch_field_embeds"):
+                expected = embed_with_json_params(testapp, json_params, status=200)
+
+        get_object = CustomEmbed.get_object
+        not_fetched = []
+
+        def get_fetched_object(custom_embed, item_id):
+            if item_id not in custom_embed.fetched:
+                not_fetched.append(item_id)
+            return get_object(custom_embed, item_id)
+
+        with mock.patch.object(CustomEmbed, "fetch_objects", autospec=True,
+                               side_effect=CustomEmbed.fetch_objects) as fetch_objects:
+            with mock.patch.object(CustomEmbed, "get_object", new=get_fetched_object):
+                assert embed_with_json_params(testapp, json_params, status=200) == expected
+        assert 1 < fetch_objects.call_count <= max_batches
+        assert not_fetched == []
+
+    def test_field_embed_projection(self, testapp, variant_sample_list):
+        """
+        Test that items are only fetched with the fields needed for the
+        requested fields, with the same result as fetching whole objects.
+        """
+        vsl_uuid = variant_sample_list["uuid"]
+        fields = ["variant_samples.variant_sample_item.variant.display_title", "project.title"]
+        json_params = {"ids": [vsl_uuid], "fields": fields}
+        with mock.patch.object(CustomEmbed, "get_projection", return_value=None):
+            expected = embed_with_json_params(testapp, json_params, status=200)
+
+        fetch_objects = CustomEmbed.fetch_objects
+        fetched = []
+
+        def fetch_projected_objects(custom_embed, item_ids, projections=None):
+            objects = fetch_objects(custom_embed, item_ids, projections)
+            fetched.extend(objects.values())
+            return objects
+
+        object_cache = testapp.app.registry[EMBED_OBJECT_CACHE]
+        with mock.patch.object(object_cache, "capacity", 0):  # so whole objects are not taken from it
+            with mock.patch.object(CustomEmbed, "fetch_objects", new=fetch_projected_objects):
+                assert embed_with_json_params(testapp, json_params, status=200) == expected
+        variants = [item for item in fetched if "Variant" in item["@type"]]
+        assert variants
+        for variant in variants:
+            assert set(variant) == {"@id", "@type", "uuid", "display_title"}
+
+    def test_field_embed_projection_at_several_depths(self, testapp, variant_sample_list):
+        """
+        Test that an item fetched with few fields is fetched again with
+        the fields requested for it at a deeper path.
+        """
+        vsl_uuid = variant_sample_list["uuid"]
+        fields = ["project.@id", "variant_samples.variant_sample_item.project.title"]
+        json_params = {"ids": [vsl_uuid], "fields": fields}
+        with mock.patch.object(CustomEmbed, "get_projection", return_value=None):
+            expected = embed_with_json_params(testapp, json_params, status=200)
+        object_cache = testapp.app.registry[EMBED_OBJECT_CACHE]
+        with mock.patch.object(object_cache, "capacity", 0):  # so whole objects are not taken from it
+            embed = embed_with_json_params(testapp, json_params, status=200)
+        assert embed == expected
+        project_atid = embed["project"]["@id"]
+        variant_sample_projects = [
+            variant_sample["variant_sample_item"]["project"] for variant_sample in embed["variant_samples"]
+        ]
+        assert variant_sample_projects
+        for project in variant_sample_projects:
+            assert project["title"] == testapp.get(project_atid).json["title"]
+
+    def test_object_fields_view(self, testapp, variant_sample_list):
+        """Test the object view projected to the given fields."""
+        vsl_atid = variant_sample_list["@id"]
+        fields = ["variant_samples", "display_title", "project", "not_a_field"]
+        projected = testapp.get(vsl_atid + "@@object-fields?field=" + "&field=".join(fields)).json
+        vsl_object = testapp.get(vsl_atid + "@@object").json
+        assert projected == {field: vsl_object[field] for field in fields if field in vsl_object}
+
+    def test_embed_object_cache(self, testapp, bgm_user_testapp, variant_sample_list):
+        """
+        Test that object views are cached across requests, with permissions
+        checked per request, until the database is written.
+        """
+        object_cache = testapp.app.registry[EMBED_OBJECT_CACHE]
+        vsl_atid = variant_sample_list["@id"]
+        testapp.patch_json(vsl_atid, {"status": "shared"}, status=200)
+        json_params = {"ids": [vsl_atid], "depth": 2, "ignored": ["variant-sample-lists"]}
+        admin_embed = embed_with_json_params(testapp, json_params)
+        stats = testapp.get("/embed-cache").json
+        assert stats["entries"] > 1
+        assert stats["max_sid"] == object_cache.max_sid
+
+        with mock.patch.object(CustomEmbed, "prefetch_resources") as prefetch_resources:
+            assert embed_with_json_params(testapp, json_params) == admin_embed
+            prefetch_resources.assert_called_with([])
+        cached_stats = testapp.get("/embed-cache").json
+        assert cached_stats["hits"] - stats["hits"] == stats["entries"]
+        assert cached_stats["misses"] == stats["misses"]
+
+        bgm_embed = embed_with_json_params(bgm_user_testapp, json_params)
+        for variant_sample in bgm_embed["variant_samples"]:
+            assert variant_sample["variant_sample_item"] == FORBIDDEN_MSG
+        bgm_user_testapp.get("/embed-cache", status=403)
+
+        testapp.patch_json(vsl_atid, {"status": "current"}, status=200)
+        embed = embed_with_json_params(testapp, json_params)
+        assert embed["status"] == "current"
+        assert testapp.get("/embed-cache").json["invalidations"] > stats["invalidations"]
+
+    def test_bulk_embed(self, testapp, variant_sample_list):
+        """
+        Test that items of a bulk embed are streamed in order as they would
+        be embedded by the embed API, invalid IDs being reported per line.
+        """
+        vsl_uuid = variant_sample_list["uuid"]
+        variant_sample_uuids = [
+            variant_sample["variant_sample_item"]
+            for variant_sample in variant_sample_list["variant_samples"]
+        ]
+        ids = variant_sample_uuids + [vsl_uuid, "not-an-id", vsl_uuid]
+        fields = ["variant.display_title", "variant_samples.variant_sample_item.variant.display_title", "*"]
+        lines = bulk_embed(testapp, {"ids": ids, "fields": fields})
+        assert [line["id"] for line in lines] == variant_sample_uuids + [vsl_uuid, "not-an-id"]
+        for line in lines[:-1]:
+            expected = embed_with_json_params(testapp, {"ids": [line["id"]], "fields": fields}, status=200)
+            assert line["item"] == expected
+        assert lines[-1] == {"id": "not-an-id", "error": "invalid ID"}
+        embed_with_json_params(testapp, {"ids": ids, "fields": fields}, status=400)
+
+    def test_bulk_embed_work_budget(self, testapp, variant_sample_list):
+        """
+        Test that items are no longer embedded once the object views fetched
+        exceed the work budget of the request.
+        """
+        vsl_uuid = variant_sample_list["uuid"]
+        variant_sample_uuids = [
+            variant_sample["variant_sample_item"]
+            for variant_sample in variant_sample_list["variant_samples"]
+        ]
+        ids = variant_sample_uuids + [vsl_uuid]
+        with mock.patch.dict(testapp.app.registry.settings, {EMBED_BULK_WORK_BUDGET_SETTING: 1}):
+            lines = bulk_embed(testapp, {"ids": ids, "depth": 0})
+        assert "item" in lines[0]
+        for line in lines[1:]:
+            assert line["error"] == BUDGET_EXCEEDED_MSG
+        assert len(lines) == len(ids)
+
+
+def test_embed_object_cache_eviction():
+    """Test that the least recently used object views are evicted beyond capacity."""
+    items = [{"uuid": str(i) * 8, "@id": "/items/%s/" % i, "value": "x" * 50} for i in range(3)]
+    principals = ["system.Everyone", "group.admin"]
+    object_cache = EmbedObjectCache(250)
+    for item in items:
+        object_cache.put(item["@id"], item, principals, 1)
+        assert object_cache.get("/" + item["uuid"], principals, 1) == item
+    stats = object_cache.get_stats()
+    assert stats["entries"] == 2 and stats["evictions"] == 1 and stats["bytes"] <= 250
+    assert object_cache.get(items[0]["@id"], principals, 1) is None
+    cached_item = object_cache.get(items[2]["@id"], principals, 1)
+    cached_item["value"] = "modified"
+    assert object_cache.get(items[2]["@id"], principals[::-1], 1) == items[2]
+    assert object_cache.get(items[2]["@id"], principals, 2) is None
+    stats = object_cache.get_stats()
+    assert stats["entries"] == 0 and stats["invalidations"] == 1 and stats["max_sid"] == 2
+
+
+def test_embed_object_cache_principals():
+    """Test that object views are only given back for the principals they were rendered for."""
+    item = {"uuid": "uuid", "@id": "/items/uuid/", "value": "as seen by admin"}
+    object_cache = EmbedObjectCache(1000)
+    object_cache.put(item["@id"], item, ["system.Everyone", "group.admin"], 1)
+    assert object_cache.get(item["@id"], ["system.Everyone"], 1) is None
+    other_item = dict(item, value="as seen by everyone")
+    object_cache.put(item["@id"], other_item, ["system.Everyone"], 1)
+    assert object_cache.get("/uuid", ["system.Everyone"], 1) == other_item
+    assert object_cache.get("/uuid", ["group.admin", "system.Everyone"], 1) == item
+    assert object_cache.get_stats()["entries"] == 2
@@ -1,14 +1,15 @@
 import pytest
 
 from ..util import resolve_file_path
-from ..ingestion.table_utils import GeneTableParser
-from .test_variant_table_intake import ANNOTATION_FIELD_SCHEMA
+from ..ingestion.table_utils import GeneTableParser, MappingTableDiff
+from .test_variant_table_intake import ANNOTATION_FIELD_SCHEMA, write_updated_table
 from .variant_fixtures import GENE_ANNOTATION_FIELD_URL
 
 
 pytestmark = [pytest.mark.working, pytest.mark.ingestion]
 MT_LOC = resolve_file_path('annotations/gene_table_v0.4.6.csv')
 GENE_SCHEMA_TEST_LOC = resolve_file_path('schemas/gene.json')
+GENE_ANNOTATION_FIELD_SCHEMA = resolve_file_path('schemas/gene_annotation_field.json')
 NUMBER_ANNOTATION_FIELDS = 284
 EXPECTED_INSERT = {'field_name': 'chrom',
                    'schema_title': 'Chromosome', 'do_import': True,
@@ -106,3 +107,22 @@ def test_gene_table_run(GTParser, testapp):
     inserts = GTParser.run(gs_out=GENE_SCHEMA_TEST_LOC, write=False)
     for item in inserts:
         testapp.post_json(GENE_ANNOTATION_FIELD_URL, item, status=201)
+
+
+def test_gene_table_diff(tmp_path):
+    """ Tests the diff of two gene tables reports added fields as additive """
+    def update(fields):
+        [chrom] = [field for field in fields if field['field_name'] == 'chrom']
+        return fields + [dict(chrom, field_name='new_field')]
+
+    new_table = write_updated_table(MT_LOC, tmp_path / 'gene_table.csv', update)
+    report = MappingTableDiff.from_tables(GeneTableParser, MT_LOC, new_table, GENE_ANNOTATION_FIELD_SCHEMA)
+    report = report.generate_report()
+    gene_report = report['item_types']['gene']
+    assert gene_report['added'] == ['new_field']
+    assert gene_report['removed'] == gene_report['retyped'] == gene_report['changed'] == []
+    assert list(gene_report['properties']) == ['new_field']
+    assert gene_report['mapping_change'] == MappingTableDiff.ADDITIVE_MAPPING_CHANGE
+    assert gene_report['facets'] == {'added': [], 'removed': [], 'changed': []}
+    assert gene_report['columns'] == {'added': [], 'removed': [], 'changed': []}
+    assert report['reindex_required'] == []
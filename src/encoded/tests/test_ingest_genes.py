@@ -1,7 +1,12 @@
+import io
+import json
+from unittest import mock
+
 import pytest
 
 from dcicutils.qa_utils import notice_pytest_fixtures
-from .variant_fixtures import test_genes, GENE_URL  # noqa (fixture)
+from ..ingestion.gene_utils import GeneIngestion, iter_json_array
+from .variant_fixtures import test_genes, GENE_URL, GENES_LOC  # noqa (fixture)
 
 
 notice_pytest_fixtures(test_genes)
@@ -22,3 +27,50 @@ def test_post_gene_inserts(testapp, project, institution, test_genes):
 def test_post_gene_inserts_via_upload(testapp, project, institution, test_genes):
     """ Attempts to post using the upload method """
     test_genes.upload(testapp, project='encode-project', institution='encode-institution')
+
+
+def test_post_gene_inserts_via_bulk_upload(testapp, project, institution, test_genes):
+    """ Tests genes are created then updated in batches, unchanged genes being skipped """
+    kwargs = {'project': 'encode-project', 'institution': 'encode-institution', 'batch_size': 3}
+    assert test_genes.upload(testapp, **kwargs) == {'created': len(test_genes)}
+    assert test_genes.upload(testapp, skip_unchanged=True, **kwargs) == {'unchanged': len(test_genes)}
+    genes = GeneIngestion(GENES_LOC)
+    genes[0]['name'] = 'updated'
+    assert genes.upload(testapp, skip_unchanged=True, **kwargs) == {'updated': 1, 'unchanged': len(genes) - 1}
+    assert testapp.get('/genes/%s/?frame=object' % genes[0]['ensgid']).json['name'] == 'updated'
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 1024 * 1024])
+def test_iter_json_array(chunk_size):
+    """ Tests elements streamed from a JSON array are those of the loaded document """
+    with open(GENES_LOC, 'r') as f:
+        expected = json.load(f)
+    with open(GENES_LOC, 'r') as f:
+        assert list(iter_json_array(f, chunk_size=chunk_size)) == expected
+    content = ' [ 12 , -3.5e2,"a,]" ,[1, {"b": [2]}],null ]\n'
+    assert list(iter_json_array(io.StringIO(content), chunk_size=chunk_size)) == json.loads(content)
+    assert list(iter_json_array(io.StringIO('[]'), chunk_size=chunk_size)) == []
+
+
+@pytest.mark.parametrize('content', ['{"a": 1}', '[1, 2', '[1, {"a"]', '[1 2]', '[1,,2]', ''])
+def test_iter_json_array_invalid(content):
+    """ Tests content that is not a complete JSON array raises an error """
+    with pytest.raises(ValueError):
+        list(iter_json_array(io.StringIO(content), chunk_size=2))
+
+
+def test_gene_ingestion_streams_genes(test_genes):
+    """ Tests iterating genes does not load the whole file, while indexing does """
+    assert [gene['ensgid'] for gene in test_genes] == [gene['ensgid'] for gene in json.load(open(GENES_LOC))]
+    assert test_genes._genes is None
+    assert len(test_genes) == 8
+    assert test_genes[0]['ensgid'] == 'ENSG00000186092'
+
+
+def test_gene_ingestion_upload_streams_genes():
+    """ Tests uploading genes with a progress bar streams them rather than loading the whole file """
+    genes = GeneIngestion(GENES_LOC)
+    vapp = mock.Mock()
+    assert genes.upload(vapp, use_tqdm=True) == {'created': 8}
+    assert vapp.post_json.call_count == 8
+    assert genes._genes is None
@@ -2,6 +2,7 @@ import datetime
 import gzip
 import json
 from unittest import mock
+import pysam
 import pytest
 import time
 
@@ -9,10 +10,16 @@ from dcicutils.misc_utils import ignored
 from uuid import uuid4
 from pyramid.testing import DummyRequest
 from snovault.ingestion.common import IngestionReport, IngestionError
-from snovault.ingestion.ingestion_listener_base import STATUS_INGESTED
+from snovault.ingestion.ingestion_listener_base import STATUS_ERROR, STATUS_INGESTED
 from snovault.ingestion.ingestion_listener import IngestionQueueManager, run, IngestionListener
+from ..ingestion import ingestion_message_handler_vcf
+from ..ingestion.ingestion_message_handler_vcf import (
+    download_to_temporary_file, ingest_downloaded_vcf, open_gzipped_vcf, tabix_index_vcf
+)
+from ..ingestion.ingestion_metrics import IngestionMetrics
+from ..ingestion.variant_utils import VariantBuilder
 from ..project.ingestion import verify_vcf_file_status_is_not_ingested
-from ..util import debuglog
+from ..util import debuglog, resolve_file_path
 
 
 pytestmark = [pytest.mark.working, pytest.mark.ingestion, pytest.mark.workbook]
@@ -261,11 +268,17 @@ def test_ingestion_report_basic(success):
 
 
 def mock_request_get(*args, **kwargs):
-    """Mock request.get() result for SV VCF ingestion."""
+    """Mock (streamed) request.get() result for SV VCF ingestion."""
     ignored(args, kwargs)
 
     class MockContent:
 
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc_info):
+            return False
+
         @property
         def content(self):
             """
@@ -284,9 +297,73 @@ def mock_request_get(*args, **kwargs):
             content = gzip.compress(file_contents)
             return content
 
+        def iter_content(self, chunk_size=1):
+            content = self.content
+            for i in range(0, len(content), chunk_size):
+                yield content[i:i + chunk_size]
+
+        def raise_for_status(self):
+            pass
+
     return MockContent()
 
 
+@mock.patch("requests.get", new=mock_request_get)
+def test_download_to_temporary_file():
+    """ Tests the VCF is streamed to disk and read back by vcf.Reader as it is decompressed. """
+    downloaded = download_to_temporary_file("https://some/vcf.gz", suffix=".gz")
+    with open(downloaded.name, "rb") as f:
+        assert f.read() == mock_request_get().content
+    reader = open_gzipped_vcf(downloaded.name)
+    assert reader.samples == ["NA12879_sample", "NA12878_sample", "NA12877_sample"]
+    [record] = list(reader)
+    assert record.POS == 31908111
+    downloaded.close()
+
+
+def test_tabix_index_vcf(tmp_path):
+    """ Tests a bgzipped VCF is tabix indexed, but not one that is only gzipped. """
+    content = gzip.decompress(mock_request_get().content)
+    gzipped, bgzipped = str(tmp_path / "gzipped.vcf.gz"), str(tmp_path / "bgzipped.vcf.gz")
+    with gzip.open(gzipped, "wb") as f:
+        f.write(content)
+    with pysam.BGZFile(bgzipped, "wb") as f:
+        f.write(content)
+    assert tabix_index_vcf(gzipped) is None
+    assert tabix_index_vcf(bgzipped) == bgzipped + ".tbi"
+    [record] = list(pysam.TabixFile(bgzipped).fetch("chr1"))
+    assert record.split("\t")[1] == "31908111"
+
+
+def test_ingest_downloaded_vcf_preprocessing_error(tmp_path):
+    """ Tests an error of the streamed preprocessing of a SNV VCF, raised past its header as records are
+        ingested, sets the file in error with an ingestion report. """
+    with open(resolve_file_path("annotations/GAPFII76KW2T_v0.5.6.reformat.altcounts.vcf.subset"), "rb") as f:
+        content = f.read()
+    downloaded_vcf = tmp_path / "downloaded.vcf.gz"
+    downloaded_vcf.write_bytes(gzip.compress(content))
+    header = [line + "\n" for line in content.decode("utf-8").splitlines() if line.startswith("#")]
+
+    def iter_preprocessed_vcf_lines(*args, **kwargs):
+        ignored(args, kwargs)
+        yield from header
+        raise ValueError("Malformed record")
+
+    listener = mock.Mock(vapp=mock.Mock(spec=["patch_json"]), build_ingestion_error_report=(
+        IngestionListener.build_ingestion_error_report
+    ))
+    message = mock.Mock(uuid="b153279a-7521-4f7d-a360-831aeba0a595")
+    file_meta = {"accession": "GAPFIZ123456", "project": {"@id": "project"}, "institution": {"@id": "institution"}}
+    with mock.patch.object(ingestion_message_handler_vcf, "iter_preprocessed_vcf_lines",
+                           new=iter_preprocessed_vcf_lines):
+        with mock.patch.object(VariantBuilder, "get_checkpoint", return_value=None):
+            with mock.patch.object(VariantBuilder, "extract_sample_relations", return_value={}):
+                with open(str(downloaded_vcf), "rb") as f:
+                    assert ingest_downloaded_vcf(message, listener, file_meta, f, IngestionMetrics()) is True
+    assert listener.set_status.call_args == mock.call(message.uuid, STATUS_ERROR)
+    listener.patch_ingestion_report.assert_called_once_with([{"body": "Malformed record", "row": -1}], message.uuid)
+
+
 def mock_ingest_vcf(*args, **kwargs):
     """
     Mock for StructuralVariantBuilder.ingest_vcf() for SV VCF ingestion.
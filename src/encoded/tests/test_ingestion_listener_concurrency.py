@@ -0,0 +1,124 @@
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+import pytest
+
+from ..ingestion import ingestion_listener
+from ..ingestion.ingestion_listener import ConcurrentIngestionListener, ProjectFairQueue
+
+
+pytestmark = [pytest.mark.working, pytest.mark.ingestion]
+
+
+def make_message(uuid):
+    return {"MessageId": "message-" + uuid, "Body": json.dumps({"uuid": uuid, "ingestion_type": "vcf"})}
+
+
+class MockedQueueManager:
+    """ Queue manager handing out the given batches of messages, recording the deleted ones. """
+
+    def __init__(self, *batches):
+        self.batches = list(batches)
+        self.batch_sizes = []
+        self.deleted = []
+
+    def receive_messages(self, batch_size=None):
+        self.batch_sizes.append(batch_size)
+        return self.batches.pop(0) if self.batches else []
+
+    def delete_messages(self, messages):
+        self.deleted.extend(messages)
+        return []
+
+
+class ThreadedIngestionListener(ConcurrentIngestionListener):
+    """ Concurrent listener running its workers in threads of this process, with projects given by uuid. """
+    POLL_INTERVAL = 0
+
+    def __init__(self, queue_manager, projects, iterations, processes=2):
+        super().__init__(None, processes=processes, _queue_manager=queue_manager)
+        self.projects = projects
+        self.iterations = iterations
+
+    def make_executor(self):
+        return ThreadPoolExecutor(max_workers=self.processes)
+
+    def get_message_project(self, message):
+        return self.projects[self.get_message_uuid(message)]
+
+    def should_remain_online(self, override=None):
+        self.iterations -= 1
+        return self.iterations >= 0
+
+
+def test_project_fair_queue():
+    """ Tests messages are handed out in order of arrival, favoring projects with fewer messages running. """
+    queue = ProjectFairQueue()
+    for message, project in [("a1", "a"), ("a2", "a"), ("a3", "a"), ("b1", "b"), ("c1", "c")]:
+        queue.add(message, project)
+    running = []
+    order = []
+    while queue:
+        message, project = queue.pop(running)
+        running.append(project)
+        order.append(message)
+    assert order == ["a1", "b1", "c1", "a2", "a3"]
+
+
+def test_concurrent_ingestion_listener_run():
+    """ Tests messages are handled, then deleted unless deferred, and that each file is only handled once. """
+    messages = [make_message(uuid) for uuid in ["one", "two", "three", "deferred"]]
+    unparseable = {"MessageId": "unparseable", "Body": "not json"}
+    queue_manager = MockedQueueManager(messages[:2] + [unparseable, make_message("one")], messages[2:])
+    listener = ThreadedIngestionListener(queue_manager, {"one": "a", "two": "a", "three": "b", "deferred": "b"},
+                                         iterations=5)
+    handled = []
+
+    def handle_message(message):
+        handled.append(message)
+        if "deferred" in message["Body"]:
+            return listener.MESSAGE_DEFERRED
+        return listener.MESSAGE_HANDLED
+
+    with mock.patch.object(ingestion_listener, "handle_message_in_worker", new=handle_message):
+        listener.run()
+    assert sorted(message["MessageId"] for message in handled) == sorted(m["MessageId"] for m in messages)
+    assert sorted(message["MessageId"] for message in queue_manager.deleted) == [
+        "message-one", "message-three", "message-two", "unparseable"
+    ]
+
+
+def test_concurrent_ingestion_listener_runs_serially_by_default():
+    """ Tests the listener defers to IngestionListener.run when not given more than one process. """
+    listener = ConcurrentIngestionListener(None, _queue_manager=MockedQueueManager())
+    with mock.patch.object(ingestion_listener.IngestionListener, "run") as mocked_run:
+        listener.run()
+    mocked_run.assert_called_once()
+
+
+def test_concurrent_ingestion_listener_receives_for_idle_workers_only():
+    """ Tests the listener only receives as many messages as it has idle workers, so none waits for a worker
+        (and outlives its visibility timeout) on its side. """
+    queue_manager = MockedQueueManager([make_message("one")], [make_message("two")])
+    listener = ThreadedIngestionListener(queue_manager, {"one": "a", "two": "a"}, iterations=3, processes=3)
+    with mock.patch.object(ingestion_listener, "handle_message_in_worker",
+                           new=lambda message: time.sleep(0.5) or listener.MESSAGE_HANDLED):
+        listener.run()
+    assert queue_manager.batch_sizes == [3, 2, 1]
+    assert sorted(message["MessageId"] for message in queue_manager.deleted) == ["message-one", "message-two"]
+
+
+@pytest.mark.parametrize("argv", [["development.ini"], ["--dry-run", "development.ini"]])
+def test_ingestion_listener_main(argv):
+    """ Tests the command line of the listener, which still accepts the snovault listener's --dry-run. """
+    app = mock.Mock()
+    app.registry.settings = {ingestion_listener.INGESTION_LISTENER_PROCESSES_SETTING: "2"}
+    with mock.patch("sys.argv", ["ingestion-listener"] + argv):
+        with mock.patch.object(ingestion_listener.paster, "get_app", return_value=app) as get_app:
+            with mock.patch.object(ingestion_listener, "run") as run:
+                ingestion_listener.main()
+    get_app.assert_called_once_with("development.ini", None)
+    [(args, kwargs)] = run.call_args_list
+    assert kwargs == {"processes": 2, "worker_args": ("development.ini", None, "IMPORT", None)}
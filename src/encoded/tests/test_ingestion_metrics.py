@@ -0,0 +1,99 @@
+import time
+from unittest import mock
+
+import pytest
+
+from ..ingestion.ingestion_message_handler_vcf import FILE_INGESTION_METRICS, report_ingestion_metrics
+from ..ingestion import ingestion_metrics
+from ..ingestion.ingestion_metrics import IngestionMetrics
+
+
+pytestmark = [pytest.mark.working, pytest.mark.ingestion]
+
+
+def test_ingestion_metrics_stages():
+    """ Tests the times of a stage add up, in the order stages were first timed. """
+    metrics = IngestionMetrics()
+    with metrics.timer("write", count=10):
+        time.sleep(0.01)
+    assert list(metrics.timed_iter("parse", range(3))) == [0, 1, 2]
+    with metrics.timer("write", count=5):
+        pass
+    stages = metrics.get_stage_times()
+    assert list(stages) == ["write", "parse"]
+    assert stages["write"]["count"] == 15 and stages["write"]["seconds"] >= 0.01
+    assert stages["parse"]["count"] == 3
+
+
+def test_ingestion_metrics_timer_error():
+    """ Tests the time of a stage is recorded even if it fails. """
+    metrics = IngestionMetrics()
+    with pytest.raises(ValueError):
+        with metrics.timer("build"):
+            raise ValueError("malformed record")
+    assert metrics.get_stage_times()["build"]["count"] == 1
+
+
+def test_ingestion_metrics_merge():
+    """ Tests the stage times of another process are added to those of the same stages. """
+    metrics, worker_metrics = IngestionMetrics(), IngestionMetrics()
+    metrics.add_time("build", 1.5, 10)
+    worker_metrics.add_time("build", 2, 20)
+    worker_metrics.add_time("parse", 1, 20)
+    metrics.merge(worker_metrics.get_stage_times())
+    assert metrics.get_stage_times() == {"build": {"seconds": 3.5, "count": 30}, "parse": {"seconds": 1, "count": 20}}
+
+
+def test_ingestion_metrics_to_dict():
+    """ Tests metrics are reported with counters, throughput and peak memory use. """
+    metrics = IngestionMetrics()
+    metrics.add_time("download", 0.1234567)
+    metrics.increment(metrics.RECORDS, 100)
+    metrics.increment("retries")
+    with mock.patch("time.time", return_value=metrics.started + 4):
+        result = metrics.to_dict()
+    assert result["stages"] == [{"stage": "download", "seconds": 0.123, "count": 1}]
+    assert result["records"] == 100
+    assert result["retries"] == 1
+    assert result["total_seconds"] == 4
+    assert result["records_per_second"] == 25
+    assert result["peak_rss_mb"] > 0
+    assert "peak_worker_rss_mb" not in result  # not built in worker processes
+
+
+def test_ingestion_metrics_peak_rss():
+    """ Tests the peak memory use is the largest sampled during the ingestion, not since the process started,
+        and that of workers the largest given with their stage times. """
+    with mock.patch("encoded.ingestion.ingestion_metrics.get_rss_mb", side_effect=[100, 300, 200, 150]):
+        metrics = IngestionMetrics()  # samples 100
+        metrics.sample_rss()
+        metrics.add_time("parse", 1)  # not sampled again within RSS_SAMPLE_INTERVAL
+        with mock.patch("time.time", return_value=metrics.rss_sampled + ingestion_metrics.RSS_SAMPLE_INTERVAL):
+            metrics.add_time("parse", 1)  # samples 200
+        metrics.merge({"build": {"seconds": 1, "count": 1}}, peak_rss_mb=500)
+        metrics.merge({"build": {"seconds": 1, "count": 1}}, peak_rss_mb=400)
+        metrics.merge({"build": {"seconds": 1, "count": 1}})
+        result = metrics.to_dict()  # samples 150
+    assert result["peak_rss_mb"] == 300
+    assert result["peak_worker_rss_mb"] == 500
+    with mock.patch("encoded.ingestion.ingestion_metrics.get_rss_mb", return_value=None):
+        assert "peak_rss_mb" not in IngestionMetrics().to_dict()  # not on linux
+
+
+def test_get_rss_mb():
+    """ Tests the current memory use of the process is read, if on linux. """
+    rss_mb = ingestion_metrics.get_rss_mb()
+    assert rss_mb is None or rss_mb > 0
+
+
+def test_report_ingestion_metrics():
+    """ Tests metrics are patched on the ingested file, and that failing to do so is not an error. """
+    listener = mock.MagicMock()
+    metrics = IngestionMetrics()
+    metrics.increment(metrics.RECORDS)
+    report_ingestion_metrics(listener, "some_uuid", metrics)
+    [(path, body), kwargs] = listener.vapp.patch_json.call_args
+    assert path == "/some_uuid"
+    assert body[FILE_INGESTION_METRICS]["records"] == 1
+    listener.vapp.patch_json.side_effect = Exception("conflict")
+    report_ingestion_metrics(listener, "some_uuid", metrics)
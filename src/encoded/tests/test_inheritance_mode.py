@@ -1,5 +1,7 @@
 import pytest
 import csv
+import itertools
+import re
 from ..inheritance_mode import InheritanceMode, InheritanceModeError
 from ..util import resolve_file_path
 
@@ -749,3 +751,118 @@ def test_compute_inheritance_modes_csv_tests():
             for entry in actual:
                 entry = entry.lower()
                 assert entry in reference or entry in reference[0]  # structure varies
+
+
+@pytest.mark.parametrize('novoPP', [1, .95, .9, .5, .1, .05, .001, 0, -.5, -1])
+@pytest.mark.parametrize('gts, sexes, chrom', [
+    ({'proband': '0/1', 'mother': '0/0', 'father': '0/0'}, {'proband': 'F', 'mother': 'F', 'father': 'M'}, 'autosome'),
+    ({'proband': '0/1', 'mother': '0/0', 'father': '0/0'}, {'proband': 'F', 'mother': 'F', 'father': 'M'}, 'X'),
+    ({'proband': '1/1', 'mother': '0/1', 'father': '0/0'}, {'proband': 'M', 'mother': 'F', 'father': 'M'}, 'X'),
+    ({'proband': '1/1', 'mother': '0/1', 'father': '0/1'}, {'proband': 'M', 'mother': 'F', 'father': 'M'}, 'autosome'),
+    ({'proband': '1/2', 'mother': '0/1', 'father': '0/2'}, {'proband': 'M', 'mother': 'F', 'father': 'M'}, 'autosome'),
+])
+def test_compute_family_inheritance(gts, sexes, chrom, novoPP):
+    """ Tests memoized family inheritance gives the same results as computing them directly, for any novoPP """
+    genotype_labels = InheritanceMode.compute_family_genotype_labels(gts, sexes, chrom)
+    try:
+        expected_modes = InheritanceMode.compute_inheritance_mode_trio(
+            genotypes=gts, genotype_labels=genotype_labels, sexes=sexes, chrom=chrom, novoPP=novoPP)
+    except ValueError as e:
+        with pytest.raises(ValueError, match=re.escape(str(e))):
+            InheritanceMode.compute_family_inheritance(
+                genotypes=tuple(gts.items()), sexes=tuple(sexes.items()), chrom=chrom, novoPP=novoPP)
+        return
+    expected_other_modes = InheritanceMode.inheritance_modes_other_labels(gts, genotype_labels)
+    for _ in range(2):  # computed, then remembered
+        labels, modes, other_modes = InheritanceMode.compute_family_inheritance(
+            genotypes=tuple(gts.items()), sexes=tuple(sexes.items()), chrom=chrom, novoPP=novoPP)
+        assert (labels, modes, other_modes) == (genotype_labels, expected_modes, expected_other_modes)
+        labels['proband'].append('changed by caller')  # results handed out do not share state
+        modes.append('changed by caller')
+
+
+def build_trio_variant_sample(gts, sexes, novoPP, roles=('proband', 'mother', 'father')):
+    """ Builds a variant sample of a trio with the given genotypes/sexes, in the order of roles. """
+    return {
+        'samplegeno': [
+            {
+                'samplegeno_role': role,
+                'samplegeno_numgt': gt,
+                'samplegeno_sex': sex,
+                'samplegeno_sampleid': 'sample_%s' % role,
+            }
+            for role, gt, sex in zip(roles, gts, sexes)
+        ],
+        'novoPP': novoPP,
+    }
+
+
+@pytest.mark.parametrize('structural_variant', [False, True])
+@pytest.mark.parametrize('chrom', ['1', 'X', 'Y'])
+def test_compute_inheritance_modes_batch_parity(chrom, structural_variant):
+    """ Tests the batch computation gives exactly the results of compute_inheritance_modes for all trio
+        genotype/sex combinations, raising where it raises. """
+    gts = ['./.', '0/0', '0/1', '1/1', '1/2', '0/2', '1/0']
+    variant_samples, expected = [], []
+    for gt_self, gt_mother, gt_father in itertools.product(gts, repeat=3):
+        for sexes in itertools.product(['M', 'F', 'U'], ['F', 'U'], ['M', 'U']):
+            for novoPP in [-1, 0, .05, .5, .95]:
+                variant_sample = build_trio_variant_sample([gt_self, gt_mother, gt_father], sexes, novoPP)
+                try:
+                    expected_fields = InheritanceMode.compute_inheritance_modes(
+                        variant_sample, chrom=chrom, structural_variant=structural_variant)
+                except ValueError:
+                    with pytest.raises(ValueError):
+                        InheritanceMode.compute_inheritance_modes_batch(
+                            [variant_sample], [chrom], structural_variant=structural_variant)
+                    continue
+                variant_samples.append(variant_sample)
+                expected.append(expected_fields)
+    assert InheritanceMode.compute_inheritance_modes_batch(
+        variant_samples, [chrom] * len(variant_samples), structural_variant=structural_variant
+    ) == expected
+
+
+@pytest.mark.parametrize('variant_sample, chrom', [
+    (build_trio_variant_sample(['0/1', '0/0', '0/0'], ['F', 'F', 'M'], -1, roles=('mother', 'proband', 'father')),
+     '1'),  # roles in any order
+    (build_trio_variant_sample(['0/1', '0/0', '0/0'], ['F', 'F', 'M'], -1), 'M'),  # mitochondrial
+    (build_trio_variant_sample(['0/1', '0/0'], ['F', 'F'], -1), '1'),  # not a trio
+    (build_trio_variant_sample(['0/1', '0/0', '0/0', '1/1'], ['F', 'F', 'M', 'M'], -1,
+                               roles=('proband', 'mother', 'father', 'brother')), '1'),
+    (build_trio_variant_sample(['0/1', '0/0', '00/0'], ['F', 'F', 'M'], -1), '1'),  # non canonical genotype
+    (dict(build_trio_variant_sample(['1/1', '0/1', '0/1'], ['F', 'F', 'M'], -1),
+          cmphet=[{'comhet_phase': 'Phased', 'comhet_impact_gene': 'STRONG'}]), '1'),
+    ({'samplegeno': []}, '1'),
+])
+def test_compute_inheritance_modes_batch_other_samples(variant_sample, chrom):
+    """ Tests variant samples that are not computed through the trio batch still give the same results """
+    assert InheritanceMode.compute_inheritance_modes_batch([variant_sample], [chrom]) == [
+        InheritanceMode.compute_inheritance_modes(variant_sample, chrom=chrom)
+    ]
+
+
+def test_compute_inheritance_modes_batch_variant_uuid():
+    """ Tests the batch computation does not read the chromosome from the variant, which variant samples link
+        by uuid. """
+    variant_sample = build_trio_variant_sample(['0/1', '0/0', '0/0'], ['F', 'F', 'M'], -1)
+    expected = InheritanceMode.compute_inheritance_modes(variant_sample, chrom=None)
+    variant_sample['variant'] = 'f6aef055-4c88-4a3e-a306-d37a71535d8b'
+    assert InheritanceMode.compute_inheritance_modes_batch([variant_sample], [None]) == [expected]
+
+
+@pytest.mark.parametrize('novoPP', [None, '.'])
+@pytest.mark.parametrize('gts, sexes', [
+    ({'proband': './.', 'mother': '0/0', 'father': '0/0'}, {'proband': 'F', 'mother': 'F', 'father': 'M'}),
+    ({'proband': '0/1', 'mother': '0/0'}, {'proband': 'F', 'mother': 'F'}),
+])
+def test_compute_family_inheritance_missing_novopp(gts, sexes, novoPP):
+    """ Tests a missing novoPP does not fail memoized family inheritance for no-calls or missing roles,
+        for which trio inheritance modes are not computed """
+    genotype_labels = InheritanceMode.compute_family_genotype_labels(gts, sexes, 'autosome')
+    assert InheritanceMode.compute_inheritance_mode_trio(
+        genotypes=gts, genotype_labels=genotype_labels, sexes=sexes, chrom='autosome', novoPP=novoPP) == []
+    labels, modes, other_modes = InheritanceMode.compute_family_inheritance(
+        genotypes=tuple(gts.items()), sexes=tuple(sexes.items()), chrom='autosome', novoPP=novoPP)
+    assert (labels, modes) == (genotype_labels, [])
+    assert other_modes == InheritanceMode.inheritance_modes_other_labels(gts, genotype_labels)
@@ -0,0 +1,183 @@
+import gzip
+from unittest import mock
+
+import pysam
+import pytest
+from vcf import Reader
+
+from ..commands import reformat_vcf as reformat_vcf_module
+from ..commands.add_altcounts_by_gene import main as add_altcounts
+from ..commands.preprocess_vcf import (
+    iter_preprocessed_vcf_lines, runner as preprocess_vcf, write_preprocessed_vcf_records
+)
+from ..commands.reformat_vcf import get_regions, runner as reformat_vcf
+from ..ingestion.vcf_reader import LazyVCFReader, PreprocessedVCFReader
+from ..ingestion.vcf_utils import VCFParser
+from ..util import resolve_file_path
+from .test_vcf_reader import assert_same_record
+from .test_vcf_utils import VARIANT_SAMPLE_SCHEMA, VARIANT_SCHEMA
+
+
+pytestmark = [pytest.mark.working, pytest.mark.ingestion]
+
+ANNOTATED_VCF = resolve_file_path("tests/data/variant_workbook/GAPFI4LHHWB6_subset_v0.5.0.vcf")
+# Region size putting a region boundary within the REF of a variant, at 1:979034 CGAA
+REGION_SIZE = 979034
+SAMPLEGENO_DEF = ('##INFO=<ID=SAMPLEGENO,Number=.,Type=String,Description="Sample genotype information. '
+                  'Subembedded:\'samplegeno\':Format:\'NUMGT|GT|AD|SAMPLEID\'">')
+
+
+def add_samplegeno(line, samples):
+    """ Adds SAMPLEGENO, as annotated upstream, to the given variant line of ANNOTATED_VCF. """
+    fields = line.rstrip("\n").split("\t")
+    samplegeno = []
+    for sample, call in zip(samples, fields[9:]):
+        data = dict(zip(fields[8].split(":"), call.split(":")))
+        genotype = data["GT"].replace("|", "/")
+        samplegeno.append("|".join([genotype, genotype, data.get("AD", ".").replace(",", "/"), sample]))
+    fields[7] += ";SAMPLEGENO=" + ",".join(samplegeno)
+    return "\t".join(fields) + "\n"
+
+
+@pytest.fixture
+def annotated_vcf(tmp_path):
+    """ Gzipped annotated VCF as input to reformat_vcf, ie: with SAMPLEGENO but no custom tags. """
+    path = tmp_path / "annotated.vcf.gz"
+    added_definition, samples = False, []
+    with open(ANNOTATED_VCF, "r", encoding="utf-8") as f:
+        with gzip.open(path, "wt", encoding="utf-8") as out:
+            for line in f:
+                if line.startswith("##INFO") and not added_definition:
+                    out.write(SAMPLEGENO_DEF + "\n")
+                    added_definition = True
+                elif line.startswith("#CHROM"):
+                    samples = line.rstrip().split("\t")[9:]
+                out.write(line if line.startswith("#") else add_samplegeno(line, samples))
+    return str(path)
+
+
+@pytest.fixture
+def indexed_vcf(annotated_vcf, tmp_path):
+    """ Annotated VCF, bgzipped and tabix indexed, with its second half of variants moved to chr2. """
+    path = str(tmp_path / "indexed.vcf")
+    with gzip.open(annotated_vcf, "rt", encoding="utf-8") as f:
+        lines = f.readlines()
+    variants = [line for line in lines if not line.startswith("#")]
+    with open(path, "w", encoding="utf-8") as out:
+        out.writelines(line for line in lines if line.startswith("#"))
+        out.writelines(variants[:len(variants) // 2])
+        out.writelines(line.replace("chr1", "chr2", 1) for line in variants[len(variants) // 2:])
+    return pysam.tabix_index(path, preset="vcf")
+
+
+@pytest.fixture
+def expected_vcf(annotated_vcf, tmp_path):
+    """ Output of reformat_vcf followed by add_altcounts_by_gene. """
+    reformatted = str(tmp_path / "reformatted.vcf")
+    outputfile = str(tmp_path / "altcounts.vcf")
+    reformat_vcf({"inputfile": annotated_vcf, "outputfile": reformatted, "verbose": False})
+    add_altcounts({"inputfile": reformatted, "outputfile": outputfile})
+    with open(outputfile, "r", encoding="utf-8") as f:
+        return f.read()
+
+
+def test_iter_preprocessed_vcf_lines_matches_scripts(annotated_vcf, expected_vcf):
+    """ Tests the fused engine gives the same lines as reformat_vcf followed by add_altcounts_by_gene. """
+    assert "SAMPLEGENO=" in expected_vcf
+    assert "".join(iter_preprocessed_vcf_lines(annotated_vcf)) == expected_vcf
+
+
+def test_preprocess_vcf_runner_matches_scripts(annotated_vcf, expected_vcf, tmp_path):
+    """ Tests the file written by the fused engine is identical to that of the scripts. """
+    outputfile = str(tmp_path / "preprocessed.vcf")
+    preprocess_vcf({"inputfile": annotated_vcf, "outputfile": outputfile, "verbose": False})
+    with open(outputfile, "rb") as f:
+        assert f.read() == expected_vcf.encode("utf-8")
+
+
+def test_iter_preprocessed_vcf_lines_read_by_vcf_reader(annotated_vcf):
+    """ Tests the streamed lines can be parsed directly, with custom tags and alt counts added. """
+    records = list(Reader(iter_preprocessed_vcf_lines(annotated_vcf)))
+    assert records
+    for record in records:
+        assert "GENES" in record.INFO and "variantClass" in record.INFO
+        for entry in record.INFO["SAMPLEGENO"]:
+            assert len(entry.split("|")) == 5
+
+
+def read_file(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def test_get_regions(indexed_vcf):
+    """ Tests contigs are split in regions of the given size up to their length in the header. """
+    header = reformat_vcf_module.vcf_parser.Vcf(indexed_vcf).header
+    regions = get_regions(indexed_vcf, header, region_size=100000000)
+    assert regions == [("chr1", 0, 100000000), ("chr1", 100000000, 200000000), ("chr1", 200000000, None),
+                       ("chr2", 0, 100000000), ("chr2", 100000000, 200000000), ("chr2", 200000000, None)]
+
+
+@pytest.mark.parametrize("indexed", [True, False])
+def test_reformat_vcf_processes(indexed, annotated_vcf, indexed_vcf, tmp_path):
+    """ Tests reformatting regions in parallel gives the same output as a single process,
+        falling back to a single process if the VCF is not tabix indexed. """
+    inputfile = indexed_vcf if indexed else annotated_vcf
+    serial, parallel = str(tmp_path / "serial.vcf"), str(tmp_path / "parallel.vcf")
+    reformat_vcf({"inputfile": inputfile, "outputfile": serial, "verbose": False})
+    with mock.patch.object(reformat_vcf_module, "REGION_SIZE", REGION_SIZE):
+        reformat_vcf({"inputfile": inputfile, "outputfile": parallel, "verbose": False, "processes": 2})
+    assert read_file(parallel) == read_file(serial)
+    assert read_file(serial).count(b"\tCGAA\t") == 1
+
+
+def test_iter_preprocessed_vcf_lines_processes(indexed_vcf):
+    """ Tests preprocessing regions in parallel gives the same lines as a single process. """
+    expected = "".join(iter_preprocessed_vcf_lines(indexed_vcf))
+    with mock.patch.object(reformat_vcf_module, "REGION_SIZE", REGION_SIZE):
+        assert "".join(iter_preprocessed_vcf_lines(indexed_vcf, processes=2)) == expected
+
+
+@pytest.fixture
+def preprocessed_records(annotated_vcf, tmp_path):
+    """ Annotated VCF preprocessed as binary records. """
+    path = str(tmp_path / "preprocessed.records")
+    write_preprocessed_vcf_records(annotated_vcf, path)
+    return path
+
+
+def test_preprocessed_vcf_records_read_by_parser(annotated_vcf, preprocessed_records):
+    """ Tests the parser gives the same records/variants from binary records as from preprocessed VCF lines. """
+    records_parser = VCFParser(None, VARIANT_SCHEMA, VARIANT_SAMPLE_SCHEMA,
+                               reader=PreprocessedVCFReader.open(preprocessed_records))
+    parser = VCFParser(None, VARIANT_SCHEMA, VARIANT_SAMPLE_SCHEMA,
+                       reader=LazyVCFReader(iter_preprocessed_vcf_lines(annotated_vcf)))
+    assert records_parser.get_header_lines() == parser.get_header_lines()
+    assert records_parser.format == parser.format
+    records, expected = list(records_parser), list(parser)
+    assert len(records) == len(expected) > 0
+    for record, expected_record in zip(records, expected):
+        assert_same_record(record, expected_record)
+        assert records_parser.create_variant_from_record(record) == parser.create_variant_from_record(expected_record)
+        assert (records_parser.create_sample_variant_from_record(record)
+                == parser.create_sample_variant_from_record(expected_record))
+
+
+def test_preprocessed_vcf_records_from_header_lines(preprocessed_records):
+    """ Tests raw binary records are parsed by a parser created from the header lines, as by worker processes. """
+    parser = VCFParser(None, VARIANT_SCHEMA, VARIANT_SAMPLE_SCHEMA,
+                       reader=PreprocessedVCFReader.open(preprocessed_records))
+    raw_records = list(parser.iter_raw_records())
+    from_header = VCFParser.from_header_lines(parser.get_header_lines(), VARIANT_SCHEMA, VARIANT_SAMPLE_SCHEMA,
+                                              reader_class=PreprocessedVCFReader)
+    expected = VCFParser(None, VARIANT_SCHEMA, VARIANT_SAMPLE_SCHEMA,
+                         reader=PreprocessedVCFReader.open(preprocessed_records))
+    assert len(raw_records) > 0
+    for raw_record, record in zip(raw_records, expected):
+        assert_same_record(from_header.parse_raw_record(raw_record), record)
+
+
+def test_preprocessed_vcf_reader_open_vcf():
+    """ Tests a VCF is not read as binary records. """
+    with pytest.raises(ValueError):
+        PreprocessedVCFReader.open(ANNOTATED_VCF)
@@ -1,6 +1,16 @@
 import json
 import pytest
 import csv
+from contextlib import contextmanager
+from unittest import mock
+
+from pyramid.request import Request
+from pyramid.scripting import prepare
+from snovault import STORAGE
+from snovault.util import filter_embedded
+
+from .. import batch_download
+from ..batch_download import embed_and_merge_note_items_to_variant_samples, get_indexed_notes
 
 pytestmark = [pytest.mark.working, pytest.mark.schema, pytest.mark.search, pytest.mark.workbook]
 
@@ -116,3 +126,72 @@ def test_interpretation_tab(workbook, html_es_testapp):
 
     check_spreadsheet_rows(result_rows, colname_to_index)
 
+
+def test_embed_and_merge_note_items_to_variant_samples():
+    """ Tests notes recurring across variant samples are only fetched once, and merged everywhere. """
+    gene_note, variant_note, vs_note = "/notes-standard/gene/", "/notes-standard/variant/", "/notes-standard/vs/"
+    embedded_vss = [
+        {
+            "variant": {"variant_notes": {"@id": variant_note}, "genes": [
+                {"genes_most_severe_gene": {"gene_notes": {"@id": gene_note}}}
+            ]},
+            "variant_notes": {"@id": vs_note},
+        },
+        {
+            "variant": {"variant_notes": {"@id": variant_note}, "genes": [
+                {"genes_most_severe_gene": {"gene_notes": {"@id": gene_note}}}
+            ]},
+        },
+    ]
+    request = mock.Mock(method="GET", datastore="database")
+    with mock.patch.object(batch_download, "embed_note",
+                           side_effect=lambda _, note_id: {"@id": note_id, "note_text": note_id}) as embed_note:
+        embed_and_merge_note_items_to_variant_samples(request, embedded_vss)
+    assert sorted(call.args[1] for call in embed_note.call_args_list) == sorted([gene_note, variant_note, vs_note])
+    for embedded_vs in embedded_vss:
+        assert embedded_vs["variant"]["variant_notes"]["note_text"] == variant_note
+        assert embedded_vs["variant"]["genes"][0]["genes_most_severe_gene"]["gene_notes"]["note_text"] == gene_note
+    assert embedded_vss[0]["variant_notes"]["note_text"] == vs_note
+
+
+# Notes of tests/data/workbook-inserts/note_interpretation.json, "in review" so only visible to hms-dbmi and admins
+WORKBOOK_NOTE_IDS = [
+    "/notes-interpretation/ab5e1c89-4c88-4a3e-a306-d37a12defd8b/",
+    "/notes-interpretation/de5e1c12-4c88-4a3e-a306-d37a12defa6b/",
+]
+
+
+@contextmanager
+def es_request(es_app, remote_user):
+    """ Request to es_app for the given user, reading from Elasticsearch, with threadlocals set. """
+    request = Request.blank("/", environ={"REMOTE_USER": remote_user, "HTTP_ACCEPT": "application/json"})
+    with prepare(request=request, registry=es_app.registry) as env:
+        yield env["request"]
+
+
+def test_get_indexed_notes(workbook, es_app, es_testapp):
+    """ Tests notes are fetched from Elasticsearch together, unless stale or not viewable by the user. """
+    visible_note_id, stale_note_id = WORKBOOK_NOTE_IDS
+    stale_uuid = stale_note_id.split("/")[-2]
+    with es_request(es_app, "TEST") as request:
+        assert request.datastore == "elasticsearch"
+        get_sids_by_uuids = request.registry[STORAGE].write.get_sids_by_uuids
+
+        def get_sids_with_stale_note(uuids):
+            """ Sids as if the stale note were modified since it was indexed. """
+            sids = get_sids_by_uuids(uuids)
+            if stale_uuid in sids:
+                sids[stale_uuid] += 1
+            return sids
+
+        with mock.patch.object(request.registry[STORAGE].write, "get_sids_by_uuids",
+                               side_effect=get_sids_with_stale_note):
+            with mock.patch.object(batch_download, "filter_embedded", wraps=filter_embedded) as filtered:
+                notes = get_indexed_notes(request, WORKBOOK_NOTE_IDS)
+        assert list(notes) == [visible_note_id]
+        assert notes[visible_note_id] == es_testapp.get(visible_note_id + "@@embedded").json
+        [(_, effective_principals)] = [call.args for call in filtered.call_args_list]
+        assert effective_principals == request.effective_principals
+
+    with es_request(es_app, "TEST_AUTHENTICATED") as request:
+        assert get_indexed_notes(request, WORKBOOK_NOTE_IDS) == {}
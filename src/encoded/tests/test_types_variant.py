@@ -1,5 +1,9 @@
 import pytest
+from unittest import mock
 
+from snovault import COLLECTIONS
+
+from ..types import variant_consequence
 
 pytestmark = [pytest.mark.working, pytest.mark.schema]
 
@@ -311,3 +315,36 @@ def test_additional_variant_names(testapp, gene, variant, hgvsc, hgvsp, result):
         patch_body["genes"][0]["genes_most_severe_hgvsp"] = hgvsp
     resp = testapp.patch_json(variant_atid, patch_body, status=200).json['@graph'][0]
     assert sorted(resp['additional_variant_names']) == sorted(result)
+
+
+@pytest.mark.parametrize("found, viewable, expected", [
+    (True, True, UTR_3_CONSEQUENCE),
+    (True, False, None),
+    (False, True, None),
+])
+def test_get_variant_consequence_name(found, viewable, expected):
+    """Test consequence names are only given for consequences the user can view."""
+    item = mock.Mock(properties={"var_conseq_name": UTR_3_CONSEQUENCE})
+    collection = mock.Mock()
+    collection.get.return_value = item if found else None
+    request = mock.Mock(registry={COLLECTIONS: {"variant_consequence": collection}})
+    request.has_permission.return_value = viewable
+    consequence = LOCATION_CONSEQUENCES[0]["uuid"]
+    assert variant_consequence.get_variant_consequence_name(request, consequence) == expected
+    collection.get.assert_called_once_with(consequence)
+    if found:
+        request.has_permission.assert_called_once_with("view", item)
+
+
+def test_most_severe_location_consequence_renamed(testapp, variant, consequence_name_to_atid):
+    """Test 'most_severe_location' reflects consequences edited since it was last calculated."""
+    transcript = make_transcript(
+        exon="2/6", most_severe=True, consequences=[consequence_name_to_atid[UTR_3_CONSEQUENCE]]
+    )
+    variant_atid = variant.get("@id")
+    response = testapp.patch_json(variant_atid, {"transcript": [transcript]}, status=200).json["@graph"][0]
+    assert response["most_severe_location"] == "Exon 2/6 (3' UTR)"
+    testapp.patch_json(consequence_name_to_atid[UTR_3_CONSEQUENCE], {"var_conseq_name": UTR_5_CONSEQUENCE},
+                       status=200)
+    response = testapp.get(variant_atid + "?frame=object", status=200).json
+    assert response["most_severe_location"] == "Exon 2/6 (5' UTR)"
@@ -0,0 +1,152 @@
+import gzip
+import shutil
+
+import pytest
+
+from ..commands.validate_vcf import VCFValidator
+from ..ingestion.ingestion_message_handler_vcf import build_validation_error_report, validate_vcf
+from ..util import resolve_file_path
+from .test_vcf_utils import TEST_CNV_VCF, TEST_SV_VCF, TEST_VCF
+
+
+pytestmark = [pytest.mark.working, pytest.mark.ingestion]
+
+ANNOTATED_VCF = resolve_file_path("tests/data/variant_workbook/GAPFI4LHHWB6_subset_v0.5.0.vcf")
+# VCF with 15 sample calls having more values than their FORMAT, which PyVCF fails to read
+MALFORMED_VCF = resolve_file_path("tests/data/variant_workbook/vcf_v0.4.6_subset.vcf")
+
+
+def write_vcf(tmp_path, replacements):
+    """ Writes TEST_VCF with the given (old, new) replacements of its lines, returning its path. """
+    path = str(tmp_path / "test.vcf")
+    with open(TEST_VCF, "r") as f:
+        content = f.read()
+    for old, new in replacements:
+        assert old in content
+        content = content.replace(old, new, 1)
+    with open(path, "w") as f:
+        f.write(content)
+    return path
+
+
+def get_line_number(path, prefix):
+    with open(path, "r") as f:
+        for line_number, line in enumerate(f, 1):
+            if line.startswith(prefix):
+                return line_number
+
+
+@pytest.mark.parametrize("build_items", [True, False])
+def test_validate_vcf(build_items):
+    """ Tests a VCF ingested as is validates, records built or not. """
+    report = VCFValidator(TEST_VCF, build_items=build_items).get_report()
+    assert report["valid"] is True
+    assert report["records"] == 7
+    assert report["error_count"] == 0 and report["errors"] == [] and report["truncated"] is False
+    assert report["warnings"] == []
+    assert VCFValidator(TEST_VCF).validate() is True
+
+
+def test_validate_vcf_reports_all_errors():
+    """ Tests all records of a malformed VCF are validated, errors reported with their line numbers. """
+    report = VCFValidator(MALFORMED_VCF).get_report()
+    assert report["valid"] is False
+    assert report["records"] == 151
+    assert report["error_count"] == len(report["errors"]) == 15
+    assert report["errors"][0] == {"line": 104, "error": "could not convert string to float: '14,0,24,0'"}
+    assert [error["line"] for error in report["errors"]] == sorted(error["line"] for error in report["errors"])
+    assert VCFValidator(MALFORMED_VCF).validate() is False
+
+
+def test_validate_vcf_processes():
+    """ Tests blocks of records validated in worker processes give the same report, errors capped. """
+    expected = VCFValidator(MALFORMED_VCF).get_report()
+    report = VCFValidator(MALFORMED_VCF, processes=2, block_size=10, max_errors=5).get_report()
+    assert report["records"] == expected["records"]
+    assert report["error_count"] == 15
+    assert report["errors"] == expected["errors"][:5]
+    assert report["truncated"] is True
+
+
+def test_validate_vcf_header_types(tmp_path):
+    """ Tests a field mapped as is whose header type is not castable to its schema type is an error. """
+    path = write_vcf(tmp_path, [("ID=novoPP,Number=1,Type=Float", "ID=novoPP,Number=0,Type=Flag")])
+    report = VCFValidator(path).get_report()
+    assert report["valid"] is False
+    assert report["errors"] == [{
+        "line": get_line_number(path, "##INFO=<ID=novoPP"),
+        "error": "INFO field novoPP has type Flag, which is not castable to number as in the mapping table"
+    }]
+
+
+def test_validate_vcf_missing_mapped_fields():
+    """ Tests annotation fields of the mapping table missing from the header are warnings. """
+    report = VCFValidator(ANNOTATED_VCF).get_report()
+    assert report["valid"] is True
+    [warning] = report["warnings"]
+    assert warning["line"] == get_line_number(ANNOTATED_VCF, "##INFO=<ID=CSQ")
+    assert warning["error"].startswith("Fields of the mapping table missing from the CSQ INFO header: ")
+    assert "csq_most_severe" in warning["error"]
+
+
+def test_validate_vcf_malformed_records(tmp_path):
+    """ Tests records with missing columns or values that do not cast are errors. """
+    with open(TEST_VCF, "r") as f:
+        records = [line for line in f if not line.startswith("#")]
+    first, second = records[0].split("\t"), records[1].split("\t")
+    path = write_vcf(tmp_path, [
+        (records[0], "\t".join(first[:8]) + "\n"),
+        (records[1], "\t".join(second[:1] + ["pos"] + second[2:])),
+    ])
+    report = VCFValidator(path).get_report()
+    first_line = get_line_number(path, "#CHROM") + 1
+    assert report["errors"] == [
+        {"line": first_line, "error": "Expected %s columns, found 8" % len(first)},
+        {"line": first_line + 1, "error": "invalid literal for int() with base 10: 'pos'"},
+    ]
+
+
+def test_validate_vcf_no_header(tmp_path):
+    """ Tests a VCF without header is a single error. """
+    path = str(tmp_path / "test.vcf")
+    with open(path, "w") as f:
+        f.write("chr1\t100\t.\tA\tC\t50\tPASS\t.\n")
+    report = VCFValidator(path).get_report()
+    assert report["valid"] is False
+    assert report["records"] == 0
+    assert report["errors"] == [{"line": 0, "error": "Could not parse VCF header: No #CHROM header line"}]
+
+
+def test_validate_vcf_unreadable(tmp_path):
+    """ Tests a VCF that cannot be decompressed, ie: truncated or not gzipped, is reported as an error. """
+    with open(TEST_VCF, "rb") as f:
+        content = gzip.compress(f.read())
+    truncated = str(tmp_path / "truncated.vcf.gz")
+    with open(truncated, "wb") as f:
+        f.write(content[:len(content) // 2])
+    not_gzipped = str(tmp_path / "not_gzipped.vcf.gz")
+    shutil.copyfile(TEST_VCF, not_gzipped)
+    for path in [truncated, not_gzipped]:
+        report = VCFValidator(path).get_report()
+        assert report["valid"] is False
+        assert report["error_count"] == 1
+        assert report["errors"][0]["line"] == 0
+        assert report["errors"][0]["error"].startswith("Could not read VCF: ")
+
+
+@pytest.mark.parametrize("vcf_path, vcf_type", [
+    (TEST_VCF, "SNV"), (TEST_SV_VCF, "SV"), (TEST_CNV_VCF, "CNV"),
+])
+def test_ingestion_validate_vcf(vcf_path, vcf_type):
+    """ Tests the pre-flight validation of the ingestion listener accepts VCFs of all types. """
+    report = validate_vcf(vcf_path, vcf_type)
+    assert report["valid"] is True
+    assert report["records"] > 0
+
+
+def test_build_validation_error_report():
+    """ Tests validation errors are reported as ingestion errors, rows being line numbers. """
+    report = validate_vcf(MALFORMED_VCF, "SNV")
+    error_report = build_validation_error_report(report)
+    assert len(error_report) == 15
+    assert error_report[0] == {"body": "could not convert string to float: '14,0,24,0'", "row": 104}
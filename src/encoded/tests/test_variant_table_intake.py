@@ -1,3 +1,4 @@
+import csv
 import io
 import json
 from unittest import mock
@@ -7,7 +8,7 @@ from dcicutils.diff_utils import DiffManager
 from dcicutils.misc_utils import file_contents
 from ..util import resolve_file_path
 from ..ingestion.table_utils import (
-    VariantTableParser, MappingTableHeader, StructuralVariantTableParser
+    VariantTableParser, MappingTableDiff, MappingTableHeader, StructuralVariantTableParser
 )
 from .variant_fixtures import ANNOTATION_FIELD_URL
 
@@ -259,6 +260,88 @@ def test_post_inserts_via_run(MTParser, project, institution, testapp):
     assert not variant_schema_delta
     assert not variant_sample_schema_delta
 
+
+def write_updated_table(mapping_table, fname, update):
+    """ Writes a copy of the given mapping table to fname, with its field rows (dicts) updated by update """
+    with io.open(mapping_table, 'r', encoding='utf-8-sig') as f:
+        rows = list(csv.reader(f))
+    header = rows[MappingTableHeader.HEADER_ROW_INDEX]
+    fields = update([dict(zip(header, row)) for row in rows[MappingTableHeader.HEADER_ROW_INDEX + 1:]])
+    with io.open(fname, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerows(rows[:MappingTableHeader.HEADER_ROW_INDEX + 1])
+        writer.writerows([field.get(name, '') for name in header] for field in fields)
+    return str(fname)
+
+
+def test_mapping_table_diff(tmp_path):
+    """ Tests the diff of two mapping tables reports added, removed, retyped and changed fields
+        and whether their mapping changes need a reindex """
+    def update(fields):
+        updated = []
+        for field in fields:
+            if field['field_name'] == 'ID':  # removed
+                continue
+            if field['field_name'] == 'CHROM':
+                field['schema_title'] = 'Chrom'
+            elif field['field_name'] == 'POS':
+                field['field_type'] = 'string'
+            elif field['field_name'] == 'REF':
+                updated.append(dict(field, field_name='REF_UPDATED'))
+            updated.append(field)
+        return updated
+
+    new_table = write_updated_table(MT_LOC, tmp_path / 'variant_table.csv', update)
+    report = MappingTableDiff.from_tables(VariantTableParser, MT_LOC, new_table, ANNOTATION_FIELD_SCHEMA)
+    report = report.generate_report()
+    assert report['version'] == report['previous_version'] == VARIANT_TABLE_VERSION
+    variant_report = report['item_types']['variant']
+    assert variant_report['added'] == ['REF_UPDATED']
+    assert variant_report['removed'] == ['ID']
+    assert variant_report['retyped'] == ['POS']
+    assert variant_report['changed'] == ['CHROM']
+    assert variant_report['mapping_change'] == MappingTableDiff.BREAKING_MAPPING_CHANGE
+    assert variant_report['properties']['ID'] is None
+    assert variant_report['properties']['POS']['type'] == 'string'
+    assert sorted(variant_report['properties']) == ['CHROM', 'ID', 'POS', 'REF_UPDATED']
+    sample_report = report['item_types']['variant_sample']
+    assert sample_report['mapping_change'] == MappingTableDiff.NO_MAPPING_CHANGE
+    assert sample_report['properties'] == {}
+    assert report['reindex_required'] == ['variant']
+
+
+def test_mapping_table_diff_properties():
+    """ Tests sub-embedded fields are compared by path, arrays being mapped as their items """
+    previous = {
+        'transcript': {'type': 'array', 'items': {'type': 'object', 'properties': {
+            'csq_gene': {'type': 'string'}, 'csq_exon': {'type': 'string'}
+        }}},
+        'samplegeno': {'type': 'string'},
+        'af': {'type': 'number'},
+    }
+    new = {
+        'transcript': {'type': 'array', 'items': {'type': 'object', 'properties': {
+            'csq_gene': {'type': 'array', 'items': {'type': 'string'}}, 'csq_cds': {'type': 'string'}
+        }}},
+        'samplegeno': {'type': 'array', 'items': {'type': 'object', 'properties': {'numgt': {'type': 'string'}}}},
+        'af': {'type': 'number', 'title': 'AF'},
+    }
+    diff = MappingTableDiff.diff_properties(previous, new)
+    assert diff == {
+        'added': ['samplegeno.numgt', 'transcript.csq_cds'],
+        'removed': ['transcript.csq_exon'],
+        'retyped': ['samplegeno'],
+        'changed': ['af', 'transcript.csq_gene'],
+    }
+    assert MappingTableDiff.get_mapping_change(dict(diff, removed=[], retyped=[])) == 'additive'
+
+
+def test_mapping_table_diff_facets():
+    """ Tests facets (or columns) are compared by key """
+    previous = {'CHROM': {'title': 'Chromosome'}, 'POS': {'title': 'Position'}}
+    new = {'CHROM': {'title': 'Chrom'}, 'REF': {'title': 'Reference'}}
+    assert MappingTableDiff.diff_keys(previous, new) == {'added': ['REF'], 'removed': ['POS'], 'changed': ['CHROM']}
+
 @pytest.fixture
 def sv_schema():
     schema = {
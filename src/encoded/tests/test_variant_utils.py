@@ -1,10 +1,15 @@
+import json
 from unittest import mock
 import pytest
 # from dcicutils.misc_utils import VirtualApp
 
-from ..ingestion.variant_utils import StructuralVariantBuilder, VariantBuilder
-from ..ingestion.vcf_utils import StructuralVariantVCFParser  # , VCFParser
-from .test_vcf_utils import SV_SAMPLE_SCHEMA, SV_SCHEMA, TEST_SV_VCF
+from ..inheritance_mode import InheritanceMode
+from ..ingestion.variant_utils import FamilyContext, StructuralVariantBuilder, VariantBuilder, VariantBuilderError
+from ..ingestion.vcf_utils import StructuralVariantVCFParser, VCFParser
+from ..util import resolve_file_path
+from .test_vcf_utils import (
+    SV_SAMPLE_SCHEMA, SV_SCHEMA, TEST_SV_VCF, TEST_VCF, VARIANT_SAMPLE_SCHEMA, VARIANT_SCHEMA
+)
 
 pytestmark = [pytest.mark.working, pytest.mark.ingestion]
 
@@ -44,6 +49,314 @@ def test_ingestion_listener_build_familial_relations(
         assert relations["sample_three"]["samplegeno_sex"] == "M"
 
 
+def test_family_context_add_relations(mocked_familial_relations):
+    """ Tests relations are added to the samplegeno entries of the samples they are known for. """
+    with mock.patch.object(
+        VariantBuilder,
+        "search_for_sample_relations",
+        new=lambda x: mocked_familial_relations,
+    ):
+        family = FamilyContext(VariantBuilder(None, None, None).extract_sample_relations())
+    assert FamilyContext.of(family) is family
+    for _ in range(2):  # relations of the samples are looked up once, then reused
+        samplegeno = [
+            {"samplegeno_sampleid": "sample_three", "samplegeno_numgt": "0/1"},
+            {"samplegeno_sampleid": "sample_four", "samplegeno_numgt": "0/0"},
+            {"samplegeno_sampleid": "sample_one", "samplegeno_numgt": "0/0"},
+        ]
+        family.add_relations(samplegeno)
+        assert samplegeno == [
+            {"samplegeno_sampleid": "sample_three", "samplegeno_numgt": "0/1",
+             "samplegeno_role": "proband", "samplegeno_sex": "M"},
+            {"samplegeno_sampleid": "sample_four", "samplegeno_numgt": "0/0"},
+            {"samplegeno_sampleid": "sample_one", "samplegeno_numgt": "0/0",
+             "samplegeno_role": "mother", "samplegeno_sex": "F"},
+        ]
+
+
+def strip_last_modified(built_records):
+    """ Removes the (time dependent) last_modified fields from the given built records. """
+    for _, variant, variant_samples, _ in built_records:
+        for item in [variant] + (variant_samples or []):
+            if item:
+                item.pop("last_modified", None)
+    return built_records
+
+
+@pytest.mark.parametrize("builder_class, parser_class, vcf, variant_schema, sample_schema", [
+    (VariantBuilder, VCFParser, TEST_VCF, VARIANT_SCHEMA, VARIANT_SAMPLE_SCHEMA),
+    (StructuralVariantBuilder, StructuralVariantVCFParser, TEST_SV_VCF, SV_SCHEMA, SV_SAMPLE_SCHEMA),
+])
+def test_build_records_in_parallel(builder_class, parser_class, vcf, variant_schema, sample_schema):
+    """
+    Tests that building records in worker processes gives the same results,
+    in the same order, as building them in the current process.
+    """
+    serial_builder = builder_class(None, parser_class(vcf, variant_schema, sample_schema), "some_file")
+    expected = strip_last_modified(list(serial_builder.build_records({})))
+    parallel_builder = builder_class(None, parser_class(vcf, variant_schema, sample_schema), "some_file",
+                                     processes=2)
+    with mock.patch("encoded.ingestion.variant_utils.PARALLEL_BUILD_CHUNK_SIZE", 2):
+        built = strip_last_modified(list(parallel_builder.build_records_in_parallel({})))
+    assert [idx for idx, *_ in built] == list(range(len(expected)))
+    assert built == expected
+
+
+@pytest.mark.parametrize("processes", [None, 2])
+def test_build_records_metrics(processes):
+    """ Tests the time spent parsing, building and computing inheritance modes of records is recorded,
+        in worker processes too. """
+    builder = StructuralVariantBuilder(
+        None, StructuralVariantVCFParser(TEST_SV_VCF, SV_SCHEMA, SV_SAMPLE_SCHEMA), "some_file",
+        processes=processes,
+    )
+    with mock.patch("encoded.ingestion.variant_utils.PARALLEL_BUILD_CHUNK_SIZE", 2):
+        built = list(builder.build_records_in_parallel({}) if processes else builder.build_records({}))
+    stages = builder.metrics.get_stage_times()
+    assert list(stages) == ["parse", "build", "inheritance_modes"]
+    for stage in ["parse", "build", "inheritance_modes"]:
+        assert stages[stage]["count"] == len(built) > 0
+        assert stages[stage]["seconds"] > 0
+
+
+def test_build_records_from_start():
+    """ Tests that building records from a given index skips the records before it. """
+    builder = StructuralVariantBuilder(
+        None, StructuralVariantVCFParser(TEST_SV_VCF, SV_SCHEMA, SV_SAMPLE_SCHEMA), "some_file"
+    )
+    expected = strip_last_modified(list(builder.build_records({})))
+    for processes in [None, 2]:
+        builder = StructuralVariantBuilder(
+            None, StructuralVariantVCFParser(TEST_SV_VCF, SV_SCHEMA, SV_SAMPLE_SCHEMA), "some_file",
+            processes=processes,
+        )
+        if processes:
+            built = builder.build_records_in_parallel({}, start=2)
+        else:
+            built = builder.build_records({}, start=2)
+        assert strip_last_modified(list(built)) == expected[2:]
+
+
+def test_build_records_in_blocks():
+    """
+    Tests that building records a block at a time gives the same results as
+    building them one by one, and that an error computing inheritance modes is
+    only reported on the record causing it.
+    """
+    builder = StructuralVariantBuilder(
+        None, StructuralVariantVCFParser(TEST_SV_VCF, SV_SCHEMA, SV_SAMPLE_SCHEMA), "some_file"
+    )
+    expected = []
+    for idx, record in enumerate(builder.parser):
+        variant, variant_samples = builder.build_record(record, {})
+        expected.append((idx, variant, variant_samples, None))
+    expected = strip_last_modified(expected)
+    bad_variant = expected[1][2][0]["structural_variant"]
+    compute_inheritance_modes_batch = InheritanceMode.compute_inheritance_modes_batch
+
+    def mocked_compute_inheritance_modes_batch(variant_samples, chroms, structural_variant=False):
+        if any(sample["structural_variant"] == bad_variant for sample in variant_samples):
+            raise ValueError("Bad variant")
+        return compute_inheritance_modes_batch(variant_samples, chroms, structural_variant=structural_variant)
+
+    builder = StructuralVariantBuilder(
+        None, StructuralVariantVCFParser(TEST_SV_VCF, SV_SCHEMA, SV_SAMPLE_SCHEMA), "some_file"
+    )
+    with mock.patch("encoded.ingestion.variant_utils.INHERITANCE_BLOCK_SIZE", 2):
+        with mock.patch.object(InheritanceMode, "compute_inheritance_modes_batch",
+                               new=mocked_compute_inheritance_modes_batch):
+            built = strip_last_modified(list(builder.build_records({})))
+    assert built[1] == (1, None, None, "Bad variant")
+    assert built[:1] + built[2:] == expected[:1] + expected[2:]
+
+
+def test_checkpoint(testapp, file_vcf):
+    """
+    Tests that ingestion progress is saved on the file, restored from it and
+    cleared once ingestion is complete.
+    """
+    builder = StructuralVariantBuilder(testapp, None, file_vcf["uuid"], checkpoint_interval=2)
+    assert builder.get_checkpoint() is None
+    builder.ingestion_report.grand_total = 3
+    builder.ingestion_report.mark_failure(body="some error", row=1)
+    assert builder.checkpoint(1, 0) == 0  # not enough records since the last checkpoint
+    assert builder.get_checkpoint() is None
+    assert builder.checkpoint(4, 0) == 4
+    checkpoint = builder.get_checkpoint()
+    assert checkpoint == {
+        "records": 4,
+        "total_successful": 3,
+        "total_errors": 1,
+        "errors": [{"body": "some error", "row": 1}],
+    }
+
+    resumed = StructuralVariantBuilder(testapp, None, file_vcf["uuid"], resume=True)
+    assert resumed.restore_checkpoint(dict(checkpoint, total_errors=2)) == 4
+    assert resumed.ingestion_report.total_successful() == 3
+    assert resumed.ingestion_report.total_errors() == 2
+    assert resumed.ingestion_report.get_errors()[0] == {"body": "some error", "row": 1}
+
+    builder.clear_checkpoint()
+    assert builder.get_checkpoint() is None
+
+
+def test_post_variant_consequence_items(testapp, project, institution):
+    """
+    Tests that missing variant consequences are created in a single batch,
+    existing ones being left as they are, and that their uuids are cached.
+    """
+    builder = VariantBuilder(testapp, None, None, project=project["uuid"], institution=institution["uuid"])
+    builder.consequence_uuids = {}  # not cached in the process, as the items do not outlive this test
+    with open(resolve_file_path("annotations/variant_consequence.json")) as f:
+        consequences = json.load(f)
+    consequence = dict(consequences[0], project=project["uuid"], institution=institution["uuid"])
+    [result] = testapp.post_json("/bulk_upsert", {
+        "items": [{"item_type": "variant_consequence", "properties": consequence}],
+    }, status=200).json["@graph"]
+    assert result == {"status": "created", "uuid": consequence["uuid"]}
+
+    consequence_uuids = builder.post_variant_consequence_items()
+    assert consequence_uuids == {entry["var_conseq_name"]: entry["uuid"] for entry in consequences}
+    assert builder.consequence_uuids == consequence_uuids
+    assert builder.post_variant_consequence_items() == consequence_uuids
+
+    [result] = testapp.post_json("/bulk_upsert", {
+        "items": [{"item_type": "variant_consequence", "properties": dict(consequence, definition="updated")}],
+        "skip_existing": True,
+    }, status=200).json["@graph"]
+    assert result == {"status": "existing", "uuid": consequence["uuid"]}
+    raw = testapp.get("/variant-consequences/%s/?frame=raw" % consequence["uuid"]).json
+    assert raw["definition"] == consequence["definition"]
+
+
+def test_bulk_upsert_repeated_key(testapp, project, institution):
+    """ Tests an item whose unique key is repeated in a batch is created once, then updated. """
+    with open(resolve_file_path("annotations/variant_consequence.json")) as f:
+        consequence = dict(json.load(f)[0], project=project["uuid"], institution=institution["uuid"])
+    repeated = dict(consequence, definition="updated")
+    del repeated["uuid"]
+    results = testapp.post_json("/bulk_upsert", {
+        "items": [{"item_type": "variant_consequence", "properties": consequence},
+                  {"item_type": "variant_consequence", "properties": repeated}],
+    }, status=200).json["@graph"]
+    assert results == [{"status": "created", "uuid": consequence["uuid"]},
+                       {"status": "updated", "uuid": consequence["uuid"]}]
+    raw = testapp.get("/variant-consequences/%s/?frame=raw" % consequence["uuid"]).json
+    assert raw["definition"] == "updated"
+
+
+def test_defer_indexing_of():
+    """
+    Tests that the uuids of items written are kept once each, unchanged
+    items being kept only once resumed from a checkpoint.
+    """
+    builder = VariantBuilder(None, None, "some_file", defer_indexing=True)
+    results = [
+        {"status": "created", "uuid": "a"},
+        {"status": "unchanged", "uuid": "b"},
+        {"status": "error", "error": "some error"},
+        {"status": "updated", "uuid": "a"},
+    ]
+    builder.defer_indexing_of(results)
+    assert list(builder.deferred_uuids) == ["a"]
+    builder.resumed = True
+    builder.defer_indexing_of(results)
+    assert list(builder.deferred_uuids) == ["a", "b"]
+
+
+def test_write_record_defers_indexing():
+    """
+    Tests that records written one at a time (without batch_size) are
+    deferred too, as all writes go through the bulk endpoint.
+    """
+    vapp = mock.Mock()
+    vapp.post_json.side_effect = [
+        mock.Mock(json={"@graph": [{"status": "created", "uuid": uuid}]}) for uuid in ["a", "b"]
+    ]
+    builder = VariantBuilder(vapp, None, "some_file", defer_indexing=True)
+    builder.write_record(0, {"annotation_id": "variant"}, [{"annotation_id": "sample"}])
+    assert builder.ingestion_report.total_successful() == 1
+    assert [args[0] for args, kwargs in vapp.post_json.call_args_list] == [
+        VariantBuilder.BULK_UPSERT_ENDPOINT + "?skip_indexing=true"
+    ] * 2
+    assert list(builder.deferred_uuids) == ["a", "b"]
+
+
+def test_checkpoint_queues_deferred_indexing():
+    """
+    Tests that items written are queued for indexing before a checkpoint is
+    saved, the checkpoint not being saved if they could not be queued.
+    """
+    vapp = mock.Mock()
+    builder = VariantBuilder(vapp, None, "some_file", checkpoint_interval=2, defer_indexing=True)
+    builder.deferred_uuids = {"a": True, "b": True}
+    with mock.patch.object(builder, "save_checkpoint") as save_checkpoint:
+        vapp.post_json.side_effect = Exception("queue unavailable")
+        assert builder.checkpoint(2, 0) == 0
+        save_checkpoint.assert_not_called()
+        assert list(builder.deferred_uuids) == ["a", "b"]
+        vapp.post_json.side_effect = None
+        assert builder.checkpoint(2, 0) == 2
+        save_checkpoint.assert_called_once_with(2)
+    vapp.post_json.assert_called_with(VariantBuilder.QUEUE_INDEXING_ENDPOINT, {
+        "uuids": ["a", "b"], "target_queue": "primary", "strict": False
+    }, status=200)
+    assert builder.deferred_uuids == {}
+    assert builder.metrics.counters["queued_for_indexing"] == 2
+
+
+@pytest.mark.parametrize("queue_error", [None, Exception("queue unavailable")])
+def test_ingest_vcf_queues_remaining_deferred_indexing(queue_error):
+    """
+    Tests that items written since the last checkpoint are queued for indexing
+    at the end of the ingestion, the failure to do so being reported and a
+    checkpoint being kept to queue them once the file is ingested again.
+    """
+    vapp = mock.Mock()
+    vapp.post_json.side_effect = queue_error
+    builder = VariantBuilder(vapp, None, "some_file", defer_indexing=True)
+    builder.deferred_uuids = {"a": True}
+    with mock.patch.object(builder, "extract_sample_relations", return_value={}):
+        with mock.patch.object(builder, "build_records", return_value=iter([])):
+            with mock.patch.object(builder, "save_checkpoint") as save_checkpoint:
+                with mock.patch.object(builder, "clear_checkpoint") as clear_checkpoint:
+                    success, error = builder.ingest_vcf()
+    clear_checkpoint.assert_not_called()
+    if queue_error is None:
+        assert (success, error) == (0, 0)
+        save_checkpoint.assert_not_called()
+        assert builder.deferred_uuids == {}
+        return
+    assert (success, error) == (0, 1)
+    assert builder.ingestion_report.get_errors() == [
+        {"body": "Could not queue 1 items of some_file for indexing: queue unavailable", "row": -1}
+    ]
+    [(args, kwargs)] = save_checkpoint.call_args_list
+    assert args == (0,) and kwargs["report"].total_errors() == 0
+    assert list(builder.deferred_uuids) == ["a"]
+
+
+@pytest.mark.parametrize("processes", [None, 2])
+def test_build_variant_resolves_consequence_links(processes):
+    """ Tests that variant consequences with a known uuid are linked by uuid. """
+    builder = VariantBuilder(None, VCFParser(TEST_VCF, VARIANT_SCHEMA, VARIANT_SAMPLE_SCHEMA), "some_file",
+                             processes=processes)
+    builder.consequence_uuids = {"splice_region_variant": "a-uuid"}
+    if processes:
+        built = list(builder.build_records_in_parallel({}))
+    else:
+        built = list(builder.build_records({}))
+    consequences = [
+        consequence
+        for _, variant, _, _ in built
+        for transcript in variant.get("transcript", [])
+        for consequence in transcript.get("csq_consequence", [])
+    ]
+    assert "a-uuid" in consequences
+    assert "splice_region_variant" not in consequences
+    assert len(set(consequences)) > 1  # other consequences are still linked by name
+
+
 class TestStructuralVariantBuilder:
 
     SV_VCF_PARSER = StructuralVariantVCFParser(TEST_SV_VCF, SV_SCHEMA, SV_SAMPLE_SCHEMA)
@@ -96,10 +409,10 @@ class TestStructuralVariantBuilder:
         assert sv_sample["callers"] == ["Manta"]
         assert sv_sample["caller_types"] == ["SV"]
 
-    def test_post_or_patch(self, testapp, project, institution):
+    def test_upsert(self, testapp, project, institution):
         """
-        Test for POST and PATCH handling for structural variants and
-        structural variant samples.
+        Test that structural variants and structural variant samples are
+        created and then updated by annotation_id.
         """
         builder = StructuralVariantBuilder(
             testapp,
@@ -117,15 +430,158 @@ class TestStructuralVariantBuilder:
             del structural_variant[key]
         for key in ["last_modified"]:
             del structural_variant_sample[key]
-        variant_post = builder._post_or_patch_variant(structural_variant)
-        variant_uuid = variant_post["@graph"][0]["uuid"]
-        builder._post_or_patch_variant_sample(structural_variant_sample, variant_uuid)
-        variant_patch = builder._post_or_patch_variant(structural_variant)
-        builder._post_or_patch_variant_sample(structural_variant_sample, variant_uuid)
+        variant_post = builder._upsert_variant(structural_variant)
+        variant_uuid = variant_post["uuid"]
+        sample_post = builder._upsert_variant_sample(structural_variant_sample)
+        variant_patch = builder._upsert_variant(structural_variant)
+        sample_patch = builder._upsert_variant_sample(structural_variant_sample)
         sample_atid = testapp.get(
             "/structural-variant-samples/", status=200
         ).json["@graph"][0]["@id"]
         sample = testapp.get(sample_atid + "?frame=raw", status=200).json
-        assert variant_post["status"] == "success"
-        assert variant_patch["status"] == "success"
+        assert variant_post["status"] == sample_post["status"] == "created"
+        assert variant_patch["status"] == sample_patch["status"] == "updated"
+        assert variant_patch["uuid"] == variant_uuid
+        assert sample_patch["uuid"] == sample_post["uuid"]
         assert sample["structural_variant"] == variant_uuid
+
+    def test_upsert_skip_unchanged(self, testapp, project, institution):
+        """
+        Test that unchanged items are not rewritten when skipping unchanged
+        items, while changed items still are.
+        """
+        builder = StructuralVariantBuilder(
+            testapp,
+            self.SV_VCF_PARSER,
+            "some_file",
+            project=project["uuid"],
+            institution=institution["uuid"],
+            skip_unchanged=True,
+        )
+        structural_variant = builder.build_variant(self.RECORD)
+        del structural_variant["transcript"]
+        del structural_variant["last_modified"]
+        assert builder._upsert_variant(structural_variant)["status"] == "created"
+        assert builder._upsert_variant(structural_variant)["status"] == "unchanged"
+        structural_variant["unrelated_count"] = structural_variant.get("unrelated_count", 0) + 1
+        assert builder._upsert_variant(structural_variant)["status"] == "updated"
+
+    def test_upsert_error(self, testapp, project, institution):
+        """ Test that an item that cannot be written raises an error. """
+        builder = StructuralVariantBuilder(
+            testapp,
+            self.SV_VCF_PARSER,
+            "some_file",
+            project=project["uuid"],
+            institution=institution["uuid"],
+        )
+        with pytest.raises(VariantBuilderError):
+            builder._upsert_variant({"CHROM": "1"})
+
+    def test_write_batch(self, testapp, project, institution):
+        """
+        Test that batches of structural variants and structural variant
+        samples are created and then updated through the bulk endpoint.
+        """
+        builder = StructuralVariantBuilder(
+            testapp,
+            self.SV_VCF_PARSER,
+            "some_file",
+            project=project["uuid"],
+            institution=institution["uuid"],
+            batch_size=10,
+        )
+        structural_variant = builder.build_variant(self.RECORD)
+        structural_variant_samples = builder.build_variant_samples(
+            structural_variant, self.RECORD, {}
+        )
+        for key in ["transcript", "last_modified"]:
+            del structural_variant[key]
+        for structural_variant_sample in structural_variant_samples:
+            del structural_variant_sample["last_modified"]
+        builder.write_batch([(0, structural_variant, structural_variant_samples)])
+        builder.write_batch([(1, structural_variant, structural_variant_samples)])
+        assert builder.ingestion_report.total_successful() == 2
+        assert builder.ingestion_report.total_errors() == 0
+        assert builder.metrics.counters["batches"] == 2
+        assert builder.metrics.counters["retries"] == 0
+        variants = testapp.get("/structural-variants/", status=200).json["@graph"]
+        samples = testapp.get(
+            "/structural-variant-samples/", status=200
+        ).json["@graph"]
+        assert len(variants) == 1
+        assert len(samples) == len(structural_variant_samples)
+
+    def test_write_batch_defer_indexing(self, testapp, project, institution):
+        """
+        Test that items written in batches are not queued for indexing as
+        they are written, but once each, in batches, when deferred.
+        """
+        urls, queued = [], []
+
+        def post_json(url, body, **kwargs):
+            urls.append(url)
+            if url == VariantBuilder.QUEUE_INDEXING_ENDPOINT:
+                queued.append(body["uuids"])
+                return None
+            return testapp.post_json(url, body, **kwargs)
+
+        builder = StructuralVariantBuilder(
+            mock.Mock(post_json=post_json),
+            self.SV_VCF_PARSER,
+            "some_file",
+            project=project["uuid"],
+            institution=institution["uuid"],
+            batch_size=10,
+            defer_indexing=True,
+        )
+        structural_variant = builder.build_variant(self.RECORD)
+        structural_variant_samples = builder.build_variant_samples(
+            structural_variant, self.RECORD, {}
+        )
+        for key in ["transcript", "last_modified"]:
+            del structural_variant[key]
+        for structural_variant_sample in structural_variant_samples:
+            del structural_variant_sample["last_modified"]
+        builder.write_batch([(0, structural_variant, structural_variant_samples)])
+        builder.write_batch([(1, structural_variant, structural_variant_samples)])
+        assert urls == [VariantBuilder.BULK_UPSERT_ENDPOINT + "?skip_indexing=true"] * 2
+        uuids = list(builder.deferred_uuids)
+        assert len(uuids) == 1 + len(structural_variant_samples)
+        with mock.patch("encoded.ingestion.variant_utils.DEFERRED_INDEXING_BATCH_SIZE", 1):
+            assert builder.queue_deferred_indexing() == len(uuids)
+        assert queued == [[uuid] for uuid in uuids]
+        assert builder.deferred_uuids == {}
+        assert builder.metrics.counters["queued_for_indexing"] == len(uuids)
+        assert builder.queue_deferred_indexing() == 0
+
+    def test_write_batch_reports_invalid_records(self, testapp, project, institution):
+        """
+        Test that an invalid record in a batch is reported as a failure
+        without failing the other records in the batch.
+        """
+        builder = StructuralVariantBuilder(
+            testapp,
+            self.SV_VCF_PARSER,
+            "some_file",
+            project=project["uuid"],
+            institution=institution["uuid"],
+            batch_size=10,
+        )
+        structural_variant = builder.build_variant(self.RECORD)
+        for key in ["transcript", "last_modified"]:
+            del structural_variant[key]
+        invalid_variant = dict(structural_variant, START="not_a_position")
+        builder.write_batch([(0, invalid_variant, []), (1, structural_variant, [])])
+        assert builder.ingestion_report.total_successful() == 1
+        assert builder.ingestion_report.total_errors() == 1
+        assert builder.ingestion_report.get_errors()[0]["row"] == 0
+
+
+def test_bulk_upsert_rejects_unsupported_item_type(testapp):
+    """ Tests that the bulk endpoint only accepts annotated item types. """
+    testapp.post_json(
+        "/bulk_upsert",
+        {"items": [{"item_type": "gene_list", "properties": {}}]},
+        status=400,
+    )
@@ -0,0 +1,160 @@
+import pytest
+import time
+import tracemalloc
+import vcf
+
+from importlib.metadata import version
+
+from ..ingestion.vcf_reader import (
+    PYVCF_VERSION, LazyVCFReader, get_raw_records, get_reader_header_lines, set_raw_records
+)
+from ..ingestion.vcf_utils import StructuralVariantVCFParser, VCFParser
+from .test_vcf_utils import (
+    SV_SAMPLE_SCHEMA, SV_SCHEMA, TEST_CNV_VCF, TEST_SV_VCF, TEST_VCF, VARIANT_SAMPLE_SCHEMA, VARIANT_SCHEMA
+)
+
+
+pytestmark = [pytest.mark.working, pytest.mark.ingestion]
+
+VCF_LINES = [
+    '##fileformat=VCFv4.2',
+    '##INFO=<ID=DP,Number=1,Type=Integer,Description="Depth">',
+    '##INFO=<ID=AF,Number=A,Type=Float,Description="Allele frequency">',
+    '##INFO=<ID=DB,Number=0,Type=Flag,Description="dbSNP">',
+    '##INFO=<ID=ANN,Number=.,Type=String,Description="Annotations">',
+    '##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">',
+    '##FORMAT=<ID=AD,Number=R,Type=Integer,Description="Allelic depths">',
+    '##FORMAT=<ID=GQ,Number=1,Type=Integer,Description="Genotype quality">',
+    '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tsample_one\tsample_two',
+    'chr1\t100\t.\tA\tC,<DEL>\t50\tPASS\tDP=12;AF=0.5,.;DB;ANN=a|b,c|d;OTHER=x;NOVALUE\tGT:AD:GQ\t0/1:5,7:.\t./.:.:3',
+    'chr2\t200\trs1\tG\tT\t.\tq10;s50\t.\tGT\t1/1',
+]
+
+
+def read_records(reader_class, lines=VCF_LINES):
+    return list(reader_class(iter(lines)))
+
+
+def assert_same_record(lazy_record, record):
+    for field in ['CHROM', 'POS', 'ID', 'REF', 'QUAL', 'FILTER', 'FORMAT']:
+        assert getattr(lazy_record, field) == getattr(record, field)
+    assert [str(alt) for alt in lazy_record.ALT] == [str(alt) for alt in record.ALT]
+    assert [type(alt) for alt in lazy_record.ALT] == [type(alt) for alt in record.ALT]
+    assert dict(lazy_record.INFO.items()) == record.INFO
+    assert list(lazy_record.INFO) == list(record.INFO)
+    assert [(call.sample, call.data) for call in lazy_record.samples] == [
+        (call.sample, call.data) for call in record.samples
+    ]
+
+
+def test_lazy_vcf_reader():
+    """ Tests records read by LazyVCFReader have the same values as those of vcf.Reader. """
+    lazy_records = read_records(LazyVCFReader)
+    records = read_records(vcf.Reader)
+    assert len(lazy_records) == len(records) == 2
+    for lazy_record, record in zip(lazy_records, records):
+        assert_same_record(lazy_record, record)
+    info = lazy_records[0].INFO
+    assert info['DP'] == 12
+    assert info['AF'] == [0.5, None]
+    assert info['DB'] is True
+    assert info['ANN'] == ['a|b', 'c|d']
+    assert info['OTHER'] == ['x']
+    assert info['NOVALUE'] is True
+    assert info.get('MISSING') is None and 'MISSING' not in info
+    with pytest.raises(KeyError):
+        info['MISSING']  # noQA - raises
+
+
+def test_pyvcf_version():
+    """ Tests the installed PyVCF is the version whose internals vcf_reader relies on: on upgrading it, check
+        these still work as they do (ie: with test_pyvcf_internals) and update PYVCF_VERSION. """
+    assert version("dcicpyvcf").split(".")[:2] == PYVCF_VERSION.split(".")
+
+
+@pytest.mark.parametrize("reader_class", [vcf.Reader, LazyVCFReader])
+def test_pyvcf_internals(reader_class):
+    """ Tests the header lines and raw records of a reader are read and given to it through its internals. """
+    reader = reader_class(iter(VCF_LINES))
+    header_lines = get_reader_header_lines(reader)
+    assert header_lines == VCF_LINES[:-2]
+    assert list(get_raw_records(reader)) == VCF_LINES[-2:]
+    from_header = reader_class(iter(header_lines))
+    for line, record in zip(VCF_LINES[-2:], read_records(vcf.Reader)):
+        set_raw_records(from_header, iter([line]))
+        assert_same_record(next(from_header), record)
+        with pytest.raises(StopIteration):
+            next(from_header)
+
+
+def test_lazy_vcf_reader_is_lazy():
+    """ Tests INFO values and sample data are only parsed once read. """
+    record = read_records(LazyVCFReader)[0]
+    info = record.INFO
+    assert info._values == {}
+    assert info.get('DP') == 12
+    assert list(info._values) == ['DP']
+    assert record._calls is None
+    call = record.samples[0]
+    assert call._data is None
+    assert call.data.AD == [5, 7]
+
+
+@pytest.mark.parametrize("parser_class, vcf_path, variant_schema, sample_schema", [
+    (VCFParser, TEST_VCF, VARIANT_SCHEMA, VARIANT_SAMPLE_SCHEMA),
+    (StructuralVariantVCFParser, TEST_SV_VCF, SV_SCHEMA, SV_SAMPLE_SCHEMA),
+    (StructuralVariantVCFParser, TEST_CNV_VCF, SV_SCHEMA, SV_SAMPLE_SCHEMA),
+])
+def test_parse_with_lazy_vcf_reader(parser_class, vcf_path, variant_schema, sample_schema):
+    """ Tests parsers give the same variants/variant samples with either reader. """
+    lazy_parser = parser_class(vcf_path, variant_schema, sample_schema, reader_class=LazyVCFReader)
+    parser = parser_class(vcf_path, variant_schema, sample_schema)
+    assert isinstance(lazy_parser.reader, LazyVCFReader)
+    assert lazy_parser.format == parser.format
+    count = 0
+    for lazy_record, record in zip(lazy_parser, parser):
+        assert_same_record(lazy_record, record)
+        assert lazy_parser.create_variant_from_record(lazy_record) == parser.create_variant_from_record(record)
+        assert (lazy_parser.create_sample_variant_from_record(lazy_record)
+                == parser.create_sample_variant_from_record(record))
+        count += 1
+    assert count > 0
+
+
+def test_lazy_vcf_reader_from_header_lines():
+    """ Tests a parser created from header lines parses raw records with the given reader class. """
+    parser = StructuralVariantVCFParser(TEST_SV_VCF, SV_SCHEMA, SV_SAMPLE_SCHEMA, reader_class=LazyVCFReader)
+    header_lines = parser.get_header_lines()
+    lines = list(parser.iter_raw_records())
+    from_header = StructuralVariantVCFParser.from_header_lines(header_lines, SV_SCHEMA, SV_SAMPLE_SCHEMA,
+                                                              reader_class=LazyVCFReader)
+    for line, record in zip(lines, StructuralVariantVCFParser(TEST_SV_VCF, SV_SCHEMA, SV_SAMPLE_SCHEMA)):
+        assert_same_record(from_header.parse_raw_record(line), record)
+
+
+@pytest.mark.performance
+@pytest.mark.parametrize("vcf_path", [TEST_VCF, TEST_SV_VCF, TEST_CNV_VCF])
+def test_lazy_vcf_reader_performance(vcf_path):
+    """ Microbenchmark of record parsing with vcf.Reader and LazyVCFReader: records parsed per second, and
+        memory held per record once all records are read.
+        Note: run with bin/test -s -m performance to see the prints from the test
+    """
+    with open(vcf_path) as f:
+        lines = f.read().splitlines()
+    header = [line for line in lines if line.startswith("#")]
+    body = [line for line in lines if not line.startswith("#")]
+    lines = header + body * (1000 // len(body))  # so parsing the (large) header once is negligible
+    for reader_class in [vcf.Reader, LazyVCFReader]:
+        reader = reader_class(iter(lines))
+        start = time.time()
+        count = len(list(reader))
+        rate = count / (time.time() - start)
+        reader = reader_class(iter(lines))
+        tracemalloc.start()
+        try:
+            records = list(reader)
+            memory, _ = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        print("PERFORMANCE: %s parsed %.0f records/sec, holding %.0f bytes/record (%s)"
+              % (reader_class.__name__, rate, memory / len(records), vcf_path.split("/")[-1]))
@@ -1,4 +1,7 @@
 import pytest
+import time
+
+from unittest import mock
 
 from ..ingestion.vcf_utils import VCFParser, StructuralVariantVCFParser
 from ..util import resolve_file_path
@@ -60,6 +63,39 @@ def test_vcf():
     return parser
 
 
+def build_variant_by_schema_lookup(parser, record):
+    """ Builds the INFO fields of the variant from the record looking up the schema for every
+        value with validate_variant_value, as a reference for the compiled cast plan.
+    """
+    result = {}
+    for key in parser.format.keys():
+        if key not in parser.annotation_keys:
+            if record.INFO.get(key, None):
+                val = parser.validate_variant_value(key, record.INFO.get(key))
+                if val is not None:
+                    result[key] = val
+            continue
+        sub_embedded_group = parser.sub_embedded_mapping.get(key, None)
+        if sub_embedded_group in parser.variant_sample_sub_embedded_fields or not record.INFO.get(key, None):
+            continue
+        for g_idx, group in enumerate(parser.parse_annotation_field_value(record.INFO.get(key))):
+            for f_idx, field in enumerate(group):
+                fn = parser.format[key][f_idx]
+                if not field or fn == parser.DROPPED_FIELD:
+                    continue
+                fn = parser.OVERWRITE_FIELDS.get(fn, fn)
+                if key in parser.sub_embedded_mapping:
+                    result.setdefault(sub_embedded_group, {}).setdefault(g_idx, {})
+                value = parser.validate_variant_value(fn, field, key)
+                if value is None:
+                    continue
+                if key in parser.sub_embedded_mapping and fn not in parser.variant_props:
+                    result[sub_embedded_group][g_idx][fn] = value
+                else:
+                    result[fn] = value
+    return result
+
+
 class TestIngestVCF:
 
     def test_parser_meta(self, test_vcf):
@@ -71,6 +107,31 @@ class TestIngestVCF:
             assert annot_field in annotation_fields
         assert test_vcf.get_sub_embedded_label('comHet') == ('cmphet', False)
 
+    def test_variant_cast_plan(self, test_vcf):
+        """ Tests that variants built with the compiled cast plan are identical to those
+            built looking up the schema for every value
+        """
+        for record in test_vcf:
+            expected = build_variant_by_schema_lookup(test_vcf, record)
+            result = test_vcf.create_variant_from_record(record)
+            for vcf_field in test_vcf.VCF_FIELDS:
+                result.pop(vcf_field, None)
+            assert result == dict(test_vcf.variant_defaults, **expected)
+
+    @pytest.mark.performance
+    def test_build_variants_performance(self, test_vcf):
+        """ Microbenchmark of variant/variant sample building.
+            Note: run with bin/test -s -m performance to see the prints from the test
+        """
+        records = list(test_vcf)
+        count, start = 0, time.time()
+        while time.time() - start < 5:
+            for record in records:
+                test_vcf.create_variant_from_record(record)
+                test_vcf.create_sample_variant_from_record(record)
+                count += 1
+        print("PERFORMANCE: Built %.0f records/sec" % (count / (time.time() - start)))
+
     @pytest.mark.skip  # invoked by below test
     def test_build_one_variant(self, test_vcf):
         """
@@ -374,3 +435,56 @@ class TestIngestStructuralVariantVCF():
         assert get_top_level_field(result[0], "bicseq2_pvalue") == 4.1426e-52
         assert get_top_level_field(result[0], "confidence_class") == "LOW"
         assert get_top_level_field(result[0], "quality_score") is None
+
+    def test_annotation_field_indexes(self, test_sv_vcf):
+        """
+        Tests the compiled annotation field indexes give the annotations
+        with each field, in order, and the first index of the field in them.
+        """
+        for field, field_indexes in test_sv_vcf.annotation_field_indexes.items():
+            expected = [
+                (annotation, test_sv_vcf.format[annotation].index(field))
+                for annotation in test_sv_vcf.annotation_keys
+                if field in test_sv_vcf.format.get(annotation, [])
+            ]
+            assert field_indexes == expected
+        assert "csq_gene" in test_sv_vcf.annotation_field_indexes
+
+    def test_record_annotations_parsed_once(self, test_sv_vcf):
+        """
+        Tests annotation INFO fields are only split once per record, for
+        the variant and its samples.
+        """
+        with mock.patch.object(
+            test_sv_vcf, "parse_annotation_field_value",
+            wraps=test_sv_vcf.parse_annotation_field_value,
+        ) as mocked_parse:
+            for record in test_sv_vcf:
+                mocked_parse.reset_mock()
+                test_sv_vcf.create_variant_from_record(record)
+                test_sv_vcf.create_sample_variant_from_record(record)
+                annotations = [
+                    annotation for annotation in test_sv_vcf.annotation_keys
+                    if record.INFO.get(annotation)
+                ]
+                assert mocked_parse.call_count <= len(annotations)
+                for annotation in annotations:
+                    assert (
+                        test_sv_vcf.get_record_annotations(record, annotation)
+                        == test_sv_vcf.parse_annotation_field_value(record.INFO[annotation])
+                    )
+
+    @pytest.mark.performance
+    def test_build_structural_variants_performance(self, test_sv_vcf):
+        """
+        Microbenchmark of structural variant/variant sample building.
+        Note: run with bin/test -s -m performance to see the prints from the test
+        """
+        records = list(test_sv_vcf)
+        count, start = 0, time.time()
+        while time.time() - start < 5:
+            for record in records:
+                test_sv_vcf.create_variant_from_record(record)
+                test_sv_vcf.create_sample_variant_from_record(record)
+                count += 1
+        print("PERFORMANCE: Built %.0f structural variant records/sec" % (count / (time.time() - start)))
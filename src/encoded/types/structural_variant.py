@@ -98,17 +98,25 @@ class StructuralVariant(Item):
     schema = load_schema("encoded:schemas/structural_variant.json")
     embedded_list = build_structural_variant_embedded_list()
 
-    @classmethod
-    def create(cls, registry, uuid, properties, sheets=None):
+    @staticmethod
+    def build_annotation_id(properties):
         """
-        Sets the annotation_id field on this structural variant prior to passing on.
+        Builds the annotation_id (unique key) of a structural variant from
+        its (validated) properties.
         """
-        properties[ANNOTATION_ID] = build_structural_variant_display_title(
+        return build_structural_variant_display_title(
             properties["SV_TYPE"],
             properties["CHROM"],
             properties["START"],
             properties["END"],
         )
+
+    @classmethod
+    def create(cls, registry, uuid, properties, sheets=None):
+        """
+        Sets the annotation_id field on this structural variant prior to passing on.
+        """
+        properties[ANNOTATION_ID] = cls.build_annotation_id(properties)
         return super().create(registry, uuid, properties, sheets)
 
     @calculated_property(
@@ -380,17 +388,26 @@ class StructuralVariantSample(Item):
         "son_II_genotype_label",
     ]
 
-    @classmethod
-    def create(cls, registry, uuid, properties, sheets=None):
+    @staticmethod
+    def build_annotation_id(properties):
         """
-        Sets the annotation_id field on this structural variant sample
-        prior to passing on.
+        Builds the annotation_id (unique key) of a structural variant
+        sample from its (validated) properties, where 'structural_variant'
+        is the uuid of the linked structural variant.
         """
-        properties[ANNOTATION_ID] = "%s:%s:%s" % (
+        return "%s:%s:%s" % (
             properties["CALL_INFO"],
             properties["structural_variant"],
             properties["file"],
         )
+
+    @classmethod
+    def create(cls, registry, uuid, properties, sheets=None):
+        """
+        Sets the annotation_id field on this structural variant sample
+        prior to passing on.
+        """
+        properties[ANNOTATION_ID] = cls.build_annotation_id(properties)
         return super().create(registry, uuid, properties, sheets)
 
     @calculated_property(
@@ -28,6 +28,7 @@ from ..ingestion.common import CGAP_CORE_PROJECT
 from ..inheritance_mode import InheritanceMode
 from snovault.search.search import get_iterable_search_results
 from ..types.base import Item, get_item_or_none
+from .variant_consequence import get_variant_consequence_name
 from ..util import resolve_file_path, build_s3_presigned_get_url, convert_integer_to_comma_string
 
 
@@ -294,16 +295,21 @@ class Variant(Item):
     schema = load_extended_descriptions_in_schemas(load_schema('encoded:schemas/variant.json'))
     embedded_list = build_variant_embedded_list()
 
-    @classmethod
-    def create(cls, registry, uuid, properties, sheets=None):
-        """ Sets the annotation_id field on this variant prior to passing on. """
-        properties[ANNOTATION_ID] = build_variant_display_title(
+    @staticmethod
+    def build_annotation_id(properties):
+        """ Builds the annotation_id (unique key) of a variant from its (validated) properties. """
+        return build_variant_display_title(
             properties['CHROM'],
             properties['POS'],
             properties['REF'],
             properties['ALT'],
             sep=ANNOTATION_ID_SEP  # XXX: replace _ with >  to get display_title('>' char is restricted)
         )
+
+    @classmethod
+    def create(cls, registry, uuid, properties, sheets=None):
+        """ Sets the annotation_id field on this variant prior to passing on. """
+        properties[ANNOTATION_ID] = cls.build_annotation_id(properties)
         return super().create(registry, uuid, properties, sheets)
 
     @calculated_property(schema={
@@ -350,10 +356,7 @@ class Variant(Item):
                 elif exon:
                     result = "Exon " + exon
                     for consequence in consequences:
-                        item = get_item_or_none(request, consequence)
-                        if not item:
-                            continue
-                        consequence_title = item.get("var_conseq_name")
+                        consequence_title = get_variant_consequence_name(request, consequence)
                         if consequence_title == "3_prime_UTR_variant":
                             result += " (3' UTR)"
                             break
@@ -362,10 +365,7 @@ class Variant(Item):
                             break
                 elif distance:
                     for consequence in consequences:
-                        item = get_item_or_none(request, consequence)
-                        if not item:
-                            continue
-                        consequence_title = item.get("var_conseq_name")
+                        consequence_title = get_variant_consequence_name(request, consequence)
                         if consequence_title == "downstream_gene_variant":
                             result = distance + " bp downstream"
                             break
@@ -489,14 +489,17 @@ class VariantSample(Item):
                 refresh_interval='5s'  # force update every 5 seconds
             )
 
+    @staticmethod
+    def build_annotation_id(properties):
+        """ Builds the annotation_id (unique key) of a variant_sample from its (validated) properties,
+            where 'variant' is the uuid of the linked variant. """
+        return build_variant_sample_annotation_id(properties['CALL_INFO'], properties['variant'],
+                                                  properties['file'])
+
     @classmethod
     def create(cls, registry, uuid, properties, sheets=None):
         """ Sets the annotation_id field on this variant_sample prior to passing on. """
-        properties[ANNOTATION_ID] = '%s:%s:%s' % (
-            properties['CALL_INFO'],
-            properties['variant'],
-            properties['file']
-        )
+        properties[ANNOTATION_ID] = cls.build_annotation_id(properties)
         return super().create(registry, uuid, properties, sheets)
 
     @staticmethod
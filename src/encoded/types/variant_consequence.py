@@ -1,14 +1,29 @@
 """Collection for Variant Classifier objects."""
 from snovault import (
+    COLLECTIONS,
     calculated_property,
     collection,
     load_schema,
 )
 from .base import (
-    Item
+    Item,
 )
 
 
+def get_variant_consequence_name(request, consequence):
+    """ Returns the var_conseq_name of the given linked variant consequence, None if it cannot be found or viewed.
+        The item is got from its collection rather than embedded, so looking up the same consequences again
+        within a request is served by the (bounded, per transaction) item cache of the connection.
+
+    :param request: current request
+    :param consequence: uuid (or other identifier) of the variant consequence
+    """
+    item = request.registry[COLLECTIONS]['variant_consequence'].get(consequence)
+    if item is None or not request.has_permission('view', item):
+        return None
+    return item.properties.get('var_conseq_name')
+
+
 @collection(
     name='variant-consequences',
     unique_key='variant_consequence:var_conseq_id',